@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "ipetrash"
+
+
+# Запуск: python -m benchmarks.cards
+
+
+import json
+import time
+from unittest import mock
+
+import telegram as tg
+
+# pip install python-telegram-bot-pagination
+from telegram_bot_pagination import InlineKeyboardPaginator
+
+from bot import commands
+from bot.common import add_prev_next_buttons, get_keyboard_fingerprint, get_paginator_markup
+from bot.cards import card_cache
+from bot.catalog import get_catalog
+from benchmarks.common import measure_ms
+
+
+# Типичное время ответа Bot API на запрос
+RTT_SECS = 0.1
+
+API_METHODS = [
+    "reply_text",
+    "reply_photo",
+    "edit_text",
+    "edit_caption",
+    "edit_media",
+]
+
+
+class FakeTelegram:
+    """
+    Сообщения, у которых каждый вызов Bot API ждет RTT_SECS и считается
+    """
+
+    def __init__(self, rtt_secs: float = RTT_SECS):
+        self.rtt_secs = rtt_secs
+        self.number_of_calls = 0
+        self._last_message_id = 0
+
+    def _call(self, *args, **kwargs) -> mock.MagicMock:
+        self.number_of_calls += 1
+        time.sleep(self.rtt_secs)
+        return self.new_message()
+
+    def new_message(self) -> mock.MagicMock:
+        self._last_message_id += 1
+
+        message = mock.MagicMock()
+        message.message_id = self._last_message_id
+        for name in API_METHODS:
+            getattr(message, name).side_effect = self._call
+
+        return message
+
+    def new_update(self) -> mock.MagicMock:
+        update = mock.MagicMock()
+        update.callback_query = None
+        update.effective_chat.id = 1
+        update.effective_message = self.new_message()
+        return update
+
+
+def run():
+    catalog = get_catalog()
+
+    # Отправка по file_id, без загрузки файлов
+    for cover in catalog.covers:
+        if not catalog.get_server_file_id(cover.id):
+            catalog.set_server_file_id(cover.id, "file_id")
+
+    cover = catalog.covers[len(catalog.covers) // 2]
+    game = cover.game
+
+    context = mock.MagicMock()
+    context.match = None
+    context.bot.link = "https://t.me/bot"
+
+    list_context = mock.MagicMock()
+    list_context.match = {"page": "1"}
+    list_context.bot.link = context.bot.link
+
+    for title, func in [
+        (
+            "cover card",
+            lambda update: commands.reply_cover_page_card(update, context, cover_id=cover.id),
+        ),
+        (
+            "game card",
+            lambda update: commands.reply_game_card(update, context, game_id=game.id),
+        ),
+        (
+            "authors page",
+            lambda update: commands.reply_page_objects(
+                update, list_context,
+                model_title="Авторы",
+                objects=catalog.get_authors(),
+                paginator_pattern="{page}",
+            ),
+        ),
+    ]:
+        telegram = FakeTelegram()
+        elapsed_ms = measure_ms(lambda: func(telegram.new_update()), repeat=10)
+
+        print(
+            f"{title:<12} | API calls: {telegram.number_of_calls / 10:.0f} | "
+            f"{elapsed_ms:7.1f} ms (RTT {RTT_SECS * 1000:.0f} ms)"
+        )
+
+
+def run_render():
+    catalog = get_catalog()
+    cover = max(catalog.covers, key=lambda x: len(x.authors))
+    author = cover.authors[0]
+
+    context = mock.MagicMock()
+    context.bot.link = "https://t.me/bot"
+
+    telegram = FakeTelegram(rtt_secs=0)
+    update = telegram.new_update()
+
+    def _do():
+        commands.get_cover_text(
+            update, context, cover,
+            reply_to_message_id=update.effective_message.message_id,
+            by_author=author.id,
+        )
+
+    def _do_without_cache():
+        card_cache.clear()
+        _do()
+
+    without_cache_ms = measure_ms(_do_without_cache, repeat=1000)
+    with_cache_ms = measure_ms(_do, repeat=1000)
+    print(
+        f"get_cover_text | without cache: {without_cache_ms * 1000:7.1f} us | "
+        f"with cache: {with_cache_ms * 1000:7.1f} us"
+    )
+
+
+def run_keyboard():
+    # Клавиатура карточки обложки при клике на ⬅️/➡️ и сравнение с клавиатурой сообщения
+    page_count, page = 500, 250
+    data_pattern = "covers page={page} a#1 gs# g#"
+    prev_data_pattern = "covers page={page} <c#123 a#1 gs# g#"
+    next_data_pattern = "covers page={page} >c#123 a#1 gs# g#"
+
+    message_markup = tg.InlineKeyboardMarkup.de_json(
+        json.loads(
+            get_paginator_markup(
+                page_count, page, data_pattern, prev_data_pattern, next_data_pattern
+            ).markup
+        ),
+        bot=None,
+    )
+
+    def _do_without_cache():
+        paginator = InlineKeyboardPaginator(
+            page_count=page_count,
+            current_page=page,
+            data_pattern=data_pattern,
+        )
+        add_prev_next_buttons(
+            paginator,
+            prev_data_pattern=prev_data_pattern,
+            next_data_pattern=next_data_pattern,
+        )
+        markup = paginator.markup
+        assert json.loads(markup)["inline_keyboard"] == message_markup.to_dict()["inline_keyboard"]
+
+    def _do():
+        keyboard = get_paginator_markup(
+            page_count, page, data_pattern, prev_data_pattern, next_data_pattern
+        )
+        assert keyboard.fingerprint == get_keyboard_fingerprint(message_markup)
+
+    without_cache_ms = measure_ms(_do_without_cache, repeat=1000)
+    with_cache_ms = measure_ms(_do, repeat=1000)
+    print(
+        f"keyboard       | without cache: {without_cache_ms * 1000:7.1f} us | "
+        f"with cache: {with_cache_ms * 1000:7.1f} us"
+    )
+
+
+if __name__ == "__main__":
+    run()
+    run_render()
+    run_keyboard()
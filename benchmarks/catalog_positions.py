@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "ipetrash"
+
+
+# Запуск: python -m benchmarks.catalog_positions
+
+
+from unittest import mock
+
+from peewee import fn
+
+from bot import catalog as catalog_module
+from bot.catalog import Catalog
+from bot.db import Cover, Game, Author2Cover
+from benchmarks.common import synthetic_db, measure_ms
+
+
+def run(number_of_covers: int):
+    with synthetic_db(number_of_covers):
+        # Самый частый автор и серия его первой обложки, чтобы пересечение было непустым
+        author_id = (
+            Author2Cover.select(Author2Cover.author)
+            .group_by(Author2Cover.author)
+            .order_by(fn.COUNT(Author2Cover.id).desc())
+            .scalar()
+        )
+        game_series_id = (
+            Game.select(Game.series)
+            .join(Cover)
+            .join(Author2Cover)
+            .where(Author2Cover.author == author_id)
+            .scalar()
+        )
+
+        catalog = Catalog.load()
+
+        for title, cover_filters in [
+            ("all", dict()),
+            ("by_author", dict(by_author=author_id)),
+            ("by_author+gs", dict(by_author=author_id, by_game_series=game_series_id)),
+        ]:
+            total = Cover.count_by(**cover_filters)
+            cover_id = Cover.get_by_page(page=total, **cover_filters).id
+
+            def _do():
+                Cover.count_by(**cover_filters)
+                Cover.get_page(need_cover_id=cover_id, **cover_filters)
+
+            with mock.patch.object(catalog_module, "_catalog", None):
+                sql_ms = measure_ms(_do)
+
+            with mock.patch.object(catalog_module, "_catalog", catalog):
+                assert total == Cover.count_by(**cover_filters)
+                assert total == Cover.get_page(need_cover_id=cover_id, **cover_filters)
+                catalog_ms = measure_ms(_do)
+
+            print(
+                f"{number_of_covers:>9} | {title:<12} | total {total:>6} | "
+                f"sql: {sql_ms:8.3f} ms | catalog: {catalog_ms:8.3f} ms"
+            )
+
+
+if __name__ == "__main__":
+    for number_of_covers in [1_000, 10_000, 100_000]:
+        run(number_of_covers)
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "ipetrash"
+
+
+import datetime as DT
+import random
+import statistics
+import tempfile
+import time
+
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Iterator
+
+# pip install peewee
+from peewee import SqliteDatabase, chunked
+
+from bot.db import (
+    GameSeries,
+    Game,
+    Author,
+    Cover,
+    Author2Cover,
+    CoverIndex,
+    CatalogStatistic,
+    CATALOG_MODELS,
+    casefold,
+)
+
+
+def fill_synthetic(number_of_covers: int, seed: int = 0):
+    """
+    Заполнение каталога случайными данными в пропорциях реальной базы:
+    Author: 165, Cover: 567, Game: 451, GameSeries: 200
+    """
+
+    rnd = random.Random(seed)
+
+    number_of_games = max(1, number_of_covers * 451 // 567)
+    number_of_game_series = max(1, number_of_covers * 200 // 567)
+    number_of_authors = max(1, number_of_covers * 165 // 567)
+
+    game_series = [
+        dict(id=i, name=f"Серия {i}", slug=f"серия_{i}")
+        for i in range(1, number_of_game_series + 1)
+    ]
+    games = [
+        dict(
+            id=i,
+            name=f"Game {i}",
+            slug=f"game_{i}",
+            series=rnd.randint(1, number_of_game_series),
+        )
+        for i in range(1, number_of_games + 1)
+    ]
+    authors = [
+        dict(id=i, name=f"Автор {i}", url=f"https://vk.com/id{i}")
+        for i in range(1, number_of_authors + 1)
+    ]
+
+    covers = []
+    links = []
+    date_time = DT.datetime(2012, 8, 8)
+    for i in range(1, number_of_covers + 1):
+        # Как и в реальной базе, у обложек из одного поста одинаковая дата
+        if rnd.random() > 0.05:
+            date_time += DT.timedelta(minutes=rnd.randint(1, 60 * 24))
+
+        covers.append(
+            dict(
+                id=i,
+                text=f"Обложка {i}",
+                file_name=f"images/{i}_1.jpg",
+                url_post=f"https://vk.com/wall-1_{i}",
+                url_post_image=f"https://vk.com/photo-1_{i}",
+                game=rnd.randint(1, number_of_games),
+                date_time=date_time,
+            )
+        )
+        for author_id in rnd.sample(range(1, number_of_authors + 1), k=min(2, number_of_authors)):
+            links.append(dict(author=author_id, cover=i))
+            if rnd.random() > 0.1:
+                break
+
+    database = Cover._meta.database
+    with database.atomic():
+        for model, rows in [
+            (GameSeries, game_series),
+            (Game, games),
+            (Author, authors),
+            (Cover, covers),
+            (Author2Cover, links),
+        ]:
+            for batch in chunked(rows, 500):
+                model.insert_many(batch).execute()
+
+    CoverIndex.rebuild()
+    CatalogStatistic.rebuild()
+
+
+@contextmanager
+def empty_db() -> Iterator[SqliteDatabase]:
+    """
+    Временная пустая база, к которой на время блока привязаны модели каталога
+    """
+
+    with tempfile.TemporaryDirectory() as dir_name:
+        database = SqliteDatabase(
+            Path(dir_name) / "database.sqlite",
+            pragmas={
+                "foreign_keys": 1,
+                "journal_mode": "wal",
+            },
+        )
+        database.register_function(casefold)
+
+        with database.bind_ctx(CATALOG_MODELS):
+            database.create_tables(CATALOG_MODELS)
+            yield database
+
+        database.close()
+
+
+@contextmanager
+def synthetic_db(number_of_covers: int, seed: int = 0) -> Iterator[SqliteDatabase]:
+    with empty_db() as database:
+        fill_synthetic(number_of_covers, seed)
+        yield database
+
+
+def measure_ms(func: Callable, repeat: int = 20) -> float:
+    """
+    Медианное время выполнения функции в миллисекундах
+    """
+
+    items = []
+    for _ in range(repeat):
+        t = time.perf_counter_ns()
+        func()
+        items.append((time.perf_counter_ns() - t) / 1_000_000)
+
+    return statistics.median(items)
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "ipetrash"
+
+
+# Запуск: python -m benchmarks.fill_db [--delta-factor 880]
+
+
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import tempfile
+import time
+
+from pathlib import Path
+from typing import Iterator
+
+from config import FILE_NAME_DUMP
+from data_vk.fill_db import DUMP_MODELS, iter_dumps, import_files
+from benchmarks.common import empty_db
+
+
+def iter_synthetic_dumps(factor: int, start: int = 0) -> Iterator[dict]:
+    """
+    Копии записей реального дампа. У каждой копии свои посты, картинки, игры, серии и авторы,
+    поэтому объектов в базе будет в factor раз больше
+    """
+
+    dumps = list(iter_dumps(FILE_NAME_DUMP))
+
+    for i in range(start, start + factor):
+        for dump in dumps:
+            dump = dict(dump)
+            dump["post_id"] += i * 1_000_000
+            dump["photo_file_name"] = f"{i}_{dump['photo_file_name']}"
+            dump["game_name"] = f"{dump['game_name']} {i}"
+            if dump["game_series"]:
+                dump["game_series"] = f"{dump['game_series']} {i}"
+            dump["authors"] = [
+                dict(id=author["id"] + i * 1_000_000_000, name=author["name"])
+                for author in dump["authors"]
+            ]
+            yield dump
+
+
+def make_synthetic_dump(file_name: Path, factor: int):
+    with open(file_name, "w", encoding="utf-8") as f:
+        f.write("[")
+        for dump in iter_synthetic_dumps(factor):
+            if f.tell() > 1:
+                f.write(",")
+            f.write(json.dumps(dump, ensure_ascii=False))
+        f.write("]")
+
+
+def append_synthetic_lines(file_name: Path, dumps: Iterator[dict]):
+    with open(file_name, "a", encoding="utf-8") as f:
+        for dump in dumps:
+            f.write(json.dumps(dump, ensure_ascii=False) + "\n")
+
+
+def run(factor: int, bulk: bool):
+    with tempfile.TemporaryDirectory() as dir_name:
+        file_name = Path(dir_name) / "dump.json"
+        make_synthetic_dump(file_name, factor)
+
+        with empty_db(), contextlib.redirect_stdout(io.StringIO()):
+            t = time.perf_counter()
+            import_files([file_name], bulk=bulk)
+            elapsed_secs = time.perf_counter() - t
+
+            number_of_rows = sum(model.select().count() for model in DUMP_MODELS)
+
+    title = "bulk" if bulk else "row-by-row"
+    print(
+        f"x{factor:<4} | {title:<10} | {number_of_rows:>7} rows | "
+        f"{elapsed_secs:7.2f} secs | {number_of_rows / elapsed_secs:8.0f} rows/s"
+    )
+
+
+def run_delta(factor: int, number_of_new: int = 50):
+    """
+    Полный импорт дописываемого JSONL-дампа, а затем импорт только дописанных записей
+    """
+
+    with tempfile.TemporaryDirectory() as dir_name:
+        file_name = Path(dir_name) / "dump.jsonl"
+        append_synthetic_lines(file_name, iter_synthetic_dumps(factor))
+
+        with empty_db(), contextlib.redirect_stdout(io.StringIO()):
+            def measure(title: str, delta: bool) -> str:
+                t = time.perf_counter()
+                number_of_dumps = import_files([file_name], delta=delta)
+                elapsed_secs = time.perf_counter() - t
+                return f"{title:<22} | {number_of_dumps:>7} dumps | {elapsed_secs:7.3f} secs"
+
+            results = [measure("full import", delta=False)]
+            results.append(measure("delta without new", delta=True))
+
+            new_dumps = itertools.islice(iter_synthetic_dumps(1, start=factor), number_of_new)
+            append_synthetic_lines(file_name, new_dumps)
+            results.append(measure(f"delta with {number_of_new} new", delta=True))
+
+    for result in results:
+        print(f"x{factor:<4} | {result}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--delta-factor",
+        type=int,
+        default=100,
+        help="Во сколько раз дамп для импорта новых записей больше реального",
+    )
+    args = parser.parse_args()
+
+    for factor in [1, 10]:
+        run(factor, bulk=False)
+
+    for factor in [1, 10, 100]:
+        run(factor, bulk=True)
+
+    print()
+    run_delta(args.delta_factor)
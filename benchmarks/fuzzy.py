@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "ipetrash"
+
+
+# Запуск: python -m benchmarks.fuzzy
+
+
+import random
+import time
+
+from bot.catalog import Catalog
+from bot.fuzzy import FuzzyIndex, get_similarity, get_words
+from benchmarks.common import measure_ms
+
+
+QUERIES = ["batlefeld 3", "максимум боли", "соколв", "need for sped undrcover"]
+
+
+def add_typo(word: str, rnd: random.Random) -> str:
+    i = rnd.randrange(len(word))
+    return word[:i] + rnd.choice("абвгдeklmnos") + word[i + 1:]
+
+
+def get_documents(catalog: Catalog, scale: int, seed: int = 0) -> list[tuple[str, ...]]:
+    """
+    Тексты обложек реального каталога, повторенные scale раз. В копиях часть
+    слов с опечаткой, чтобы словарь рос вместе с каталогом
+    """
+
+    rnd = random.Random(seed)
+
+    documents = []
+    for _ in range(scale):
+        for cover in catalog.covers:
+            texts = [
+                cover.text,
+                cover.game.name,
+                cover.game.series_name,
+                *(author.name for author in cover.authors),
+            ]
+            documents.append(tuple(
+                " ".join(
+                    add_typo(word, rnd) if rnd.random() < 0.2 else word
+                    for word in get_words(text)
+                )
+                for text in texts
+            ))
+
+    return documents
+
+
+def run(scale: int):
+    documents = get_documents(Catalog.load(), scale)
+
+    t = time.perf_counter()
+    index = FuzzyIndex(documents)
+    build_ms = (time.perf_counter() - t) * 1000
+
+    print(
+        f"x{scale:<4} | covers: {len(documents):>6} | words: {len(index):>6} | "
+        f"build: {build_ms:8.1f} ms"
+    )
+
+    for query in QUERIES:
+        # Без индекса каждое слово запроса сравнивается со всеми словами каталога
+        def _scan():
+            for word in get_words(query):
+                [other for other in index.words if get_similarity(word, other) >= 0.3]
+
+        index_ms = measure_ms(lambda: index.search(query))
+        scan_ms = measure_ms(_scan, repeat=3)
+        print(
+            f"    {query!r:<26} | found: {len(index.search(query)):>6} | "
+            f"index: {index_ms:7.2f} ms | scan words: {scan_ms:8.2f} ms"
+        )
+
+
+if __name__ == "__main__":
+    for scale in [1, 10, 100]:
+        run(scale)
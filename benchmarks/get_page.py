@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "ipetrash"
+
+
+# Запуск: python -m benchmarks.get_page
+
+
+from peewee import fn
+
+from bot.db import Cover, Author2Cover
+from benchmarks.common import synthetic_db, measure_ms
+
+
+def get_page_by_row_number(need_cover_id: int, filters: list) -> int:
+    # Прежняя реализация Cover.get_page: перебор всех строк в Python
+    query = Cover.select(
+        fn.row_number().over(order_by=Cover.get_order_by()).alias("page"),
+        Cover.id,
+    )
+    if filters:
+        query = query.where(*filters)
+    query = query.order_by(*Cover.get_order_by())
+
+    for page, cover_id in query.tuples():
+        if cover_id == need_cover_id:
+            return page
+
+
+def run(number_of_covers: int):
+    with synthetic_db(number_of_covers):
+        # Самый частый автор, чтобы выборка по нему была большой
+        author_id = (
+            Author2Cover.select(Author2Cover.author)
+            .group_by(Author2Cover.author)
+            .order_by(fn.COUNT(Author2Cover.id).desc())
+            .scalar()
+        )
+
+        for title, cover_filters in [
+            ("all", dict()),
+            ("by_author", dict(by_author=author_id)),
+        ]:
+            filters = Cover.get_filters(**cover_filters)
+
+            # Последняя обложка - худший случай для перебора
+            query = Cover.select(Cover.id).order_by(Cover.date_time.desc(), Cover.id.desc())
+            if filters:
+                query = query.where(*filters)
+            cover_id = query.scalar()
+
+            page = Cover.get_page(need_cover_id=cover_id, **cover_filters)
+            assert page == get_page_by_row_number(cover_id, filters)
+
+            old_ms = measure_ms(lambda: get_page_by_row_number(cover_id, filters))
+            new_ms = measure_ms(lambda: Cover.get_page(need_cover_id=cover_id, **cover_filters))
+            print(
+                f"{number_of_covers:>9} | {title:<9} | page {page:>6} | "
+                f"row_number: {old_ms:8.3f} ms | count: {new_ms:8.3f} ms"
+            )
+
+
+if __name__ == "__main__":
+    for number_of_covers in [1_000, 10_000, 100_000]:
+        run(number_of_covers)
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "ipetrash"
+
+
+import atexit
+import datetime as DT
+import logging
+import threading
+import time
+
+from typing import Type
+
+from peewee import EXCLUDED, Insert
+import telegram
+
+from config import ACTIVITY_FLUSH_INTERVAL_SECS, ACTIVITY_FLUSH_MAX_EVENTS
+from bot.common import log
+from bot.db import telemetry_db, BaseModel, TgUser, TgChat
+
+
+class ActivityTracker:
+    """
+    Накопление активности пользователей и чатов в памяти с периодической записью в базу.
+    Вместо нескольких запросов на каждый запрос к боту изменения по каждому
+    пользователю и чату схлопываются и записываются одним UPSERT на таблицу
+    """
+
+    # Поля профиля, что копируются из объектов telegram
+    PROFILE_FIELDS: dict[Type[BaseModel], list[str]] = {
+        TgUser: ["first_name", "last_name", "username", "language_code"],
+        TgChat: ["type", "title", "username", "first_name", "last_name", "description"],
+    }
+
+    def __init__(
+        self,
+        flush_interval_secs: float = ACTIVITY_FLUSH_INTERVAL_SECS,
+        flush_max_events: int = ACTIVITY_FLUSH_MAX_EVENTS,
+        log: logging.Logger = None,
+    ):
+        self.flush_interval_secs = flush_interval_secs
+        self.flush_max_events = flush_max_events
+        self.log = log
+
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+        # Между чтением из базы и записью пачки, чтобы количество запросов не учлось дважды
+        self._commit_lock = threading.Lock()
+
+        # Ожидающие записи строки по моделям: id -> значения полей
+        self._pending: dict[Type[BaseModel], dict[int, dict]] = self._new_pending()
+        self._pending_events = 0
+
+        # Записываемая пачка, до конца ее транзакции она учитывается в количестве запросов
+        self._flushing: dict[Type[BaseModel], dict[int, dict]] = self._new_pending()
+
+        self._need_flush = threading.Event()
+        self._stopped = threading.Event()
+        self._thread: threading.Thread | None = None
+
+        self.number_of_events = 0
+        self.number_of_flushes = 0
+        self.number_of_flushed_rows = 0
+        self.last_flush_ms = 0
+        self.last_flush_error: str | None = None
+
+    def _new_pending(self) -> dict[Type[BaseModel], dict[int, dict]]:
+        return {model: dict() for model in self.PROFILE_FIELDS}
+
+    def track(self, user: telegram.User | None, chat: telegram.Chat | None):
+        with self._lock:
+            for model, obj in [(TgUser, user), (TgChat, chat)]:
+                if not obj:
+                    continue
+
+                row = self._pending[model].get(obj.id)
+                if not row:
+                    row = self._pending[model][obj.id] = dict(id=obj.id, number_requests=0)
+
+                # Поля профиля перезаписываются последними значениями
+                for name in self.PROFILE_FIELDS[model]:
+                    row[name] = getattr(obj, name)
+
+                row["last_activity"] = DT.datetime.now()
+                row["number_requests"] += 1
+
+            self._pending_events += 1
+            self.number_of_events += 1
+            need_flush = self._pending_events >= self.flush_max_events
+
+        if need_flush:
+            self._need_flush.set()
+
+    def get_number_requests(self, model: Type[TgUser | TgChat], object_id: int) -> int:
+        """
+        Количество запросов с учетом еще не записанных в базу
+        """
+
+        # Пока записывается пачка, ее запросы еще в памяти, а после в базе, но не там и там сразу
+        with self._commit_lock:
+            with self._lock:
+                pending = 0
+                for rows in [self._pending[model], self._flushing[model]]:
+                    row = rows.get(object_id)
+                    if row:
+                        pending += row["number_requests"]
+
+            obj = model.get_or_none(model.id == object_id)
+
+        return (obj.number_requests if obj else 0) + pending
+
+    def is_first_request(self, chat: telegram.Chat) -> bool:
+        return self.get_number_requests(TgChat, chat.id) in (0, 1)
+
+    def _get_upsert_query(self, model: Type[BaseModel], rows: list[dict]) -> Insert:
+        fields = [getattr(model, name) for name in self.PROFILE_FIELDS[model]]
+        return model.insert_many(rows).on_conflict(
+            conflict_target=[model.id],
+            preserve=fields + [model.last_activity],
+            update={
+                model.number_requests: model.number_requests + EXCLUDED.number_requests,
+            },
+        )
+
+    def flush(self) -> int:
+        """
+        Запись накопленной активности в базу. Возвращает количество записанных строк
+        """
+
+        # Одновременно идет только одна запись, чтобы порядок изменений не нарушался
+        with self._flush_lock:
+            with self._lock:
+                pending = self._flushing = self._pending
+                self._pending = self._new_pending()
+                self._pending_events = 0
+
+            number_of_rows = sum(len(rows) for rows in pending.values())
+            if not number_of_rows:
+                return 0
+
+            t = time.perf_counter_ns()
+            with self._commit_lock:
+                try:
+                    # Строки по каждой таблице записываются одним запросом, а все таблицы -
+                    # одной транзакцией, поэтому при ошибке ничего из пачки не запишется
+                    telemetry_db.execute_atomic(
+                        self._get_upsert_query(model, list(rows.values()))
+                        for model, rows in pending.items()
+                        if rows
+                    )
+
+                except Exception as e:
+                    self.last_flush_error = str(e)
+                    if self.log:
+                        self.log.exception("Ошибка при записи активности")
+
+                    # Незаписанная активность вернется в очередь и запишется в следующий раз
+                    self._restore(pending)
+                    return 0
+
+                with self._lock:
+                    self._flushing = self._new_pending()
+
+            self.last_flush_ms = (time.perf_counter_ns() - t) // 1_000_000
+            self.last_flush_error = None
+            self.number_of_flushes += 1
+            self.number_of_flushed_rows += number_of_rows
+
+            return number_of_rows
+
+    def _restore(self, pending: dict[Type[BaseModel], dict[int, dict]]):
+        with self._lock:
+            self._flushing = self._new_pending()
+            for model, rows in pending.items():
+                for object_id, old_row in rows.items():
+                    row = self._pending[model].get(object_id)
+                    if row:
+                        # Более новые значения профиля остаются, а запросы суммируются
+                        row["number_requests"] += old_row["number_requests"]
+                    else:
+                        self._pending[model][object_id] = old_row
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._need_flush.wait(self.flush_interval_secs)
+            self._need_flush.clear()
+            self.flush()
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="ActivityTracker", daemon=True
+        )
+        self._thread.start()
+
+        atexit.register(self.stop)
+
+    def stop(self):
+        atexit.unregister(self.stop)
+
+        self._stopped.set()
+        self._need_flush.set()
+
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+        # Запись того, что осталось после остановки потока
+        self.flush()
+
+    def get_metrics(self) -> dict[str, int | str | None]:
+        with self._lock:
+            pending_users = len(self._pending[TgUser])
+            pending_chats = len(self._pending[TgChat])
+            pending_events = self._pending_events
+
+        return {
+            "pending_events": pending_events,
+            "pending_users": pending_users,
+            "pending_chats": pending_chats,
+            "events": self.number_of_events,
+            "flushes": self.number_of_flushes,
+            "flushed_rows": self.number_of_flushed_rows,
+            "last_flush_ms": self.last_flush_ms,
+            "last_flush_error": self.last_flush_error,
+            "db_write_queue": telemetry_db.get_write_queue_size(),
+        }
+
+
+activity_tracker = ActivityTracker(log=log)
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "ipetrash"
+
+
+import hashlib
+import logging
+import threading
+
+from pathlib import Path
+from typing import IO, Callable
+
+import telegram
+from telegram.error import BadRequest
+
+from bot.common import log
+from bot.db import MediaAsset
+from bot.uploader import SingleFlight, get_photo_file_id
+
+
+def get_message_file_id(message: telegram.Message) -> str:
+    # GIF, отправленный документом, телеграм превращает в анимацию
+    for attachment in [
+        message.animation,
+        message.video,
+        message.audio,
+        message.voice,
+        message.sticker,
+        message.document,
+    ]:
+        if attachment:
+            return attachment.file_id
+
+    if message.photo:
+        return get_photo_file_id(message)
+
+    raise ValueError(f"В сообщении #{message.message_id} нет файла")
+
+
+class AssetRegistry:
+    """
+    Реестр file_id статичных файлов, например, GIF из etc/screenshots.
+    Файл загружается в телеграм один раз, а после отправляется по file_id.
+    Ключ - хэш содержимого, поэтому измененный файл загрузится заново
+    """
+
+    def __init__(self, log: logging.Logger = None):
+        self.log = log
+
+        self._lock = threading.Lock()
+        # Путь -> (mtime_ns, размер, хэш), чтобы не читать файл при каждой отправке
+        self._hash_by_file_name: dict[Path, tuple[int, int, str]] = dict()
+        self._file_id_by_hash: dict[str, str] = dict()
+        self._single_flight = SingleFlight()
+
+    def get_hash(self, file_name: Path) -> str:
+        stat = file_name.stat()
+        with self._lock:
+            cached = self._hash_by_file_name.get(file_name)
+
+        if cached and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+            return cached[2]
+
+        content_hash = hashlib.sha256(file_name.read_bytes()).hexdigest()
+        with self._lock:
+            self._hash_by_file_name[file_name] = (stat.st_mtime_ns, stat.st_size, content_hash)
+
+        return content_hash
+
+    def get_file_id(self, file_name: Path) -> str | None:
+        content_hash = self.get_hash(file_name)
+
+        file_id = self._file_id_by_hash.get(content_hash)
+        if not file_id:
+            file_id = MediaAsset.get_file_id(content_hash)
+            if file_id:
+                self._file_id_by_hash[content_hash] = file_id
+
+        return file_id
+
+    def _set_file_id(self, content_hash: str, file_name: Path, file_id: str | None):
+        if file_id:
+            self._file_id_by_hash[content_hash] = file_id
+        else:
+            self._file_id_by_hash.pop(content_hash, None)
+
+        MediaAsset.set_file_id(content_hash, file_name.name, file_id)
+
+    def forget(self, file_name: Path):
+        """
+        Удаление file_id файла, которого больше нет, например, коллажа прошлой версии
+        """
+
+        with self._lock:
+            cached = self._hash_by_file_name.pop(file_name, None)
+        if cached:
+            self._file_id_by_hash.pop(cached[2], None)
+
+        MediaAsset.delete_by_file_name(file_name.name)
+
+    def send(
+        self,
+        file_name: Path,
+        send: Callable[[str | IO], telegram.Message],
+    ) -> telegram.Message:
+        """
+        Отправка файла через send, которому передается file_id или открытый файл.
+        Параллельные отправки еще не загруженного файла дождутся одной загрузки
+        """
+
+        content_hash = self.get_hash(file_name)
+
+        file_id = self.get_file_id(file_name)
+        if file_id:
+            try:
+                return send(file_id)
+            except BadRequest as e:
+                # Например, file_id от другого бота
+                if "file identifier" not in str(e):
+                    raise
+
+                if self.log:
+                    self.log.warning(f"Недействительный file_id у {file_name.name}: {e}")
+                self._set_file_id(content_hash, file_name, None)
+
+        message: telegram.Message | None = None
+
+        def _upload() -> str:
+            nonlocal message
+
+            # Файл мог загрузиться, пока ждали блокировку
+            file_id = self._file_id_by_hash.get(content_hash)
+            if file_id:
+                return file_id
+
+            with open(file_name, "rb") as f:
+                message = send(f)
+
+            file_id = get_message_file_id(message)
+            self._set_file_id(content_hash, file_name, file_id)
+
+            return file_id
+
+        file_id = self._single_flight.do(content_hash, _upload)
+
+        # Файл загрузил другой запрос, осталось отправить его по file_id
+        if message is None:
+            message = send(file_id)
+
+        return message
+
+
+asset_registry = AssetRegistry(log=log)
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "ipetrash"
+
+
+import sys
+import threading
+
+from collections import OrderedDict
+from typing import Callable, Hashable
+
+from config import CARD_CACHE_MAX_BYTES
+
+
+# Вместо id чата и сообщения в шаблоне стоят метки, что не встретятся в экранированном тексте
+CHAT_ID_PLACEHOLDER = "\x00chat_id\x00"
+MESSAGE_ID_PLACEHOLDER = "\x00message_id\x00"
+
+
+def fill_card(template: str, chat_id: int, message_id: int) -> str:
+    return template.replace(
+        CHAT_ID_PLACEHOLDER, str(chat_id)
+    ).replace(
+        MESSAGE_ID_PLACEHOLDER, str(message_id)
+    )
+
+
+class CardCache:
+    """
+    Кэш шаблонов текстов карточек и списков. От пользователя к пользователю в тексте
+    меняются только id чата и сообщения в ссылках, поэтому HTML строится один раз
+    с метками вместо них, а при отправке метки заменяются.
+    Ключ должен включать версию каталога. Давно не использованные шаблоны удаляются,
+    когда общий размер превышает max_bytes
+    """
+
+    def __init__(self, max_bytes: int = CARD_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+
+        self._lock = threading.Lock()
+        self._items: OrderedDict[Hashable, str] = OrderedDict()
+        self._size_by_key: dict[Hashable, int] = dict()
+        self._total_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_template(self, key: Hashable, render: Callable[[], str]) -> str:
+        with self._lock:
+            template = self._items.get(key)
+            if template is not None:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return template
+
+            self.misses += 1
+
+        # Построение вне блокировки, одинаковый шаблон могут построить дважды, это не страшно
+        template = render()
+        size = sys.getsizeof(key) + sys.getsizeof(template)
+
+        with self._lock:
+            if key not in self._items:
+                self._items[key] = template
+                self._size_by_key[key] = size
+                self._total_bytes += size
+
+            while self._total_bytes > self.max_bytes and len(self._items) > 1:
+                old_key, _ = self._items.popitem(last=False)
+                self._total_bytes -= self._size_by_key.pop(old_key)
+                self.evictions += 1
+
+        return template
+
+    def get(
+        self,
+        key: Hashable,
+        render: Callable[[], str],
+        chat_id: int,
+        message_id: int,
+    ) -> str:
+        """
+        Текст по шаблону из кэша, render строит шаблон при промахе
+        """
+
+        return fill_card(self.get_template(key, render), chat_id, message_id)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._size_by_key.clear()
+            self._total_bytes = 0
+
+    def get_metrics(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "items": len(self._items),
+                "bytes": self._total_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+card_cache = CardCache()
@@ -0,0 +1,628 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "ipetrash"
+
+
+import datetime as DT
+import itertools
+import sys
+import threading
+
+from array import array
+from bisect import bisect_left
+from collections import defaultdict
+from pathlib import Path
+from typing import Iterable, Optional, Sequence
+
+from config import DIR_DATA_VK
+from bot.fuzzy import FuzzyIndex
+from bot.db import (
+    GameSeries,
+    Game,
+    Author,
+    Cover,
+    Author2Cover,
+    CatalogStatistic,
+    get_catalog_version,
+)
+
+
+class Record:
+    """
+    Базовый класс записей каталога.
+    Записи повторяют нужные для отображения поля моделей, но не обращаются к базе
+    """
+
+    __slots__ = ()
+
+    # Название модели, используется в ссылках (deep linking)
+    model_name: str = None
+
+    def __repr__(self) -> str:
+        fields = ", ".join(f"{k}={getattr(self, k)!r}" for k in self.__slots__[:2])
+        return f"{self.__class__.__name__}({fields})"
+
+    def __eq__(self, other) -> bool:
+        return type(self) is type(other) and self.id == other.id
+
+    def __hash__(self) -> int:
+        return hash((self.model_name, self.id))
+
+
+class GameSeriesRecord(Record):
+    __slots__ = (
+        "id", "name",
+        "number_of_covers", "number_of_authors", "number_of_games",
+    )
+    model_name = GameSeries.__name__
+
+    def __init__(self, id: int, name: str):
+        self.id = id
+        self.name = name
+        self.number_of_covers = 0
+        self.number_of_authors = 0
+        self.number_of_games = 0
+
+
+class GameRecord(Record):
+    __slots__ = (
+        "id", "name", "series",
+        "number_of_covers", "number_of_authors",
+    )
+    model_name = Game.__name__
+
+    def __init__(self, id: int, name: str, series: GameSeriesRecord | None):
+        self.id = id
+        self.name = name
+        self.series = series
+        self.number_of_covers = 0
+        self.number_of_authors = 0
+
+    @property
+    def series_name(self) -> str:
+        return self.series.name if self.series else ""
+
+
+class AuthorRecord(Record):
+    __slots__ = (
+        "id", "name", "url",
+        "number_of_covers", "number_of_games", "number_of_game_series",
+    )
+    model_name = Author.__name__
+
+    def __init__(self, id: int, name: str, url: str):
+        self.id = id
+        self.name = name
+        self.url = url
+        self.number_of_covers = 0
+        self.number_of_games = 0
+        self.number_of_game_series = 0
+
+
+class CoverRecord(Record):
+    __slots__ = (
+        "id", "text", "file_name", "url_post", "url_post_image",
+        "date_time", "game", "authors",
+    )
+    model_name = Cover.__name__
+
+    def __init__(
+        self,
+        id: int,
+        text: str,
+        file_name: str,
+        url_post: str,
+        url_post_image: str,
+        date_time: DT.datetime,
+        game: GameRecord,
+        authors: tuple[AuthorRecord, ...],
+    ):
+        self.id = id
+        self.text = text
+        self.file_name = file_name
+        self.url_post = url_post
+        self.url_post_image = url_post_image
+        self.date_time = date_time
+        self.game = game
+        self.authors = authors
+
+    @property
+    def abs_file_name(self) -> Path:
+        return DIR_DATA_VK / self.file_name
+
+    def get_authors(self) -> list[AuthorRecord]:
+        return list(self.authors)
+
+
+EMPTY_POSITIONS = array("I")
+
+
+def intersect_positions(a: Sequence[int], b: Sequence[int]) -> array:
+    """
+    Пересечение возрастающих массивов позиций.
+    Для каждого элемента короткого массива бинарным поиском ищется совпадение в длинном,
+    причем поиск продолжается с места прошлого совпадения
+    """
+
+    if len(a) > len(b):
+        a, b = b, a
+
+    result = array("I")
+    lo = 0
+    for x in a:
+        lo = bisect_left(b, x, lo)
+        if lo == len(b):
+            break
+
+        if b[lo] == x:
+            result.append(x)
+
+    return result
+
+
+# Номер каждого нового снимка каталога
+_versions = itertools.count(1)
+
+
+class Catalog:
+    """
+    Неизменяемый снимок каталога (обложки, игры, серии игр и авторы) в памяти.
+    Каталог меняется только при заполнении базы, поэтому все чтения для
+    обработчиков можно выполнять без обращения к базе.
+    Единственное, что меняется у снимка, - это server_file_id обложек после их загрузки
+    в телеграм. Они хранятся отдельно от записей, в словаре под блокировкой
+    """
+
+    def __init__(
+        self,
+        covers: list[CoverRecord],
+        games: list[GameRecord],
+        game_series: list[GameSeriesRecord],
+        authors: list[AuthorRecord],
+        db_version: int = 0,
+        server_file_id_by_cover_id: dict[int, str] = None,
+    ):
+        # Кэши того, что построено по каталогу, хранятся с его версией,
+        # поэтому после reload_catalog старые значения не используются.
+        # Версия сравнивается в памяти, без обращения к базе
+        self.version: int = next(_versions)
+
+        # Версия базы (ее увеличивает заполнение), по которой загружен снимок
+        self.db_version: int = db_version
+
+        # Обложки в порядке Cover.get_order_by, позиция в списке - это номер страницы без фильтров
+        self.covers: list[CoverRecord] = covers
+
+        # Остальные объекты в порядке отображения в списках
+        self.games: list[GameRecord] = sorted(games, key=lambda x: (x.name, x.id))
+        self.game_series: list[GameSeriesRecord] = sorted(game_series, key=lambda x: (x.name, x.id))
+        self.authors: list[AuthorRecord] = sorted(authors, key=lambda x: (x.name, x.id))
+
+        self.cover_by_id: dict[int, CoverRecord] = {obj.id: obj for obj in self.covers}
+        self.game_by_id: dict[int, GameRecord] = {obj.id: obj for obj in self.games}
+        self.game_series_by_id: dict[int, GameSeriesRecord] = {obj.id: obj for obj in self.game_series}
+        self.author_by_id: dict[int, AuthorRecord] = {obj.id: obj for obj in self.authors}
+
+        # Позиция обложки в self.covers
+        self.position_by_cover_id: dict[int, int] = {
+            obj.id: i for i, obj in enumerate(self.covers)
+        }
+
+        # Возрастающие позиции обложек по каждому фильтру. Номер обложки при фильтре - это
+        # индекс ее позиции в массиве, а для пересечения фильтров хватает бинарного поиска
+        self.positions_by_author: dict[int, array] = defaultdict(lambda: array("I"))
+        self.positions_by_game: dict[int, array] = defaultdict(lambda: array("I"))
+        self.positions_by_game_series: dict[int, array] = defaultdict(lambda: array("I"))
+        for i, cover in enumerate(self.covers):
+            self.positions_by_game[cover.game.id].append(i)
+            if cover.game.series:
+                self.positions_by_game_series[cover.game.series.id].append(i)
+
+            for author in cover.authors:
+                self.positions_by_author[author.id].append(i)
+
+        # После заполнения обращение к отсутствующим ключам не должно добавлять их
+        self.positions_by_author = dict(self.positions_by_author)
+        self.positions_by_game = dict(self.positions_by_game)
+        self.positions_by_game_series = dict(self.positions_by_game_series)
+
+        # Обложки загружаются в телеграм из нескольких потоков, а записи читаются без блокировки
+        self._server_file_id_by_cover_id: dict[int, str] = dict(server_file_id_by_cover_id or {})
+        self._server_file_id_lock = threading.Lock()
+
+        self._fuzzy_index: FuzzyIndex | None = None
+        self._fuzzy_index_lock = threading.Lock()
+
+    @classmethod
+    def load(cls) -> "Catalog":
+        db_version = get_catalog_version()
+
+        game_series_by_id = {
+            id: GameSeriesRecord(id, name)
+            for id, name in GameSeries.select(GameSeries.id, GameSeries.name).tuples()
+        }
+        game_by_id = {
+            id: GameRecord(id, name, game_series_by_id.get(series_id))
+            for id, name, series_id in Game.select(Game.id, Game.name, Game.series).tuples()
+        }
+        author_by_id = {
+            id: AuthorRecord(id, name, url)
+            for id, name, url in Author.select(Author.id, Author.name, Author.url).tuples()
+        }
+
+        authors_by_cover_id: dict[int, list[AuthorRecord]] = defaultdict(list)
+        query = (
+            Author2Cover.select(Author2Cover.cover, Author2Cover.author)
+            .order_by(Author2Cover.cover, Author2Cover.author)
+        )
+        for cover_id, author_id in query.tuples():
+            authors_by_cover_id[cover_id].append(author_by_id[author_id])
+
+        query = (
+            Cover.select(
+                Cover.id,
+                Cover.text,
+                Cover.file_name,
+                Cover.url_post,
+                Cover.url_post_image,
+                Cover.date_time,
+                Cover.game,
+            )
+            .order_by(*Cover.get_order_by())
+        )
+        covers = [
+            CoverRecord(
+                id=id,
+                text=text,
+                file_name=file_name,
+                url_post=url_post,
+                url_post_image=url_post_image,
+                date_time=date_time,
+                game=game_by_id[game_id],
+                authors=tuple(authors_by_cover_id[id]),
+            )
+            for id, text, file_name, url_post, url_post_image, date_time, game_id
+            in query.tuples()
+        ]
+
+        query = (
+            Cover.select(Cover.id, Cover.server_file_id)
+            .where(Cover.server_file_id.is_null(False))
+        )
+        server_file_id_by_cover_id = dict(query.tuples())
+
+        # Статистика уже подсчитана при заполнении базы
+        records_by_class_name: dict[str, dict[int, Record]] = {
+            Author.__name__: author_by_id,
+            GameSeries.__name__: game_series_by_id,
+            Game.__name__: game_by_id,
+        }
+        query = CatalogStatistic.select(
+            CatalogStatistic.class_name,
+            CatalogStatistic.object_id,
+            CatalogStatistic.number_of_covers,
+            CatalogStatistic.number_of_authors,
+            CatalogStatistic.number_of_games,
+            CatalogStatistic.number_of_game_series,
+        )
+        for class_name, object_id, *numbers in query.tuples():
+            obj = records_by_class_name[class_name].get(object_id)
+            if not obj:
+                continue
+
+            for name, value in zip(
+                ["number_of_covers", "number_of_authors", "number_of_games", "number_of_game_series"],
+                numbers,
+            ):
+                if name in obj.__slots__:
+                    setattr(obj, name, value)
+
+        return cls(
+            covers=covers,
+            games=list(game_by_id.values()),
+            game_series=list(game_series_by_id.values()),
+            authors=list(author_by_id.values()),
+            db_version=db_version,
+            server_file_id_by_cover_id=server_file_id_by_cover_id,
+        )
+
+    def get_fuzzy_index(self) -> FuzzyIndex:
+        # Индекс строится при первом обращении, бот обращается к нему при запуске
+        if self._fuzzy_index is None:
+            with self._fuzzy_index_lock:
+                if self._fuzzy_index is None:
+                    self._fuzzy_index = FuzzyIndex(
+                        (
+                            cover.text,
+                            cover.game.name,
+                            cover.game.series_name,
+                            *(author.name for author in cover.authors),
+                        )
+                        for cover in self.covers
+                    )
+
+        return self._fuzzy_index
+
+    def find_similar(self, text: str) -> list[CoverRecord]:
+        """
+        Обложки, у которых текст, игра, серия или авторы похожи на text, по убыванию похожести
+        """
+
+        return [
+            self.covers[position]
+            for position, _ in self.get_fuzzy_index().search(text)
+        ]
+
+    def get_cover(self, cover_id: int) -> CoverRecord:
+        return self.cover_by_id[cover_id]
+
+    def get_game(self, game_id: int) -> GameRecord:
+        return self.game_by_id[game_id]
+
+    def get_game_series(self, game_series_id: int) -> GameSeriesRecord:
+        return self.game_series_by_id[game_series_id]
+
+    def get_author(self, author_id: int) -> AuthorRecord:
+        return self.author_by_id[author_id]
+
+    def get_first_cover(self) -> Optional[CoverRecord]:
+        return self.covers[0] if self.covers else None
+
+    def get_last_cover(self) -> Optional[CoverRecord]:
+        return self.covers[-1] if self.covers else None
+
+    def get_positions(
+        self,
+        by_author: int = None,
+        by_game_series: int = None,
+        by_game: int = None,
+    ) -> Sequence[int]:
+        """
+        Возрастающие позиции обложек в self.covers, подходящих под фильтры
+        """
+
+        items = []
+        for positions_by_id, object_id in [
+            (self.positions_by_author, by_author),
+            (self.positions_by_game_series, by_game_series),
+            (self.positions_by_game, by_game),
+        ]:
+            if object_id is not None:
+                items.append(positions_by_id.get(object_id, EMPTY_POSITIONS))
+
+        if not items:
+            return range(len(self.covers))
+
+        # Пересечение начинается с самого короткого массива
+        items.sort(key=len)
+        positions = items[0]
+        for other in items[1:]:
+            positions = intersect_positions(positions, other)
+
+        return positions
+
+    def get_covers(self, **cover_filters) -> list[CoverRecord]:
+        """
+        Обложки по фильтрам в порядке Cover.get_order_by
+        """
+
+        positions = self.get_positions(**cover_filters)
+        if isinstance(positions, range):
+            return self.covers
+
+        return [self.covers[i] for i in positions]
+
+    def count_by(self, **cover_filters) -> int:
+        return len(self.get_positions(**cover_filters))
+
+    def get_by_page(self, page: int = 1, **cover_filters) -> Optional[CoverRecord]:
+        positions = self.get_positions(**cover_filters)
+        if 1 <= page <= len(positions):
+            return self.covers[positions[page - 1]]
+
+        return None
+
+    def get_index(self, positions: Sequence[int], cover_id: int) -> Optional[int]:
+        """
+        Индекс обложки в позициях из get_positions (номер страницы без единицы)
+        """
+
+        position = self.position_by_cover_id.get(cover_id)
+        if position is None:
+            return None
+
+        i = bisect_left(positions, position)
+        if i < len(positions) and positions[i] == position:
+            return i
+
+        return None
+
+    def get_page(self, need_cover_id: int, **cover_filters) -> int:
+        i = self.get_index(self.get_positions(**cover_filters), need_cover_id)
+        if i is None:
+            raise Exception(
+                f"Не удалось определить номер для #{need_cover_id} по {cover_filters}"
+            )
+
+        return i + 1
+
+    def get_near(
+        self,
+        cover_id: int,
+        reverse: bool = False,
+        **cover_filters,
+    ) -> Optional[CoverRecord]:
+        positions = self.get_positions(**cover_filters)
+        if not positions:
+            return None
+
+        i = self.get_index(positions, cover_id)
+        if i is None:
+            return self.covers[positions[-1 if reverse else 0]]
+
+        i = (i + (-1 if reverse else 1)) % len(positions)
+        return self.covers[positions[i]]
+
+    def get_authors(
+        self,
+        by_game_series: int = None,
+        by_game: int = None,
+    ) -> list[AuthorRecord]:
+        if by_game_series is None and by_game is None:
+            return self.authors
+
+        author_ids = None
+        for positions_by_id, object_id in [
+            (self.positions_by_game_series, by_game_series),
+            (self.positions_by_game, by_game),
+        ]:
+            if object_id is None:
+                continue
+
+            ids = {
+                author.id
+                for i in positions_by_id.get(object_id, EMPTY_POSITIONS)
+                for author in self.covers[i].authors
+            }
+            author_ids = ids if author_ids is None else (author_ids & ids)
+
+        return [obj for obj in self.authors if obj.id in author_ids]
+
+    def get_all_game_series(self, by_author: int = None) -> list[GameSeriesRecord]:
+        if by_author is None:
+            return self.game_series
+
+        covers = self.get_covers(by_author=by_author)
+        ids = {cover.game.series.id for cover in covers if cover.game.series}
+        return [obj for obj in self.game_series if obj.id in ids]
+
+    def get_games(
+        self,
+        by_author: int = None,
+        by_game_series: int = None,
+    ) -> list[GameRecord]:
+        games = self.games
+        if by_author is not None:
+            ids = {cover.game.id for cover in self.get_covers(by_author=by_author)}
+            games = [obj for obj in games if obj.id in ids]
+
+        if by_game_series is not None:
+            games = [
+                obj for obj in games
+                if obj.series and obj.series.id == by_game_series
+            ]
+
+        return games
+
+    @staticmethod
+    def paginating(items: list, page: int, items_per_page: int) -> list:
+        start = (page - 1) * items_per_page
+        return items[start: start + items_per_page]
+
+    def get_server_file_id(self, cover_id: int) -> str | None:
+        with self._server_file_id_lock:
+            return self._server_file_id_by_cover_id.get(cover_id)
+
+    def set_server_file_id(self, cover_id: int, server_file_id: str):
+        with self._server_file_id_lock:
+            self._server_file_id_by_cover_id[cover_id] = server_file_id
+
+    def get_memory_usage(self) -> dict[str, int]:
+        """
+        Примерный размер каталога в памяти в байтах по его частям
+        """
+
+        def _get_size(records: Iterable[Record]) -> int:
+            size = 0
+            for obj in records:
+                size += sys.getsizeof(obj)
+                for name in obj.__slots__:
+                    value = getattr(obj, name)
+                    # Объекты других записей учитываются в своих частях
+                    if not isinstance(value, (Record, int, type(None))):
+                        size += sys.getsizeof(value)
+            return size
+
+        def _get_size_of_index(index: dict) -> int:
+            # Записи учитываются в своих частях, поэтому считаются только массивы позиций
+            return sys.getsizeof(index) + sum(
+                sys.getsizeof(value) for value in index.values()
+                if isinstance(value, array)
+            )
+
+        # Словарь пополняется из других потоков
+        with self._server_file_id_lock:
+            server_file_ids_size = sys.getsizeof(self._server_file_id_by_cover_id) + sum(
+                sys.getsizeof(value) for value in self._server_file_id_by_cover_id.values()
+            )
+
+        return {
+            "covers": _get_size(self.covers),
+            "games": _get_size(self.games),
+            "game_series": _get_size(self.game_series),
+            "authors": _get_size(self.authors),
+            "server_file_ids": server_file_ids_size,
+            "indexes": sum(
+                _get_size_of_index(index)
+                for index in [
+                    self.cover_by_id,
+                    self.game_by_id,
+                    self.game_series_by_id,
+                    self.author_by_id,
+                    self.position_by_cover_id,
+                    self.positions_by_author,
+                    self.positions_by_game,
+                    self.positions_by_game_series,
+                ]
+            ),
+        }
+
+    def get_memory_report(self) -> str:
+        usage = self.get_memory_usage()
+        total = sum(usage.values())
+        items = [f"{name}: {size / 1024:.1f} KB" for name, size in usage.items()]
+        return (
+            f"Каталог (версия базы {self.db_version}): "
+            f"{len(self.covers)} обложек, {len(self.games)} игр, "
+            f"{len(self.game_series)} серий, {len(self.authors)} авторов. "
+            f"Память: {total / 1024:.1f} KB ({', '.join(items)})"
+        )
+
+
+_lock = threading.Lock()
+_catalog: Catalog | None = None
+
+
+def get_loaded_catalog() -> Catalog | None:
+    """
+    Каталог, если он уже загружен. Сам каталог этот вызов не загружает
+    """
+    return _catalog
+
+
+def get_catalog() -> Catalog:
+    global _catalog
+
+    # Каталог загружается один раз, после только заменяется целиком через reload_catalog
+    if _catalog is None:
+        with _lock:
+            if _catalog is None:
+                _catalog = Catalog.load()
+
+    return _catalog
+
+
+def reload_catalog() -> Catalog:
+    global _catalog
+
+    catalog = Catalog.load()
+    with _lock:
+        _catalog = catalog
+
+    return catalog
+
+
+if __name__ == "__main__":
+    catalog = get_catalog()
+    print(catalog.get_memory_report())
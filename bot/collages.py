@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "ipetrash"
+
+
+import atexit
+import hashlib
+import logging
+import os
+import threading
+
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+# pip install Pillow
+from PIL import Image, ImageDraw, ImageFont
+
+from config import (
+    DIR_THUMBNAILS_CACHE,
+    DIR_COLLAGES_CACHE,
+    COLLAGE_COVERS_PER_ROW,
+    COLLAGE_CELL_SIZE,
+    COLLAGE_JPEG_QUALITY,
+    COLLAGE_WORKERS,
+)
+from bot.assets import asset_registry
+from bot.catalog import CoverRecord
+from bot.common import log
+from bot.derivatives import DerivativeCache, get_mp_context
+from bot.uploader import SingleFlight
+
+
+BACKGROUND_COLOR = (32, 32, 32)
+TEXT_COLOR = (230, 230, 230)
+
+
+class CollageRenderer:
+    """
+    Коллажи для страниц списков авторов, серий и игр: строка на каждый объект из его
+    первых обложек. Миниатюры обложек создаются в пуле процессов и хранятся в кэше на диске,
+    как и готовые коллажи. Ключ коллажа - (объект, страница, версия), где версия - хэш
+    обложек в нем, поэтому после изменения каталога коллаж создастся заново, а коллаж
+    прошлой версии удалится вместе с его file_id
+    """
+
+    def __init__(
+        self,
+        dir_cache: Path = DIR_COLLAGES_CACHE,
+        dir_thumbnails: Path = DIR_THUMBNAILS_CACHE,
+        covers_per_row: int = COLLAGE_COVERS_PER_ROW,
+        cell_size: int = COLLAGE_CELL_SIZE,
+        quality: int = COLLAGE_JPEG_QUALITY,
+        workers: int = COLLAGE_WORKERS,
+        log: logging.Logger = None,
+    ):
+        self.dir_cache = dir_cache
+        self.covers_per_row = covers_per_row
+        self.cell_size = cell_size
+        self.quality = quality
+        self.workers = workers
+        self.log = log
+
+        self.thumbnails = DerivativeCache(
+            dir_cache=dir_thumbnails,
+            max_side=cell_size,
+            quality=quality,
+            log=log,
+        )
+
+        self._lock = threading.Lock()
+        self._executor: ProcessPoolExecutor | None = None
+        self._single_flight = SingleFlight()
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        # Пул создается при первом коллаже и живет до остановки бота,
+        # чтобы не запускать процессы на каждый запрос
+        with self._lock:
+            if not self._executor:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=get_mp_context()
+                )
+                atexit.register(self.stop)
+
+            return self._executor
+
+    def stop(self):
+        atexit.unregister(self.stop)
+
+        with self._lock:
+            executor = self._executor
+            self._executor = None
+
+        if executor:
+            executor.shutdown()
+
+    def get_version(self, rows: list[list[CoverRecord]], start: int) -> str:
+        data = f"{start}:{self.covers_per_row}:{self.cell_size}:{self.quality}:" + ";".join(
+            ",".join(str(cover.id) for cover in row) for row in rows
+        )
+        return hashlib.sha1(data.encode()).hexdigest()[:16]
+
+    def get_file_name(
+        self,
+        entity: str,
+        page: int,
+        rows: list[list[CoverRecord]],
+        start: int,
+    ) -> Path:
+        return self.dir_cache / f"{entity}_p{page}_{self.get_version(rows, start)}.jpg"
+
+    def get(
+        self,
+        entity: str,
+        page: int,
+        rows: list[list[CoverRecord]],
+        start: int = 1,
+    ) -> Path:
+        """
+        Путь к коллажу, где rows - обложки по строкам, а start - номер первой строки.
+        entity - имя списка вместе с фильтрами, например "authors_gs1_g"
+        """
+
+        target = self.get_file_name(entity, page, rows, start)
+        if target.exists():
+            return target
+
+        def _render() -> Path:
+            if target.exists():
+                return target
+
+            self.render(rows, start, target)
+
+            # Коллажи прошлых версий этой страницы больше не нужны, как и их file_id
+            for file_name in self.dir_cache.glob(f"{entity}_p{page}_*.jpg"):
+                if file_name != target:
+                    file_name.unlink(missing_ok=True)
+                    asset_registry.forget(file_name)
+
+            return target
+
+        return self._single_flight.do(target, _render)
+
+    def get_thumbnails(self, rows: list[list[CoverRecord]]) -> dict[int, Path]:
+        covers = [cover for row in rows for cover in row[:self.covers_per_row]]
+
+        self.thumbnails.make_all(
+            [cover.abs_file_name for cover in covers],
+            executor=self._get_executor(),
+        )
+
+        thumbnails = dict()
+        for cover in covers:
+            try:
+                thumbnail = self.thumbnails.get_cached(cover.abs_file_name)
+            except OSError:
+                thumbnail = None
+
+            # Для обложки без миниатюры останется пустая клетка
+            if thumbnail:
+                thumbnails[cover.id] = thumbnail
+
+        return thumbnails
+
+    def render(self, rows: list[list[CoverRecord]], start: int, target: Path):
+        thumbnails = self.get_thumbnails(rows)
+
+        cell = self.cell_size
+        label_width = cell // 2
+        img = Image.new(
+            "RGB",
+            (label_width + cell * self.covers_per_row, cell * len(rows)),
+            BACKGROUND_COLOR,
+        )
+        draw = ImageDraw.Draw(img)
+        try:
+            font = ImageFont.load_default(size=cell // 5)
+        except (TypeError, ImportError):
+            # Pillow без FreeType
+            font = ImageFont.load_default()
+
+        for i, row in enumerate(rows):
+            y = i * cell
+            draw.text(
+                (label_width // 2, y + cell // 2),
+                str(start + i),
+                fill=TEXT_COLOR,
+                font=font,
+                anchor="mm",
+            )
+
+            for j, cover in enumerate(row[:self.covers_per_row]):
+                thumbnail = thumbnails.get(cover.id)
+                if not thumbnail:
+                    continue
+
+                x = label_width + j * cell
+                with Image.open(thumbnail) as thumb:
+                    # Миниатюра по центру клетки
+                    img.paste(
+                        thumb,
+                        (x + (cell - thumb.width) // 2, y + (cell - thumb.height) // 2),
+                    )
+
+        self.dir_cache.mkdir(parents=True, exist_ok=True)
+
+        tmp = target.with_name(f"{target.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        img.save(tmp, "JPEG", quality=self.quality, optimize=True)
+        os.replace(tmp, target)
+
+
+collage_renderer = CollageRenderer(log=log)
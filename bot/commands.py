@@ -5,9 +5,8 @@ __author__ = "ipetrash"
 
 
 import html
+import math
 import re
-import time
-from typing import Iterator
 
 from telegram import (
     Update,
@@ -28,9 +27,6 @@ from telegram.ext import (
     CallbackQueryHandler,
 )
 
-# pip install python-telegram-bot-pagination
-from telegram_bot_pagination import InlineKeyboardPaginator
-
 from bot.common import (
     process_error,
     log,
@@ -38,18 +34,37 @@ from bot.common import (
     FILTER_BY_ADMIN,
     SeverityEnum,
     get_deep_linking,
-    is_equal_inline_keyboards,
+    get_keyboard_fingerprint,
+    get_paginator_markup,
     reply_text_or_edit_with_keyboard_paginator,
-    add_prev_next_buttons,
+    split_into_pages,
 )
 from bot.decorators import log_func, process_request
-from bot.db import Field, Cover, Author, GameSeries, Game, TgChat, ITEMS_PER_PAGE
+from bot.activity import activity_tracker
+from bot.assets import asset_registry
+from bot.cards import card_cache, fill_card, CHAT_ID_PLACEHOLDER, MESSAGE_ID_PLACEHOLDER
+from bot.collages import collage_renderer
+from bot.search import SearchResult, search_cache
+from bot.uploader import cover_uploader, send_cover_album, send_cover_photo
+from bot.db import Cover, Author, GameSeries, Game, ITEMS_PER_PAGE
+from bot.catalog import (
+    CoverRecord,
+    AuthorRecord,
+    GameSeriesRecord,
+    GameRecord,
+    get_catalog,
+    reload_catalog,
+)
 from bot import regexp_patterns as P
 from bot.regexp_patterns import fill_string_pattern
-from config import PLEASE_WAIT, SCREENSHOT_GIF_START_DEEP_LINKING, MAX_MESSAGE_LENGTH
+from config import (
+    SCREENSHOT_GIF_START_DEEP_LINKING,
+    MAX_MESSAGE_LENGTH,
+    MAX_CAPTION_LENGTH,
+    COVERS_PER_ALBUM,
+)
 
 
-PLEASE_WAIT_INFO = SeverityEnum.INFO.value.format(text=PLEASE_WAIT)
 TITLE_URL_SOURCE = "vk"
 
 
@@ -76,11 +91,32 @@ def get_html_url(url: str, title: str) -> str:
     return f'<a href="{url}">{title}</a>'
 
 
+def get_deep_linking_start_arg_html_url_template(
+    context: CallbackContext,
+    title: str,
+    obj: CoverRecord | AuthorRecord | GameSeriesRecord | GameRecord,
+) -> str:
+    """
+    Ссылка с метками вместо id чата и сообщения, их подставит fill_card
+    """
+
+    start_argument = fill_string_pattern(
+        P.PATTERN_START_ARGUMENT,
+        obj.model_name,          # class_name
+        obj.id,                  # object_id
+        CHAT_ID_PLACEHOLDER,     # chat_id
+        MESSAGE_ID_PLACEHOLDER,  # message_id
+    )
+
+    url = get_deep_linking(start_argument, context)
+    return get_html_url(url, title)
+
+
 def get_deep_linking_start_arg_html_url(
     update: Update,
     context: CallbackContext,
     title: str,
-    obj: Cover | Author | GameSeries | Game,
+    obj: CoverRecord | AuthorRecord | GameSeriesRecord | GameRecord,
     reply_to_message_id: int = None,
 ) -> str:
     message = update.effective_message
@@ -88,17 +124,12 @@ def get_deep_linking_start_arg_html_url(
     if reply_to_message_id is None:
         reply_to_message_id = message.message_id
 
-    start_argument = fill_string_pattern(
-        P.PATTERN_START_ARGUMENT,
-        obj.__class__.__name__,    # class_name
-        obj.id,                    # object_id
-        update.effective_chat.id,  # chat_id
-        reply_to_message_id        # message_id
+    return fill_card(
+        get_deep_linking_start_arg_html_url_template(context, title, obj),
+        chat_id=update.effective_chat.id,
+        message_id=reply_to_message_id,
     )
 
-    url = get_deep_linking(start_argument, context)
-    return get_html_url(url, title)
-
 
 def get_context_value(context: CallbackContext) -> str | None:
     value = None
@@ -116,64 +147,79 @@ def get_context_value(context: CallbackContext) -> str | None:
 
 
 def reply_cover_ids(
-    items: list[Cover],
+    items: list[CoverRecord],
     update: Update,
     context: CallbackContext,
+    query_key: str = None,
+    page: int = 1,
     sep: str = ", ",
+    title: str = "Найдено",
 ):
-    def _get_search_result(items: list[Cover]) -> str:
-        result = sep.join(
-            get_deep_linking_start_arg_html_url(
-                update=update, context=context,
-                title=f"{cover.id}",
-                obj=cover
-            )
-            for cover in items
-        )
-        return f"Найдено {len(items)}:\n{result}"
+    """
+    Ссылки на найденные обложки. Если они не помещаются в одно сообщение, то делятся
+    на страницы, а остальные страницы открываются кнопками пагинатора по query_key
+    """
 
-    def _get_result(items: list[Cover], post_fix="...") -> str:
-        text = _get_search_result(items)
-        if len(text) <= MAX_MESSAGE_LENGTH:
-            return text
-
-        # Результат может быть слишком большим, а нужно вместить сообщение в MAX_MESSAGE_LENGTH
-        # Поэтому, если при составлении текста результата длина вышла больше нужно уменьшить
-        prev = 0
-        while True:
-            i = text.find(sep, prev + 1)
-            if i == -1:
-                break
+    message = update.effective_message
 
-            # Если на этой итерации кусочек текста превысил максимум, значит нужно остановиться,
-            # а предыдущий кусочек текста сохранить -- его размер как раз подходит
-            if len(text[:i]) + len(post_fix) > MAX_MESSAGE_LENGTH:
-                text = text[:prev] + post_fix
-                break
+    query = update.callback_query
+    if query:
+        query.answer()
 
-            prev = i
+    if not items:
+        reply_message(
+            "Не найдено!",
+            update, context,
+            severity=SeverityEnum.INFO
+        )
+        return
 
-        return text
+    links = (
+        get_deep_linking_start_arg_html_url(
+            update=update, context=context,
+            title=f"{cover.id}",
+            obj=cover
+        )
+        for cover in items
+    )
+    pages = split_into_pages(
+        links,
+        max_length=MAX_MESSAGE_LENGTH,
+        sep=sep,
+        header=SeverityEnum.INFO.value.format(text=f"{title} {len(items)}:\n"),
+    )
+    page = min(max(page, 1), len(pages))
 
-    text = _get_result(items) if items else "Не найдено!"
+    if len(pages) == 1 or not query_key:
+        reply_message(
+            pages[page - 1],
+            update, context,
+            parse_mode=ParseMode.HTML,
+        )
+        return
 
-    reply_message(
-        text,
-        update, context,
+    reply_text_or_edit_with_keyboard_paginator(
+        message, query,
+        text=pages[page - 1],
+        page_count=len(pages),
+        items_per_page=1,
+        current_page=page,
+        paginator_pattern=fill_string_pattern(P.PATTERN_FIND_PAGE, "{page}", query_key),
         parse_mode=ParseMode.HTML,
-        severity=SeverityEnum.INFO
+        quote=True,
     )
 
 
 def reply_help(update: Update, context: CallbackContext):
+    catalog = get_catalog()
     text = (
         '<a href="https://github.com/gil9red/telegram__farguscovers_bot">Бот для отображения обложек</a> '
         "с стены группы ВК https://vk.com/farguscovers\n\n"
-        f"Всего {Cover.count()} обложек за период "
-        f"{Cover.get_first().date_time.year}-{Cover.get_last().date_time.year}.\n\n"
+        f"Всего {len(catalog.covers)} обложек за период "
+        f"{catalog.get_first_cover().date_time.year}-{catalog.get_last_cover().date_time.year}.\n\n"
         f"Для взаимодействия с ботом можно использовать клавиатуру и меню команд, что будут ниже.\n"
         f"Чтобы сразу посмотреть обложки кликни на /{P.COMMAND_COVERS_ALL}). Чтобы открыть обложку по номеру, "
-        f"просто введите номер.\n\n"
+        f"просто введите номер. Обложки по {COVERS_PER_ALBUM} штук альбомом: /{P.COMMAND_COVERS_ALBUM}.\n\n"
         "В боте ссылки используются для перехода к сущностям. "
         f"После клика на ссылку ниже появится кнопка запуска на которую "
         f"нужно кликнуть (инструкция /{P.COMMAND_GIF_START_DEEP_LINKING})."
@@ -194,8 +240,7 @@ def on_start(update: Update, context: CallbackContext):
     if context.args:
         # Если открытие по deep linking является первым запросом, то
         # предварительно отправим описание бота
-        chat = TgChat.get_from(update.effective_chat)
-        if chat.is_first_request():
+        if activity_tracker.is_first_request(update.effective_chat):
             reply_help(update, context)
 
         reply_from_start_argument(update, context)
@@ -220,7 +265,9 @@ def reply_from_start_argument(
     message_id = get_int_from_match(m, "message_id")
 
     # Если разные чаты, то нельзя создавать связь нового сообщения к переданному в message_id,
-    # иначе будет ошибка (замечено, если делать для разных чатов)
+    # иначе будет ошибка (замечено, если делать для разных чатов).
+    # Тогда карточка и ее ссылки привязываются к сообщению с /start, а оно после удаляется,
+    # поэтому карточки отправляются с allow_sending_without_reply
     if chat_id != update.effective_chat.id:
         message_id = None
 
@@ -258,15 +305,21 @@ def reply_author_card(
     author_id: int,
     reply_to_message_id: int = None,
 ):
-    author = Author.get_by_id(author_id)
+    catalog = get_catalog()
+    author = catalog.get_author(author_id)
+
+    def _render() -> str:
+        url_source = get_html_url(author.url, TITLE_URL_SOURCE)
+        return (
+            f'<b>Автор "{html.escape(author.name)}"</b> [{url_source}]\n'
+            "\n"
+            f"Обложки: {author.number_of_covers}\n"
+            f"Серии: {author.number_of_game_series}\n"
+            f"Игры: {author.number_of_games}"
+        )
 
-    url_source = get_html_url(author.url, TITLE_URL_SOURCE)
-    text = (
-        f'<b>Автор "{html.escape(author.name)}"</b> [{url_source}]\n'
-        "\n"
-        f"Обложки: {author.get_number_of_covers()}\n"
-        f"Серии: {author.get_number_of_game_series()}\n"
-        f"Игры: {author.get_number_of_games()}"
+    text = card_cache.get_template(
+        (AuthorRecord.model_name, author_id, catalog.version), _render
     )
 
     markup = InlineKeyboardMarkup.from_row([
@@ -274,6 +327,10 @@ def reply_author_card(
             text="Обложки",
             callback_data=fill_string_pattern(P.PATTERN_COVER_NEW_PAGE, 1, author_id, None, None)
         ),
+        InlineKeyboardButton(
+            text="Альбом",
+            callback_data=fill_string_pattern(P.PATTERN_COVER_ALBUM_NEW_PAGE, 1, author_id, None, None)
+        ),
         InlineKeyboardButton(
             text="Серии",
             callback_data=fill_string_pattern(P.PATTERN_GAME_SERIES_NEW_PAGE, 1, author_id)
@@ -290,6 +347,8 @@ def reply_author_card(
         reply_markup=markup,
         parse_mode=ParseMode.HTML,
         reply_to_message_id=reply_to_message_id,
+        # Сообщение из ссылки могло быть удалено, как и сообщение с /start
+        allow_sending_without_reply=True,
     )
 
 
@@ -299,14 +358,20 @@ def reply_game_series_card(
     game_series_id: int,
     reply_to_message_id: int = None,
 ):
-    game_series = GameSeries.get_by_id(game_series_id)
+    catalog = get_catalog()
+    game_series = catalog.get_game_series(game_series_id)
+
+    def _render() -> str:
+        return (
+            f'<b>Серия "{html.escape(game_series.name)}"</b>\n'
+            "\n"
+            f"Обложки: {game_series.number_of_covers}\n"
+            f"Авторы: {game_series.number_of_authors}\n"
+            f"Игр: {game_series.number_of_games}"
+        )
 
-    text = (
-        f'<b>Серия "{html.escape(game_series.name)}"</b>\n'
-        "\n"
-        f"Обложки: {game_series.get_number_of_covers()}\n"
-        f"Авторы: {game_series.get_number_of_authors()}\n"
-        f"Игр: {game_series.get_number_of_games()}"
+    text = card_cache.get_template(
+        (GameSeriesRecord.model_name, game_series_id, catalog.version), _render
     )
 
     markup = InlineKeyboardMarkup.from_row([
@@ -314,6 +379,10 @@ def reply_game_series_card(
             text="Обложки",
             callback_data=fill_string_pattern(P.PATTERN_COVER_NEW_PAGE, 1, None, game_series_id, None)
         ),
+        InlineKeyboardButton(
+            text="Альбом",
+            callback_data=fill_string_pattern(P.PATTERN_COVER_ALBUM_NEW_PAGE, 1, None, game_series_id, None)
+        ),
         InlineKeyboardButton(
             text="Авторы",
             callback_data=fill_string_pattern(P.PATTERN_AUTHORS_NEW_PAGE, 1, game_series_id, None)
@@ -330,6 +399,8 @@ def reply_game_series_card(
         reply_markup=markup,
         parse_mode=ParseMode.HTML,
         reply_to_message_id=reply_to_message_id,
+        # Сообщение из ссылки могло быть удалено, как и сообщение с /start
+        allow_sending_without_reply=True,
     )
 
 
@@ -340,27 +411,33 @@ def reply_game_card(
     reply_to_message_id: int = None,
 ):
     message = update.effective_message
-    game = Game.get_by_id(game_id)
+    catalog = get_catalog()
+    game = catalog.get_game(game_id)
 
-    message = message.reply_text(
-        text=PLEASE_WAIT_INFO,
-        reply_to_message_id=reply_to_message_id,
-        quote=True,
-    )
+    # Ссылки ссылаются на исходное сообщение, а не на карточку, чтобы
+    # не отправлять заглушку ради id карточки и после ее не редактировать
+    if reply_to_message_id is None:
+        reply_to_message_id = message.message_id
 
-    game_series_html_url = get_deep_linking_start_arg_html_url(
-        update, context,
-        title=html.escape(game.series_name),
-        obj=game.series,
-        reply_to_message_id=message.message_id,
-    )
+    def _render() -> str:
+        game_series_html_url = get_deep_linking_start_arg_html_url_template(
+            context,
+            title=html.escape(game.series_name),
+            obj=game.series,
+        )
+        return (
+            f'<b>Игра "{html.escape(game.name)}"</b>\n'
+            "\n"
+            f"Обложки: {game.number_of_covers}\n"
+            f"Авторы: {game.number_of_authors}\n"
+            f"Серия: {game_series_html_url}"
+        )
 
-    text = (
-        f'<b>Игра "{html.escape(game.name)}"</b>\n'
-        "\n"
-        f"Обложки: {game.get_number_of_covers()}\n"
-        f"Авторы: {game.get_number_of_authors()}\n"
-        f"Серия: {game_series_html_url}"
+    text = card_cache.get(
+        (GameRecord.model_name, game_id, catalog.version),
+        _render,
+        chat_id=update.effective_chat.id,
+        message_id=reply_to_message_id,
     )
 
     markup = InlineKeyboardMarkup.from_row([
@@ -368,6 +445,10 @@ def reply_game_card(
             text="Обложки",
             callback_data=fill_string_pattern(P.PATTERN_COVER_NEW_PAGE, 1, None, None, game_id)
         ),
+        InlineKeyboardButton(
+            text="Альбом",
+            callback_data=fill_string_pattern(P.PATTERN_COVER_ALBUM_NEW_PAGE, 1, None, None, game_id)
+        ),
         InlineKeyboardButton(
             text="Авторы",
             callback_data=fill_string_pattern(P.PATTERN_AUTHORS_NEW_PAGE, 1, None, game_id)
@@ -377,53 +458,51 @@ def reply_game_card(
             callback_data=fill_string_pattern(P.PATTERN_GAME_SERIES_NEW_CARD, game.series.id)
         ),
     ])
-    message.edit_text(
+    message.reply_text(
         text=text,
         reply_markup=markup,
         parse_mode=ParseMode.HTML,
+        reply_to_message_id=reply_to_message_id,
+        allow_sending_without_reply=True,
+        quote=True,
     )
 
 
-def get_cover_text(
-    update: Update,
+def get_cover_text_template(
     context: CallbackContext,
-    cover: Cover,
-    reply_to_message_id: int,
+    cover: CoverRecord,
     by_author: int = None,
     by_game_series: int = None,
     by_game: int = None,
 ) -> str:
-    url_cover = get_deep_linking_start_arg_html_url(
-        update, context,
+    url_cover = get_deep_linking_start_arg_html_url_template(
+        context,
         title=html.escape(cover.text),
         obj=cover,
-        reply_to_message_id=reply_to_message_id,
     )
 
     url_source = get_html_url(cover.url_post_image, TITLE_URL_SOURCE)
 
-    game_html_url = get_deep_linking_start_arg_html_url(
-        update, context,
+    game_html_url = get_deep_linking_start_arg_html_url_template(
+        context,
         title=html.escape(cover.game.name),
         obj=cover.game,
-        reply_to_message_id=reply_to_message_id,
     )
 
-    game_series_html_url = get_deep_linking_start_arg_html_url(
-        update, context,
+    game_series_html_url = get_deep_linking_start_arg_html_url_template(
+        context,
         title=html.escape(cover.game.series_name),
         obj=cover.game.series,
-        reply_to_message_id=reply_to_message_id,
     )
 
+    authors = cover.get_authors()
     author_html_urls = [
-        get_deep_linking_start_arg_html_url(
-            update, context,
+        get_deep_linking_start_arg_html_url_template(
+            context,
             title=html.escape(a.name),
             obj=a,
-            reply_to_message_id=reply_to_message_id,
         )
-        for a in cover.get_authors()
+        for a in authors
     ]
 
     text = (
@@ -433,25 +512,48 @@ def get_cover_text(
         f"Автор(ы): {', '.join(author_html_urls)}"
     )
     if by_author or by_game_series or by_game:
-        author = Author.get_by_id(by_author) if by_author else None
-        game_series = GameSeries.get_by_id(by_game_series) if by_game_series else None
-        game = Game.get_by_id(by_game) if by_game else None
-
+        # Обложка подходит под фильтры, поэтому объекты фильтров уже есть у нее
         names = []
-        if author:
-            names.append(html.escape(author.name))
+        if by_author:
+            names += [html.escape(a.name) for a in authors if a.id == by_author]
 
-        if game_series:
-            names.append(html.escape(game_series.name))
+        if by_game_series:
+            names.append(html.escape(cover.game.series_name))
 
-        if game:
-            names.append(html.escape(game.name))
+        if by_game:
+            names.append(html.escape(cover.game.name))
 
         text += f'\n\nФильтрация по: {", ".join(names)}'
 
     return text
 
 
+def get_cover_text(
+    update: Update,
+    context: CallbackContext,
+    cover: CoverRecord,
+    reply_to_message_id: int,
+    by_author: int = None,
+    by_game_series: int = None,
+    by_game: int = None,
+) -> str:
+    return card_cache.get(
+        (
+            CoverRecord.model_name, cover.id,
+            by_author, by_game_series, by_game,
+            get_catalog().version,
+        ),
+        lambda: get_cover_text_template(
+            context, cover,
+            by_author=by_author,
+            by_game_series=by_game_series,
+            by_game=by_game,
+        ),
+        chat_id=update.effective_chat.id,
+        message_id=reply_to_message_id,
+    )
+
+
 def reply_cover_page_card(
     update: Update,
     context: CallbackContext,
@@ -476,19 +578,27 @@ def reply_cover_page_card(
         by_game_series_id = get_int_from_match(context.match, "game_series_id", default=by_game_series_id)
         by_game_id = get_int_from_match(context.match, "game_id", default=by_game_id)
 
+    # Для кнопок ⬅️/➡️ известна текущая обложка, от нее и будет поиск соседней
+    near_cover_id: int | None = None
+    near_reverse: bool = False
+    if context.match and "cover_id" in context.match.groupdict():
+        near_cover_id = get_int_from_match(context.match, "cover_id")
+        near_reverse = context.match["direction"] == "<"
+
     cover_filters: dict[str, int | None] = dict(
         by_author=by_author_id,
         by_game_series=by_game_series_id,
         by_game=by_game_id,
     )
 
-    total_covers = Cover.count_by(**cover_filters)
+    catalog = get_catalog()
+    total_covers = catalog.count_by(**cover_filters)
 
-    # Если был явно передан id обложки, то найдем ее в базе, а после найдем ее номер
+    # Если был явно передан id обложки, то найдем ее в каталоге, а после найдем ее номер
     # с учетом фильтрации
     if cover_id is not None:
-        cover = Cover.get_by_id(cover_id)
-        page = Cover.get_page(
+        cover = catalog.get_cover(cover_id)
+        page = catalog.get_page(
             need_cover_id=cover.id,
             **cover_filters
         )
@@ -501,49 +611,68 @@ def reply_cover_page_card(
             )
             return
 
-        cover = Cover.get_by_page(page=page, **cover_filters)
+        cover = None
+        if near_cover_id is not None:
+            cover = catalog.get_near(
+                cover_id=near_cover_id,
+                reverse=near_reverse,
+                **cover_filters
+            )
+
+        if not cover:
+            cover = catalog.get_by_page(page=page, **cover_filters)
 
     pattern = P.PATTERN_COVER_PAGE
 
-    paginator = InlineKeyboardPaginator(
+    # Клавиатура из кэша, если по этой обложке уже переходили
+    keyboard = get_paginator_markup(
         page_count=total_covers,
         current_page=page,
         data_pattern=fill_string_pattern(
             pattern, "{page}", by_author_id, by_game_series_id, by_game_id
         ),
+        prev_data_pattern=fill_string_pattern(
+            P.PATTERN_COVER_NEAR_PAGE, "{page}", "<", cover.id,
+            by_author_id, by_game_series_id, by_game_id
+        ),
+        next_data_pattern=fill_string_pattern(
+            P.PATTERN_COVER_NEAR_PAGE, "{page}", ">", cover.id,
+            by_author_id, by_game_series_id, by_game_id
+        ),
     )
-    add_prev_next_buttons(paginator)
-
-    reply_markup = paginator.markup
+    reply_markup = keyboard.markup
 
     if not query or as_new_msg:
         if reply_to_message_id is None:
             reply_to_message_id = message.message_id
 
-        message = message.reply_photo(
-            photo=cover.server_file_id,
-            caption=PLEASE_WAIT_INFO,
-            reply_to_message_id=reply_to_message_id,
-            quote=True,
-        )
-
+        # Ссылки ссылаются на сообщение, на которое отвечает карточка, поэтому
+        # карточка отправляется сразу с текстом, без заглушки и ее редактирования
         text = get_cover_text(
             update=update, context=context,
             cover=cover,
-            reply_to_message_id=message.message_id,
+            reply_to_message_id=reply_to_message_id,
             **cover_filters,
         )
 
-        message.edit_caption(
-            caption=text,
-            parse_mode=ParseMode.HTML,
-            reply_markup=reply_markup,
+        send_cover_photo(
+            catalog,
+            cover,
+            lambda photo: message.reply_photo(
+                photo=photo,
+                caption=text,
+                parse_mode=ParseMode.HTML,
+                reply_markup=reply_markup,
+                reply_to_message_id=reply_to_message_id,
+                allow_sending_without_reply=True,
+                quote=True,
+            ),
         )
 
         return
 
     # Fix error: "telegram.error.BadRequest: Message is not modified"
-    if query and is_equal_inline_keyboards(reply_markup, query.message.reply_markup):
+    if query and keyboard.fingerprint == get_keyboard_fingerprint(query.message.reply_markup):
         return
 
     try:
@@ -557,13 +686,17 @@ def reply_cover_page_card(
             **cover_filters,
         )
 
-        message.edit_media(
-            media=InputMediaPhoto(
-                media=cover.server_file_id,
-                caption=text,
-                parse_mode=ParseMode.HTML,
+        send_cover_photo(
+            catalog,
+            cover,
+            lambda photo: message.edit_media(
+                media=InputMediaPhoto(
+                    media=photo,
+                    caption=text,
+                    parse_mode=ParseMode.HTML,
+                ),
+                reply_markup=reply_markup,
             ),
-            reply_markup=reply_markup,
         )
     except BadRequest as e:
         if "Message is not modified" in str(e):
@@ -572,6 +705,121 @@ def reply_cover_page_card(
         raise e
 
 
+def reply_cover_album_page(
+    update: Update,
+    context: CallbackContext,
+    as_new_msg: bool = False,
+    page: int = 1,
+    by_author_id: int = None,
+    by_game_series_id: int = None,
+    by_game_id: int = None,
+):
+    """
+    Страница из COVERS_PER_ALBUM обложек одним альбомом (sendMediaGroup) и сообщение
+    с кнопками страниц под ним. У альбома не может быть кнопок, поэтому для следующей
+    страницы отправляется новый альбом, а с прошлого сообщения кнопки убираются
+    """
+
+    message = update.effective_message
+
+    query = update.callback_query
+    if query:
+        query.answer()
+
+    if context.match and context.match.groups():
+        page = get_int_from_match(context.match, "page", default=page)
+        by_author_id = get_int_from_match(context.match, "author_id", default=by_author_id)
+        by_game_series_id = get_int_from_match(context.match, "game_series_id", default=by_game_series_id)
+        by_game_id = get_int_from_match(context.match, "game_id", default=by_game_id)
+
+    cover_filters: dict[str, int | None] = dict(
+        by_author=by_author_id,
+        by_game_series=by_game_series_id,
+        by_game=by_game_id,
+    )
+
+    catalog = get_catalog()
+
+    # Порядок тот же, что и у карточек обложек
+    covers = catalog.get_covers(**cover_filters)
+    if not covers:
+        reply_message(
+            "Нет обложек!",
+            update=update, context=context,
+            severity=SeverityEnum.INFO
+        )
+        return
+
+    page_count = math.ceil(len(covers) / COVERS_PER_ALBUM)
+    if page not in range(1, page_count + 1):
+        reply_message(
+            f"Неправильный номер альбома! Разрешенный диапазон от 1 до {page_count}",
+            update=update, context=context,
+            severity=SeverityEnum.ERROR
+        )
+        return
+
+    items = catalog.paginating(covers, page, COVERS_PER_ALBUM)
+    start = (page - 1) * COVERS_PER_ALBUM
+
+    # Ссылки ведут к карточке обложки с ее номером среди отфильтрованных
+    captions = [
+        f"{number}. "
+        + get_deep_linking_start_arg_html_url(
+            update, context,
+            title=html.escape(cover.text),
+            obj=cover,
+        )
+        for number, cover in enumerate(items, start=start + 1)
+    ]
+
+    send_cover_album(
+        catalog,
+        items,
+        lambda media: message.reply_media_group(
+            media=[
+                InputMediaPhoto(
+                    media=photo,
+                    caption=caption,
+                    parse_mode=ParseMode.HTML,
+                )
+                for photo, caption in zip(media, captions)
+            ],
+            quote=not query,
+        ),
+    )
+
+    text = f"<b>Обложки {start + 1}-{start + len(items)} из {len(covers)}</b>"
+    names = []
+    if by_author_id is not None:
+        names.append(html.escape(catalog.get_author(by_author_id).name))
+    if by_game_series_id is not None:
+        names.append(html.escape(catalog.get_game_series(by_game_series_id).name))
+    if by_game_id is not None:
+        names.append(html.escape(catalog.get_game(by_game_id).name))
+    if names:
+        text += f'\nФильтрация по: {", ".join(names)}'
+
+    keyboard = get_paginator_markup(
+        page_count=page_count,
+        current_page=page,
+        data_pattern=fill_string_pattern(
+            P.PATTERN_COVER_ALBUM_PAGE, "{page}", by_author_id, by_game_series_id, by_game_id
+        ),
+    )
+
+    message.reply_text(
+        text,
+        reply_markup=keyboard.markup,
+        parse_mode=ParseMode.HTML,
+        quote=False,
+    )
+
+    # Кнопки остаются только под последним альбомом
+    if query and not as_new_msg:
+        message.edit_reply_markup(reply_markup=None)
+
+
 @log_func(log)
 @process_request(log)
 def on_show_reply(update: Update, context: CallbackContext):
@@ -599,18 +847,24 @@ def on_hide_reply(update: Update, context: CallbackContext):
 def on_gif_start_deep_linking(update: Update, context: CallbackContext):
     message = update.effective_message
 
-    message.reply_document(
-        document=open(SCREENSHOT_GIF_START_DEEP_LINKING, "rb"),
-        reply_markup=InlineKeyboardMarkup.from_column([
-            InlineKeyboardButton(
-                text="Убрать",
-                callback_data=fill_string_pattern(P.PATTERN_DELETE_MESSAGE)
-            ),
-            InlineKeyboardButton(
-                text="Посмотреть остальные GIF",
-                url="https://github.com/gil9red/telegram__farguscovers_bot#скриншоты"
-            )
-        ])
+    reply_markup = InlineKeyboardMarkup.from_column([
+        InlineKeyboardButton(
+            text="Убрать",
+            callback_data=fill_string_pattern(P.PATTERN_DELETE_MESSAGE)
+        ),
+        InlineKeyboardButton(
+            text="Посмотреть остальные GIF",
+            url="https://github.com/gil9red/telegram__farguscovers_bot#скриншоты"
+        )
+    ])
+
+    # GIF загружается один раз, после отправляется по file_id
+    asset_registry.send(
+        SCREENSHOT_GIF_START_DEEP_LINKING,
+        lambda document: message.reply_document(
+            document=document,
+            reply_markup=reply_markup,
+        ),
     )
 
     # Удаление сообщения, вызвавшего команду
@@ -629,6 +883,18 @@ def on_cover_card_as_new_msg(update: Update, context: CallbackContext):
     reply_cover_page_card(update, context, as_new_msg=True)
 
 
+@log_func(log)
+@process_request(log)
+def on_cover_album(update: Update, context: CallbackContext):
+    reply_cover_album_page(update, context)
+
+
+@log_func(log)
+@process_request(log)
+def on_cover_album_as_new_msg(update: Update, context: CallbackContext):
+    reply_cover_album_page(update, context, as_new_msg=True)
+
+
 @log_func(log)
 @process_request(log)
 def on_cover_by_page(update: Update, context: CallbackContext):
@@ -639,9 +905,9 @@ def reply_page_objects(
     update: Update,
     context: CallbackContext,
     model_title: str,
-    model: Author | GameSeries | Game,
+    objects: list[AuthorRecord | GameSeriesRecord | GameRecord],
     paginator_pattern: str,
-    filters: Iterator[Field] = None,
+    collage_pattern: str = None,
     as_new_msg=False,
 ):
     message = update.effective_message
@@ -650,43 +916,50 @@ def reply_page_objects(
     if query:
         query.answer()
 
-    # Если это не callback-запрос или есть нужно новое сообщение
-    force_edit: bool = False
-    if not query or as_new_msg:
-        message = message.reply_text(
-            text=PLEASE_WAIT_INFO,
-            quote=True,
-        )
-        # После такого можно будет только редактировать сообщение
-        force_edit = True
-
     page = get_int_from_match(context.match, "page", default=1)
 
+    catalog = get_catalog()
+
     items_per_page = ITEMS_PER_PAGE
     start = ((page - 1) * items_per_page) + 1
-    objects = model.paginating(
+    total = len(objects)
+    objects = catalog.paginating(
+        objects,
         page=page,
         items_per_page=items_per_page,
-        filters=filters,
-        order_by=model.name.asc(),
     )
 
-    # TODO: Проверить, что не будет переполнения с ITEMS_PER_PAGE
-    lines = []
-    for i, obj in enumerate(objects, start):
-        html_url = get_deep_linking_start_arg_html_url(
-            update, context,
-            title=html.escape(obj.name),
-            obj=obj,
-            reply_to_message_id=message.message_id,
-        )
-        total_covers = obj.get_number_of_covers()
-        title = f"{i}. <b>{html_url}</b> ({total_covers})"
-        lines.append(title)
-
-    total = model.count(filters)
+    def _render() -> str:
+        # TODO: Проверить, что не будет переполнения с ITEMS_PER_PAGE
+        lines = []
+        for i, obj in enumerate(objects, start):
+            html_url = get_deep_linking_start_arg_html_url_template(
+                context,
+                title=html.escape(obj.name),
+                obj=obj,
+            )
+            title = f"{i}. <b>{html_url}</b> ({obj.number_of_covers})"
+            lines.append(title)
+
+        return f"{model_title} ({total}):\n" + "\n".join(lines)
+
+    # Для нового списка ссылки ссылаются на исходное сообщение, а не на сам список.
+    # Фильтры списка уже есть в paginator_pattern
+    text = card_cache.get(
+        (model_title, paginator_pattern, page, catalog.version),
+        _render,
+        chat_id=update.effective_chat.id,
+        message_id=message.message_id,
+    )
 
-    text = f"{model_title} ({total}):\n" + "\n".join(lines)
+    before_inline_buttons = None
+    if collage_pattern and objects:
+        before_inline_buttons = [
+            InlineKeyboardButton(
+                text="🖼 Обложки",
+                callback_data=collage_pattern.format(page=page),
+            )
+        ]
 
     reply_text_or_edit_with_keyboard_paginator(
         message, query,
@@ -695,33 +968,105 @@ def reply_page_objects(
         items_per_page=items_per_page,
         current_page=page,
         paginator_pattern=paginator_pattern,
+        before_inline_buttons=before_inline_buttons,
         parse_mode=ParseMode.HTML,
         as_new_msg=as_new_msg,
-        force_edit=force_edit,
         quote=True,
     )
 
 
+def reply_page_collage(
+    update: Update,
+    context: CallbackContext,
+    model_title: str,
+    objects: list[AuthorRecord | GameSeriesRecord | GameRecord],
+    entity: str,
+    cover_filter_name: str,
+    cover_filters: dict[str, int | None],
+):
+    """
+    Коллаж из первых обложек каждого объекта на странице списка.
+    В cover_filter_name имя фильтра обложек по объекту, например "by_author",
+    а cover_filters - фильтры самого списка, они применяются и к обложкам
+    """
+
+    message = update.effective_message
+
+    query = update.callback_query
+    if query:
+        query.answer()
+
+    page = get_int_from_match(context.match, "page", default=1)
+
+    catalog = get_catalog()
+
+    items_per_page = ITEMS_PER_PAGE
+    start = ((page - 1) * items_per_page) + 1
+    total = len(objects)
+    objects = catalog.paginating(
+        objects,
+        page=page,
+        items_per_page=items_per_page,
+    )
+    if not objects:
+        return
+
+    rows = []
+    for obj in objects:
+        covers = catalog.get_covers(**cover_filters, **{cover_filter_name: obj.id})
+        rows.append(covers[:collage_renderer.covers_per_row])
+    file_name = collage_renderer.get(entity, page, rows, start)
+
+    caption = f"{model_title} {start}-{start + len(objects) - 1} из {total}:\n" + "\n".join(
+        f"{i}. {obj.name} ({obj.number_of_covers})"
+        for i, obj in enumerate(objects, start)
+    )
+
+    # После первой загрузки коллаж отправляется по file_id
+    asset_registry.send(
+        file_name,
+        lambda photo: message.reply_photo(
+            photo=photo,
+            caption=caption[:MAX_CAPTION_LENGTH],
+            quote=False,
+        ),
+    )
+
+
 def reply_author_page_list(
     update: Update,
     context: CallbackContext,
     as_new_msg=False,
+    as_collage=False,
 ):
     game_series_id = get_int_from_match(context.match, "game_series_id")
     game_id = get_int_from_match(context.match, "game_id")
 
-    model = Author
+    objects = get_catalog().get_authors(
+        by_game_series=game_series_id,
+        by_game=game_id,
+    )
+
+    if as_collage:
+        reply_page_collage(
+            update=update, context=context,
+            model_title="Авторы",
+            objects=objects,
+            entity=f"authors_gs{game_series_id or ''}_g{game_id or ''}",
+            cover_filter_name="by_author",
+            cover_filters=dict(by_game_series=game_series_id, by_game=game_id),
+        )
+        return
 
     reply_page_objects(
         update=update, context=context,
         model_title="Авторы",
-        model=model,
+        objects=objects,
         paginator_pattern=fill_string_pattern(
             P.PATTERN_AUTHORS_PAGE, "{page}", game_series_id, game_id
         ),
-        filters=model.get_filters(
-            by_game_series=game_series_id,
-            by_game=game_id,
+        collage_pattern=fill_string_pattern(
+            P.PATTERN_AUTHORS_COLLAGE, "{page}", game_series_id, game_id
         ),
         as_new_msg=as_new_msg,
     )
@@ -739,24 +1084,44 @@ def on_author_list_as_new_msg(update: Update, context: CallbackContext):
     reply_author_page_list(update, context, as_new_msg=True)
 
 
+@log_func(log)
+@process_request(log)
+def on_author_list_collage(update: Update, context: CallbackContext):
+    reply_author_page_list(update, context, as_collage=True)
+
+
 def reply_game_series_page_list(
     update: Update,
     context: CallbackContext,
     as_new_msg=False,
+    as_collage=False,
 ):
     author_id = get_int_from_match(context.match, "author_id")
 
-    model = GameSeries
+    objects = get_catalog().get_all_game_series(
+        by_author=author_id,
+    )
+
+    if as_collage:
+        reply_page_collage(
+            update=update, context=context,
+            model_title="Серии игр",
+            objects=objects,
+            entity=f"game_series_a{author_id or ''}",
+            cover_filter_name="by_game_series",
+            cover_filters=dict(by_author=author_id),
+        )
+        return
 
     reply_page_objects(
         update=update, context=context,
         model_title="Серии игр",
-        model=model,
+        objects=objects,
         paginator_pattern=fill_string_pattern(
             P.PATTERN_GAME_SERIES_PAGE, "{page}", author_id,
         ),
-        filters=model.get_filters(
-            by_author=author_id,
+        collage_pattern=fill_string_pattern(
+            P.PATTERN_GAME_SERIES_COLLAGE, "{page}", author_id,
         ),
         as_new_msg=as_new_msg,
     )
@@ -774,6 +1139,12 @@ def on_game_series_list_as_new_msg(update: Update, context: CallbackContext):
     reply_game_series_page_list(update, context, as_new_msg=True)
 
 
+@log_func(log)
+@process_request(log)
+def on_game_series_list_collage(update: Update, context: CallbackContext):
+    reply_game_series_page_list(update, context, as_collage=True)
+
+
 @log_func(log)
 @process_request(log)
 def on_game_series_card(update: Update, context: CallbackContext):
@@ -789,22 +1160,36 @@ def reply_game_page_list(
     update: Update,
     context: CallbackContext,
     as_new_msg=False,
+    as_collage=False,
 ):
     author_id = get_int_from_match(context.match, "author_id")
     game_series_id = get_int_from_match(context.match, "game_series_id")
 
-    model = Game
+    objects = get_catalog().get_games(
+        by_author=author_id,
+        by_game_series=game_series_id,
+    )
+
+    if as_collage:
+        reply_page_collage(
+            update=update, context=context,
+            model_title="Игры",
+            objects=objects,
+            entity=f"games_a{author_id or ''}_gs{game_series_id or ''}",
+            cover_filter_name="by_game",
+            cover_filters=dict(by_author=author_id, by_game_series=game_series_id),
+        )
+        return
 
     reply_page_objects(
         update=update, context=context,
         model_title="Игры",
-        model=model,
+        objects=objects,
         paginator_pattern=fill_string_pattern(
             P.PATTERN_GAMES_PAGE, "{page}", author_id, game_series_id
         ),
-        filters=model.get_filters(
-            by_author=author_id,
-            by_game_series=game_series_id,
+        collage_pattern=fill_string_pattern(
+            P.PATTERN_GAMES_COLLAGE, "{page}", author_id, game_series_id
         ),
         as_new_msg=as_new_msg,
     )
@@ -822,6 +1207,12 @@ def on_game_list_as_new_msg(update: Update, context: CallbackContext):
     reply_game_page_list(update, context, as_new_msg=True)
 
 
+@log_func(log)
+@process_request(log)
+def on_game_list_collage(update: Update, context: CallbackContext):
+    reply_game_page_list(update, context, as_collage=True)
+
+
 @log_func(log)
 @process_request(log)
 def on_callback_delete_message(update: Update, context: CallbackContext):
@@ -831,6 +1222,25 @@ def on_callback_delete_message(update: Update, context: CallbackContext):
     query.message.delete()
 
 
+def reply_search_result(
+    result: SearchResult,
+    update: Update,
+    context: CallbackContext,
+    query_key: str,
+    page: int = 1,
+):
+    # Поиск идет по базе, а каталог в памяти может быть загружен до ее заполнения
+    cover_by_id = get_catalog().cover_by_id
+    covers = [cover_by_id[cover_id] for cover_id in result.cover_ids if cover_id in cover_by_id]
+
+    reply_cover_ids(
+        covers, update, context,
+        query_key=query_key,
+        page=page,
+        title="Точных совпадений нет, похожие" if result.is_fuzzy else "Найдено",
+    )
+
+
 @log_func(log)
 @process_request(log)
 def on_find(update: Update, context: CallbackContext):
@@ -843,8 +1253,30 @@ def on_find(update: Update, context: CallbackContext):
         )
         return
 
-    covers = Cover.find(text)
-    reply_cover_ids(covers, update, context)
+    query_key, result = search_cache.search(text)
+    reply_search_result(result, update, context, query_key=query_key)
+
+
+@log_func(log)
+@process_request(log)
+def on_find_page(update: Update, context: CallbackContext):
+    query_key = context.match["query_key"]
+
+    result = search_cache.get_by_key(query_key)
+    if result is None:
+        update.callback_query.answer()
+        reply_message(
+            "Результаты поиска устарели, повторите поиск",
+            update, context,
+            severity=SeverityEnum.INFO
+        )
+        return
+
+    reply_search_result(
+        result, update, context,
+        query_key=query_key,
+        page=get_int_from_match(context.match, "page", default=1),
+    )
 
 
 @log_func(log)
@@ -859,48 +1291,48 @@ def on_request(update: Update, context: CallbackContext):
 
 @log_func(log)
 @process_request(log)
-def on_fill_server_file_id(update: Update, _: CallbackContext):
-    message = update.effective_message
-
-    covers = Cover.select().where(Cover.server_file_id.is_null())
-    total_covers = covers.count()
-
-    title_progress = SeverityEnum.INFO.value.format(text="Загрузка обложек.")
-
-    if not total_covers:
-        message.reply_text(
-            f"{title_progress}\nВсе обложки уже загружены!",
-            quote=True,
+def on_fill_server_file_id(update: Update, context: CallbackContext):
+    # Загрузка идет задачей в фоне, прогресс она сама покажет в этом чате
+    if not cover_uploader.start(context.job_queue, update.effective_chat.id):
+        reply_message(
+            "Загрузка обложек уже идет",
+            update, context,
+            severity=SeverityEnum.INFO,
         )
-        return
-
-    message_progress = message.reply_text(
-        title_progress,
-        quote=True,
-    )
 
-    t = time.perf_counter()
 
-    # Перебор всех обложек без server_file_id
-    for i, cover in enumerate(covers, 1):
-        message_photo = message.reply_photo(
-            photo=open(cover.abs_file_name, "rb")
-        )
-        photo_large = max(message_photo.photo, key=lambda x: (x.width, x.height))
-        message_photo.delete()
+@log_func(log)
+@process_request(log)
+def on_reload_catalog(update: Update, context: CallbackContext):
+    catalog = reload_catalog()
+    catalog.get_fuzzy_index()
 
-        cover.server_file_id = photo_large.file_id
-        cover.save()
+    reply_message(
+        catalog.get_memory_report(),
+        update, context,
+        severity=SeverityEnum.INFO,
+    )
 
-        message_progress.edit_text(f"{title_progress}\n{i} / {total_covers}")
 
-        # У ботов лимиты на отправку сообщений
-        time.sleep(0.3)
+@log_func(log)
+@process_request(log)
+def on_metrics(update: Update, context: CallbackContext):
+    lines = []
+    for title, metrics in [
+        ("Активность", activity_tracker.get_metrics()),
+        ("Загрузка обложек", cover_uploader.get_metrics()),
+        ("Кэш карточек", card_cache.get_metrics()),
+        ("Кэш клавиатур", get_paginator_markup.cache_info()._asdict()),
+        ("Кэш поиска", search_cache.get_metrics()),
+    ]:
+        lines.append(f"{title}:")
+        for name, value in metrics.items():
+            lines.append(f"    {name}: {value}")
 
-    elapsed_secs = int(time.perf_counter() - t)
-    message_progress.edit_text(
-        f"{title_progress}\n"
-        f"Загружено {total_covers} обложек за {elapsed_secs} секунд."
+    reply_message(
+        "\n".join(lines),
+        update, context,
+        severity=SeverityEnum.INFO,
     )
 
 
@@ -922,6 +1354,14 @@ def setup(dp: Dispatcher):
             P.COMMAND_FILL_SERVER_FILE_ID, on_fill_server_file_id, FILTER_BY_ADMIN
         )
     )
+    dp.add_handler(
+        CommandHandler(
+            P.COMMAND_RELOAD_CATALOG, on_reload_catalog, FILTER_BY_ADMIN
+        )
+    )
+    dp.add_handler(
+        CommandHandler(P.COMMAND_METRICS, on_metrics, FILTER_BY_ADMIN)
+    )
 
     dp.add_handler(CommandHandler(P.COMMAND_SHOW_REPLY, on_show_reply))
     dp.add_handler(CommandHandler(P.COMMAND_HIDE_REPLY, on_hide_reply))
@@ -931,6 +1371,7 @@ def setup(dp: Dispatcher):
         MessageHandler(Filters.regex(P.PATTERN_COVERS_REPLY_ALL), on_cover_card)
     )
     dp.add_handler(CallbackQueryHandler(on_cover_card, pattern=P.PATTERN_COVER_PAGE))
+    dp.add_handler(CallbackQueryHandler(on_cover_card, pattern=P.PATTERN_COVER_NEAR_PAGE))
     dp.add_handler(
         CallbackQueryHandler(on_cover_card_as_new_msg, pattern=P.PATTERN_COVER_NEW_PAGE)
     )
@@ -938,6 +1379,12 @@ def setup(dp: Dispatcher):
         MessageHandler(Filters.regex(P.PATTERN_REPLY_COVER_BY_PAGE), on_cover_by_page)
     )
 
+    dp.add_handler(CommandHandler(P.COMMAND_COVERS_ALBUM, on_cover_album))
+    dp.add_handler(CallbackQueryHandler(on_cover_album, pattern=P.PATTERN_COVER_ALBUM_PAGE))
+    dp.add_handler(
+        CallbackQueryHandler(on_cover_album_as_new_msg, pattern=P.PATTERN_COVER_ALBUM_NEW_PAGE)
+    )
+
     dp.add_handler(CommandHandler(P.COMMAND_AUTHORS_ALL, on_author_page_list))
     dp.add_handler(
         MessageHandler(Filters.regex(P.PATTERN_AUTHORS_REPLY_ALL), on_author_page_list)
@@ -950,6 +1397,9 @@ def setup(dp: Dispatcher):
             on_author_list_as_new_msg, pattern=P.PATTERN_AUTHORS_NEW_PAGE
         )
     )
+    dp.add_handler(
+        CallbackQueryHandler(on_author_list_collage, pattern=P.PATTERN_AUTHORS_COLLAGE)
+    )
 
     dp.add_handler(CommandHandler(P.COMMAND_GAME_SERIES_ALL, on_game_series_page_list))
     dp.add_handler(
@@ -967,6 +1417,11 @@ def setup(dp: Dispatcher):
             on_game_series_list_as_new_msg, pattern=P.PATTERN_GAME_SERIES_NEW_PAGE
         )
     )
+    dp.add_handler(
+        CallbackQueryHandler(
+            on_game_series_list_collage, pattern=P.PATTERN_GAME_SERIES_COLLAGE
+        )
+    )
     dp.add_handler(
         CallbackQueryHandler(
             on_game_series_card, pattern=P.PATTERN_GAME_SERIES_NEW_CARD
@@ -983,6 +1438,9 @@ def setup(dp: Dispatcher):
     dp.add_handler(
         CallbackQueryHandler(on_game_list_as_new_msg, pattern=P.PATTERN_GAMES_NEW_PAGE)
     )
+    dp.add_handler(
+        CallbackQueryHandler(on_game_list_collage, pattern=P.PATTERN_GAMES_COLLAGE)
+    )
 
     dp.add_handler(
         CallbackQueryHandler(
@@ -992,6 +1450,7 @@ def setup(dp: Dispatcher):
 
     dp.add_handler(CommandHandler(P.COMMAND_FIND, on_find))
     dp.add_handler(MessageHandler(Filters.regex(P.PATTERN_REPLY_FIND), on_find))
+    dp.add_handler(CallbackQueryHandler(on_find_page, pattern=P.PATTERN_FIND_PAGE))
 
     dp.add_handler(MessageHandler(Filters.text, on_request))
 
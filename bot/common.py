@@ -5,6 +5,8 @@ __author__ = "ipetrash"
 
 
 import enum
+import functools
+import hashlib
 import json
 
 import logging
@@ -13,6 +15,7 @@ import sys
 import re
 
 from pathlib import Path
+from typing import Iterable, NamedTuple
 
 import telegram.error
 from telegram import (
@@ -47,7 +50,11 @@ def calc_pages(page: int, start_page: int, max_page: int) -> tuple[int, int]:
     return prev_page, next_page
 
 
-def add_prev_next_buttons(paginator: InlineKeyboardPaginator):
+def add_prev_next_buttons(
+    paginator: InlineKeyboardPaginator,
+    prev_data_pattern: str = None,
+    next_data_pattern: str = None,
+):
     if paginator.page_count > 1:
         prev_page, next_page = calc_pages(
             page=paginator.current_page,
@@ -55,31 +62,112 @@ def add_prev_next_buttons(paginator: InlineKeyboardPaginator):
             max_page=paginator.page_count
         )
 
+        if not prev_data_pattern:
+            prev_data_pattern = paginator.data_pattern
+
+        if not next_data_pattern:
+            next_data_pattern = paginator.data_pattern
+
         paginator.add_after(
             InlineKeyboardButton(
                 text="⬅️",
-                callback_data=paginator.data_pattern.format(page=prev_page),
+                callback_data=prev_data_pattern.format(page=prev_page),
             ),
             InlineKeyboardButton(
                 text="➡️",
-                callback_data=paginator.data_pattern.format(page=next_page),
+                callback_data=next_data_pattern.format(page=next_page),
             ),
         )
 
 
+class KeyboardMarkup(NamedTuple):
+    """
+    Готовая разметка клавиатуры в json и ее отпечаток для сравнения с клавиатурой сообщения
+    """
+
+    markup: str
+    fingerprint: str
+
+
+def get_keyboard_fingerprint(
+    keyboard: InlineKeyboardMarkup | KeyboardMarkup | str | None,
+) -> str:
+    # Отпечаток - blake2b от текстов и данных кнопок, без остальных полей клавиатуры.
+    # Используется только для сравнения в процессе бота и нигде не хранится
+    if isinstance(keyboard, KeyboardMarkup):
+        return keyboard.fingerprint
+
+    if keyboard is None:
+        rows = []
+    elif isinstance(keyboard, InlineKeyboardMarkup):
+        rows = [
+            [(button.text, button.callback_data, button.url) for button in row]
+            for row in keyboard.inline_keyboard
+        ]
+    elif isinstance(keyboard, str):
+        rows = [
+            [(button["text"], button.get("callback_data"), button.get("url")) for button in row]
+            for row in json.loads(keyboard)["inline_keyboard"]
+        ]
+    else:
+        raise Exception(f"Unsupported format (keyboard={type(keyboard)})!")
+
+    data = json.dumps(rows, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.blake2b(data.encode("utf-8"), digest_size=16).hexdigest()
+
+
 def is_equal_inline_keyboards(
-    keyboard_1: InlineKeyboardMarkup | str,
+    keyboard_1: InlineKeyboardMarkup | KeyboardMarkup | str,
     keyboard_2: InlineKeyboardMarkup
 ) -> bool:
-    if isinstance(keyboard_1, InlineKeyboardMarkup):
-        keyboard_1_inline_keyboard = keyboard_1.to_dict()["inline_keyboard"]
-    elif isinstance(keyboard_1, str):
-        keyboard_1_inline_keyboard = json.loads(keyboard_1)["inline_keyboard"]
+    return get_keyboard_fingerprint(keyboard_1) == get_keyboard_fingerprint(keyboard_2)
+
+
+@functools.lru_cache(maxsize=config.KEYBOARD_CACHE_SIZE)
+def get_paginator_markup(
+    page_count: int,
+    current_page: int,
+    data_pattern: str,
+    prev_data_pattern: str = None,
+    next_data_pattern: str = None,
+    before_buttons: tuple[tuple[str, str], ...] = (),
+    after_buttons: tuple[tuple[str, str], ...] = (),
+) -> KeyboardMarkup:
+    """
+    Клавиатура пагинатора с кнопками ⬅️/➡️. Кнопки before_buttons и after_buttons задаются
+    парами (текст, callback_data), с after_buttons кнопок ⬅️/➡️ не будет.
+    Клавиатуры кэшируются, поэтому при повторной навигации заново не строятся
+    """
+
+    paginator = InlineKeyboardPaginator(
+        page_count=page_count,
+        current_page=current_page,
+        data_pattern=data_pattern,
+    )
+    if before_buttons:
+        paginator.add_before(
+            *[InlineKeyboardButton(text=text, callback_data=data) for text, data in before_buttons]
+        )
+
+    if after_buttons:
+        paginator.add_after(
+            *[InlineKeyboardButton(text=text, callback_data=data) for text, data in after_buttons]
+        )
     else:
-        raise Exception(f"Unsupported format (keyboard_1={type(keyboard_1)})!")
+        add_prev_next_buttons(
+            paginator,
+            prev_data_pattern=prev_data_pattern,
+            next_data_pattern=next_data_pattern,
+        )
+
+    markup = paginator.markup
+    return KeyboardMarkup(markup, get_keyboard_fingerprint(markup))
+
 
-    keyboard_2_inline_keyboard = keyboard_2.to_dict()["inline_keyboard"]
-    return keyboard_1_inline_keyboard == keyboard_2_inline_keyboard
+def get_buttons_key(
+    buttons: list[InlineKeyboardButton] | None,
+) -> tuple[tuple[str, str], ...]:
+    return tuple((button.text, button.callback_data) for button in buttons or [])
 
 
 def reply_message(
@@ -109,12 +197,16 @@ def reply_text_or_edit_with_keyboard(
     message: Message,
     query: CallbackQuery | None,
     text: str,
-    reply_markup: InlineKeyboardMarkup | str,
+    reply_markup: InlineKeyboardMarkup | KeyboardMarkup | str,
     quote: bool = False,
     as_new_msg: bool = False,
     force_edit: bool = False,
     **kwargs,
 ):
+    keyboard = reply_markup
+    if isinstance(reply_markup, KeyboardMarkup):
+        reply_markup = reply_markup.markup
+
     if (not query or as_new_msg) and not force_edit:
         message.reply_text(
             text,
@@ -129,7 +221,7 @@ def reply_text_or_edit_with_keyboard(
     if (
         query
         and text == query.message.text
-        and is_equal_inline_keyboards(reply_markup, query.message.reply_markup)
+        and is_equal_inline_keyboards(keyboard, query.message.reply_markup)
     ):
         return
 
@@ -163,20 +255,13 @@ def reply_text_or_edit_with_keyboard_paginator(
 ):
     page_count = math.ceil(page_count / items_per_page)
 
-    paginator = InlineKeyboardPaginator(
+    reply_markup = get_paginator_markup(
         page_count=page_count,
         current_page=current_page,
         data_pattern=paginator_pattern,
+        before_buttons=get_buttons_key(before_inline_buttons),
+        after_buttons=get_buttons_key(after_inline_buttons),
     )
-    if before_inline_buttons:
-        paginator.add_before(*before_inline_buttons)
-
-    if after_inline_buttons:
-        paginator.add_after(*after_inline_buttons)
-    else:
-        add_prev_next_buttons(paginator)
-
-    reply_markup = paginator.markup
 
     reply_text_or_edit_with_keyboard(
         message, query,
@@ -189,6 +274,38 @@ def reply_text_or_edit_with_keyboard_paginator(
     )
 
 
+def split_into_pages(
+    parts: Iterable[str],
+    max_length: int,
+    sep: str = ", ",
+    header: str = "",
+) -> list[str]:
+    """
+    Разбиение частей на страницы не длиннее max_length за один проход.
+    Каждая страница начинается с header, части между страницами не разрываются
+    """
+
+    pages = []
+    page_parts = []
+    length = len(header)
+
+    for part in parts:
+        size = len(part) + (len(sep) if page_parts else 0)
+        if page_parts and length + size > max_length:
+            pages.append(header + sep.join(page_parts))
+            page_parts = []
+            length = len(header)
+            size = len(part)
+
+        page_parts.append(part)
+        length += size
+
+    if page_parts or not pages:
+        pages.append(header + sep.join(page_parts))
+
+    return pages
+
+
 def get_deep_linking(argument, context: CallbackContext) -> str:
     return f"{context.bot.link}?start={argument}"
 
@@ -5,13 +5,19 @@ __author__ = "ipetrash"
 
 
 import datetime as DT
+import re
+import threading
 import time
 
+from collections import defaultdict
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Type, Optional, Iterable, Union
+from typing import TYPE_CHECKING, Type, Optional, Iterable, Iterator, Sequence, Union
 
 # pip install peewee
 from peewee import (
+    Database,
+    SqliteDatabase,
     Model,
     TextField,
     ForeignKeyField,
@@ -19,15 +25,32 @@ from peewee import (
     DateTimeField,
     IntegerField,
     Field,
+    JOIN,
+    ModelSelect,
+    NodeList,
+    SQL,
+    Value,
+    chunked,
     fn,
 )
+from playhouse.sqlite_ext import FTS5Model, SearchField
 import telegram
 
-from config import DB_FILE_NAME, DIR_DATA_VK, ITEMS_PER_PAGE
-from bot.common import get_slug
-from bot.debug import SqliteQueueDatabaseDebug
+from config import (
+    DB_FILE_NAME,
+    DB_TELEMETRY_FILE_NAME,
+    DB_CATALOG_MAX_CONNECTIONS,
+    DIR_DATA_VK,
+    ITEMS_PER_PAGE,
+)
+from bot.common import get_slug, log
+from bot.debug import SqliteQueueDatabaseDebug, PooledSqliteDatabaseDebug
+from bot.migrations import Migration, migrate
 from third_party.shorten import shorten
 
+if TYPE_CHECKING:
+    from bot.catalog import Catalog
+
 
 class NotDefinedParameterException(Exception):
     def __init__(self, parameter_name: str):
@@ -37,29 +60,71 @@ class NotDefinedParameterException(Exception):
         super().__init__(text)
 
 
+CATALOG_PRAGMAS = {
+    "foreign_keys": 1,
+    "cache_size": -1024 * 64,  # 64MB page-cache
+}
+
+# Режим WAL хранится в файле базы, поэтому включается соединением на запись.
+# На соединении только для чтения эта прагма не действует
+CATALOG_WRITE_PRAGMAS = CATALOG_PRAGMAS | {
+    "journal_mode": "wal",     # WAL-mode
+}
+
+# Каталог в боте только читается, поэтому база открывается только на чтение
+# и у каждого потока обработчиков будет свое соединение из пула.
+# NOTE: immutable=1 не используется, т.к. файл меняется при заполнении базы
+#       и при загрузке server_file_id, а с ним SQLITE не увидит эти изменения
+catalog_db = PooledSqliteDatabaseDebug(
+    f"file:{DB_FILE_NAME}?mode=ro",
+    uri=True,
+    pragmas=CATALOG_PRAGMAS,
+    max_connections=DB_CATALOG_MAX_CONNECTIONS,
+    stale_timeout=300,
+    check_same_thread=False,  # Соединения из пула переходят между потоками
+)
+
+# Соединение на запись в каталог, нужно для заполнения базы и редких изменений каталога.
+# Соединение одно на процесс, а потоки пишут через него по очереди под catalog_write_lock.
+# С импортом из другого процесса запись разделяет блокировка файла в SQLITE
+catalog_write_db = SqliteDatabase(
+    DB_FILE_NAME,
+    pragmas=CATALOG_WRITE_PRAGMAS,
+    thread_safe=False,        # Состояние соединения общее для всех потоков
+    check_same_thread=False,
+)
+catalog_write_lock = threading.RLock()
+
+# Активность пользователей и чатов постоянно пишется, поэтому хранится в отдельной базе
 # This working with multithreading
 # SOURCE: http://docs.peewee-orm.com/en/latest/peewee/playhouse.html#sqliteq
-db = SqliteQueueDatabaseDebug(
-    DB_FILE_NAME,
+telemetry_db = SqliteQueueDatabaseDebug(
+    DB_TELEMETRY_FILE_NAME,
     pragmas={
         "foreign_keys": 1,
         "journal_mode": "wal",     # WAL-mode
-        "cache_size": -1024 * 64,  # 64MB page-cache
     },
     use_gevent=False,     # Use the standard library "threading" module.
-    autostart=True,
+    autostart=True,       # Поток записи запускается сразу
     queue_max_size=64,    # Max. # of pending writes that can accumulate.
     results_timeout=5.0   # Max. time to wait for query to be executed.
 )
 
 
+# NOTE: В SQLITE функции UPPER и LOWER, как и LIKE, регистро-независимы только для ASCII
+@catalog_db.func("casefold")
+@catalog_write_db.func("casefold")
+def casefold(text: str | None) -> str | None:
+    return text.casefold() if text else text
+
+
 class BaseModel(Model):
     """
     Базовая модель классов-таблиц
     """
 
     class Meta:
-        database = db
+        database = catalog_db
 
     def get_new(self) -> Type["BaseModel"]:
         return type(self).get(self._pk_expr())
@@ -77,19 +142,61 @@ class BaseModel(Model):
         cls,
         page: int = 1,
         items_per_page: int = ITEMS_PER_PAGE,
-        order_by: Field = None,
+        order_by: Field | Iterable[Field] = None,
         filters: Iterable = None,
     ) -> list[Type["BaseModel"]]:
-        query = cls.select()
+        query = cls._paginate(
+            query=cls.select(),
+            page=page,
+            items_per_page=items_per_page,
+            order_by=order_by,
+            filters=filters,
+        )
+        return list(query)
 
+    @classmethod
+    def _paginate(
+        cls,
+        query: ModelSelect,
+        page: int = 1,
+        items_per_page: int = ITEMS_PER_PAGE,
+        order_by: Field | Iterable[Field] = None,
+        filters: Iterable = None,
+    ) -> ModelSelect:
         if filters:
             query = query.filter(*filters)
 
         if order_by:
-            query = query.order_by(order_by)
+            if isinstance(order_by, Iterable):
+                query = query.order_by(*order_by)
+            else:
+                query = query.order_by(order_by)
 
-        query = query.paginate(page, items_per_page)
-        return list(query)
+        return query.paginate(page, items_per_page)
+
+    @classmethod
+    def select_with_number_of_covers(cls) -> ModelSelect:
+        """
+        Запрос объектов с количеством их обложек в поле number_of_covers
+        """
+        return CatalogStatistic.join_number_of_covers(cls.select())
+
+    @classmethod
+    def paginating_with_number_of_covers(
+        cls,
+        page: int = 1,
+        items_per_page: int = ITEMS_PER_PAGE,
+        order_by: Field | Iterable[Field] = None,
+        filters: Iterable = None,
+    ) -> list[tuple[Type["BaseModel"], int]]:
+        query = cls._paginate(
+            query=cls.select_with_number_of_covers(),
+            page=page,
+            items_per_page=items_per_page,
+            order_by=order_by,
+            filters=filters,
+        )
+        return [(obj, obj.number_of_covers) for obj in query]
 
     @classmethod
     def get_inherited_models(cls) -> list[Type["BaseModel"]]:
@@ -299,10 +406,34 @@ class Cover(BaseModel):
     server_file_id = TextField(null=True)
     date_time = DateTimeField()
 
+    class Meta:
+        indexes = (
+            # Для сортировки обложек и поиска номера обложки
+            (("date_time", "id"), False),
+        )
+
     @property
     def abs_file_name(self) -> Path:
         return DIR_DATA_VK / self.file_name
 
+    @classmethod
+    def set_server_file_id(cls, cover_id: int, server_file_id: str):
+        # Основная база каталога открыта только на чтение
+        query = (
+            cls.update(server_file_id=server_file_id)
+            .where(cls.id == cover_id)
+            .bind(catalog_write_db)
+        )
+        with catalog_write_lock:
+            query.execute()
+
+    @classmethod
+    def set_server_file_ids(cls, server_file_id_by_cover_id: dict[int, str]):
+        # Пачка изменений записывается одной транзакцией
+        with catalog_write_lock, catalog_write_db.atomic():
+            for cover_id, server_file_id in server_file_id_by_cover_id.items():
+                cls.set_server_file_id(cover_id, server_file_id)
+
     @classmethod
     def get_filters(
         cls,
@@ -343,6 +474,40 @@ class Cover(BaseModel):
 
         return total_filters
 
+    @classmethod
+    def get_catalog_positions(
+        cls,
+        by_author: Union[int, "Author"] = None,
+        by_game_series: Union[int, "GameSeries"] = None,
+        by_game: Union[int, "Game"] = None,
+        filters: Iterable = None,
+    ) -> Optional[tuple["Catalog", Sequence[int]]]:
+        """
+        Позиции обложек по фильтрам из уже загруженного каталога.
+        Если каталог не загружен или заданы произвольные выражения filters, то вернется None
+        и нужно будет выполнить запрос в базу
+        """
+
+        if filters:
+            return None
+
+        # Импорт здесь, т.к. модуль каталога сам зависит от моделей
+        from bot.catalog import get_loaded_catalog
+
+        catalog = get_loaded_catalog()
+        if catalog is None:
+            return None
+
+        def _get_id(obj: Union[int, BaseModel, None]) -> Optional[int]:
+            return obj.id if isinstance(obj, BaseModel) else obj
+
+        positions = catalog.get_positions(
+            by_author=_get_id(by_author),
+            by_game_series=_get_id(by_game_series),
+            by_game=_get_id(by_game),
+        )
+        return catalog, positions
+
     @classmethod
     def count_by(
         cls,
@@ -351,6 +516,11 @@ class Cover(BaseModel):
         by_game: Union[int, "Game"] = None,
         filters: Iterable = None,
     ) -> int:
+        result = cls.get_catalog_positions(by_author, by_game_series, by_game, filters)
+        if result:
+            _, positions = result
+            return len(positions)
+
         total_filters = cls.get_filters(
             by_author=by_author,
             by_game_series=by_game_series,
@@ -368,6 +538,15 @@ class Cover(BaseModel):
         by_game: Union[int, "Game"] = None,
         filters: Iterable = None,
     ) -> Optional["Cover"]:
+        result = cls.get_catalog_positions(by_author, by_game_series, by_game, filters)
+        if result:
+            catalog, positions = result
+            if not 1 <= page <= len(positions):
+                return None
+
+            cover_id = catalog.covers[positions[page - 1]].id
+            return cls.get_by_id_prefetched(cover_id)
+
         total_filters = cls.get_filters(
             by_author=by_author,
             by_game_series=by_game_series,
@@ -375,13 +554,71 @@ class Cover(BaseModel):
             filters=filters,
         )
 
-        covers = cls.paginating(
-            page=page,
-            items_per_page=1,
-            order_by=cls.date_time,
-            filters=total_filters,
+        # Для перехода к произвольной странице сначала по индексу (date_time, id),
+        # без чтения строк таблицы, найдется id обложки, а после по нему и сама обложка
+        cover_ids = (
+            cls.select(cls.id)
+            .order_by(*cls.get_order_by())
+            .paginate(page, 1)
+        )
+        if total_filters:
+            cover_ids = cover_ids.where(*total_filters)
+
+        return cls.get_first_prefetched(
+            cls.select_with_game().where(cls.id == cover_ids)
+        )
+
+    @classmethod
+    def select_with_game(cls) -> ModelSelect:
+        # Обложки сразу вместе с игрой и ее серией
+        return (
+            cls.select(cls, Game, GameSeries)
+            .join(Game)
+            .join(GameSeries, JOIN.LEFT_OUTER)
         )
-        return covers[0] if covers else None
+
+    @classmethod
+    def prefetch_authors(cls, covers: list["Cover"]) -> list["Cover"]:
+        """
+        Загрузка авторов обложек одним запросом, после этого get_authors не будет обращаться к базе
+        """
+
+        links_by_cover_id: dict[int, list[Author2Cover]] = defaultdict(list)
+        if covers:
+            query = (
+                Author2Cover.select(Author2Cover, Author)
+                .join(Author)
+                .where(Author2Cover.cover.in_([cover.id for cover in covers]))
+            )
+            for link in query:
+                links_by_cover_id[link.cover_id].append(link)
+
+        for cover in covers:
+            links = links_by_cover_id[cover.id]
+            for link in links:
+                link.cover = cover
+
+            cover.links_to_authors = links
+
+        return covers
+
+    @classmethod
+    def get_first_prefetched(cls, query: ModelSelect) -> Optional["Cover"]:
+        cover = query.first()
+        if cover:
+            cls.prefetch_authors([cover])
+
+        return cover
+
+    @classmethod
+    def get_by_id_prefetched(cls, cover_id: int) -> "Cover":
+        cover = cls.select_with_game().where(cls.id == cover_id).get()
+        return cls.prefetch_authors([cover])[0]
+
+    @classmethod
+    def get_order_by(cls) -> tuple[Field, Field]:
+        # Обложки из одного поста имеют одинаковую дату, поэтому порядок уточняется по id
+        return cls.date_time, cls.id
 
     @classmethod
     def get_page(
@@ -392,23 +629,46 @@ class Cover(BaseModel):
         by_game: Union[int, "Game"] = None,
         filters: Iterable = None,
     ) -> int:
+        result = cls.get_catalog_positions(by_author, by_game_series, by_game, filters)
+        if result:
+            catalog, positions = result
+            i = catalog.get_index(positions, need_cover_id)
+            if i is None:
+                raise Exception(f"Не удалось определить номер для #{need_cover_id}")
+
+            return i + 1
+
         total_filters = cls.get_filters(
             by_author=by_author,
             by_game_series=by_game_series,
             by_game=by_game,
             filters=filters,
         )
-        query = cls.select(
-            fn.row_number().over(order_by=[cls.date_time]).alias("page"),
-            cls.id
-        )
-        if total_filters:
-            query = query.where(*total_filters)
-        query = query.order_by(cls.date_time)
 
-        for page, cover_id in query.tuples():
-            if cover_id == need_cover_id:
-                return page
+        # Номер страницы - это количество обложек до нужной, включая ее саму.
+        # Подсчет разбит на два диапазона индекса по (date_time, id): до даты нужной
+        # обложки и с ее датой, т.к. так SQLITE не вычисляет условие для каждой строки
+        need_cover = cls.alias()
+
+        def _count(*expressions):
+            return cls.select(fn.COUNT(cls.id)).where(*expressions, *total_filters)
+
+        # С фильтром "id IN (...)" по автору SQLITE 3.40 ищет по индексу (date_time, id)
+        # и теряет условие "id <= ?", считая все обложки с этой датой. Унарный плюс
+        # убирает условие из поиска по индексу, и оно проверяется для каждой найденной строки
+        id_not_indexed = NodeList((SQL("+"), cls.id), glue="")
+
+        query = need_cover.select(
+            _count(cls.date_time < need_cover.date_time),
+            _count(cls.date_time == need_cover.date_time, id_not_indexed <= need_cover.id),
+            _count(cls.id == need_cover.id),  # Проверка, что обложка проходит фильтры
+        ).where(need_cover.id == need_cover_id)
+
+        row = query.tuples().first()
+        if row:
+            number_before, number_same_date_time, found = row
+            if found:
+                return number_before + number_same_date_time
 
         raise Exception(
             f"Не удалось определить номер для #{need_cover_id} по {total_filters}"
@@ -425,25 +685,16 @@ class Cover(BaseModel):
 
     @classmethod
     def find(cls, text: str) -> list["Cover"]:
-        items = []
         if not text:
-            return items
-
-        # NOTE: Элементов в базе мало, поэтому эта реализация работает быстро,
-        #       но, конечно, лучше если поиск будет идти через саму базу
-        #       Нужно помнить, что в SQLITE поиск через LIKE не регистро-независимый для
-        #       не-ASCII, туда же идет и работа функций UPPER и LOWER
-        for cover in cls.select():
-            full_text = (
-                cover.text
-                + cover.game.name
-                + cover.game.series_name
-                + "".join(a.name for a in cover.get_authors())
-            )
-            if text.upper() in full_text.upper():
-                items.append(cover)
+            return []
 
-        return items
+        query = (
+            cls.select()
+            .join(CoverIndex, on=(CoverIndex.rowid == cls.id))
+            .where(CoverIndex.search_filter(text))
+            .order_by(cls.id)
+        )
+        return list(query)
 
 
 class Author(BaseModel):
@@ -541,6 +792,318 @@ class Author2Cover(BaseModel):
         )
 
 
+class CoverIndex(FTS5Model):
+    """
+    Полнотекстовый индекс для поиска обложек, rowid совпадает с id обложки.
+    Значения хранятся в casefold, поэтому поиск регистро-независимый и для не-ASCII
+    """
+
+    text = SearchField()
+    game = SearchField()
+    series = SearchField()
+    authors = SearchField()
+
+    class Meta:
+        database = catalog_db
+        # Триграммы позволяют искать по подстроке, а не только по целым словам
+        options = {"tokenize": "trigram case_sensitive 1"}
+
+    @classmethod
+    def search_filter(cls, text: str):
+        text = casefold(text)
+
+        # Триграммный индекс работает только для строк от 3 символов,
+        # для более коротких будет обычный перебор строк индекса
+        if len(text) < 3:
+            return (
+                (fn.instr(cls.text, text) > 0)
+                | (fn.instr(cls.game, text) > 0)
+                | (fn.instr(cls.series, text) > 0)
+                | (fn.instr(cls.authors, text) > 0)
+            )
+
+        # Поиск фразы, кавычки внутри экранируются удвоением
+        phrase = '"' + text.replace('"', '""') + '"'
+        return cls.match(phrase)
+
+    @classmethod
+    def rebuild(cls, cover_ids: Iterable[int] = None):
+        """
+        Пересоздание индекса. Если указаны cover_ids, то пересоздаются только строки этих обложек
+        """
+
+        if cover_ids is None:
+            cls._rebuild()
+            return
+
+        for batch in chunked(cover_ids, 500):
+            cls._rebuild(batch)
+
+    @classmethod
+    def _rebuild(cls, cover_ids: list[int] = None):
+        authors = (
+            Author2Cover.select(
+                Author2Cover.cover.alias("cover_id"),
+                fn.group_concat(Author.name, "\n").alias("names"),
+            )
+            .join(Author)
+            .group_by(Author2Cover.cover)
+        )
+        if cover_ids is not None:
+            authors = authors.where(Author2Cover.cover.in_(cover_ids))
+
+        query = (
+            Cover.select(
+                Cover.id,
+                fn.casefold(Cover.text),
+                fn.casefold(Game.name),
+                fn.casefold(fn.coalesce(GameSeries.name, "")),
+                fn.casefold(fn.coalesce(authors.c.names, "")),
+            )
+            .join(Game)
+            .join(GameSeries, JOIN.LEFT_OUTER)
+            .join(authors, JOIN.LEFT_OUTER, on=(authors.c.cover_id == Cover.id), src=Cover)
+        )
+
+        delete_query = cls.delete()
+        if cover_ids is not None:
+            query = query.where(Cover.id.in_(cover_ids))
+            delete_query = delete_query.where(cls.rowid.in_(cover_ids))
+
+        delete_query.execute()
+        cls.insert_from(
+            query, fields=[cls.rowid, cls.text, cls.game, cls.series, cls.authors]
+        ).execute()
+
+    @classmethod
+    def is_actual(cls) -> bool:
+        return cls.select().count() == Cover.select().count()
+
+
+class CatalogStatistic(BaseModel):
+    """
+    Заранее подсчитанная статистика объектов каталога для карточек и списков.
+    Каталог меняется только при заполнении базы, поэтому таблица там и пересоздается
+    """
+
+    class_name = TextField()
+    object_id = IntegerField()
+    number_of_covers = IntegerField(default=0)
+    number_of_authors = IntegerField(default=0)
+    number_of_games = IntegerField(default=0)
+    number_of_game_series = IntegerField(default=0)
+
+    class Meta:
+        indexes = (
+            (("class_name", "object_id"), True),
+        )
+
+    # Поля статистики, что есть у объектов каждого типа
+    FIELDS_BY_MODEL: dict[Type[BaseModel], list[str]] = {
+        Author: ["number_of_covers", "number_of_games", "number_of_game_series"],
+        GameSeries: ["number_of_covers", "number_of_authors", "number_of_games"],
+        Game: ["number_of_covers", "number_of_authors"],
+    }
+
+    @classmethod
+    def get_for(cls, obj: Author | GameSeries | Game) -> "CatalogStatistic":
+        statistic = cls.get_or_none(
+            class_name=obj.__class__.__name__,
+            object_id=obj.id,
+        )
+        if not statistic:
+            statistic = cls(class_name=obj.__class__.__name__, object_id=obj.id)
+
+        return statistic
+
+    @classmethod
+    def join_number_of_covers(cls, query: ModelSelect) -> ModelSelect:
+        model = query.model
+        return (
+            query.select_extend(fn.coalesce(cls.number_of_covers, 0).alias("number_of_covers"))
+            .join(
+                cls,
+                JOIN.LEFT_OUTER,
+                on=((cls.class_name == model.__name__) & (cls.object_id == model.id)),
+            )
+        )
+
+    @classmethod
+    def rebuild(cls, cover_ids: Iterable[int] = None):
+        """
+        Пересоздание статистики. Если указаны cover_ids, то пересчитывается статистика
+        только тех авторов, игр и серий, к которым относятся эти обложки
+        """
+
+        if cover_ids is None:
+            cls._rebuild()
+            return
+
+        for batch in chunked(cover_ids, 500):
+            games = Cover.select(Cover.game).where(Cover.id.in_(batch))
+            cls._rebuild(
+                {
+                    Author: Author2Cover.select(Author2Cover.author).where(
+                        Author2Cover.cover.in_(batch)
+                    ),
+                    GameSeries: Game.select(Game.series).where(Game.id.in_(games)),
+                    Game: games,
+                }
+            )
+
+    @classmethod
+    def _rebuild(cls, ids_by_model: dict[Type[BaseModel], ModelSelect] = None):
+        fields = [
+            cls.class_name,
+            cls.object_id,
+            cls.number_of_covers,
+            cls.number_of_authors,
+            cls.number_of_games,
+            cls.number_of_game_series,
+        ]
+
+        author_query = (
+            Author.select(
+                Value(Author.__name__),
+                Author.id,
+                fn.COUNT(Cover.id.distinct()),
+                0,
+                fn.COUNT(Game.id.distinct()),
+                fn.COUNT(Game.series.distinct()),
+            )
+            .join(Author2Cover, JOIN.LEFT_OUTER)
+            .join(Cover, JOIN.LEFT_OUTER)
+            .join(Game, JOIN.LEFT_OUTER)
+            .group_by(Author.id)
+        )
+
+        game_series_query = (
+            GameSeries.select(
+                Value(GameSeries.__name__),
+                GameSeries.id,
+                fn.COUNT(Cover.id.distinct()),
+                fn.COUNT(Author2Cover.author.distinct()),
+                fn.COUNT(Game.id.distinct()),
+                0,
+            )
+            .join(Game, JOIN.LEFT_OUTER)
+            .join(Cover, JOIN.LEFT_OUTER)
+            .join(Author2Cover, JOIN.LEFT_OUTER)
+            .group_by(GameSeries.id)
+        )
+
+        game_query = (
+            Game.select(
+                Value(Game.__name__),
+                Game.id,
+                fn.COUNT(Cover.id.distinct()),
+                fn.COUNT(Author2Cover.author.distinct()),
+                0,
+                0,
+            )
+            .join(Cover, JOIN.LEFT_OUTER)
+            .join(Author2Cover, JOIN.LEFT_OUTER)
+            .group_by(Game.id)
+        )
+
+        if ids_by_model is None:
+            cls.delete().execute()
+            for query in [author_query, game_series_query, game_query]:
+                cls.insert_from(query, fields=fields).execute()
+            return
+
+        for model, query in [
+            (Author, author_query),
+            (GameSeries, game_series_query),
+            (Game, game_query),
+        ]:
+            ids = ids_by_model[model]
+            cls.delete().where(
+                (cls.class_name == model.__name__) & cls.object_id.in_(ids)
+            ).execute()
+            cls.insert_from(query.where(model.id.in_(ids)), fields=fields).execute()
+
+    @classmethod
+    def is_actual(cls) -> bool:
+        return cls.select().count() == sum(
+            model.select().count() for model in cls.FIELDS_BY_MODEL
+        )
+
+    @classmethod
+    def check(cls) -> list[str]:
+        """
+        Сравнение статистики с подсчетом по самим таблицам, вернет список расхождений
+        """
+
+        errors = []
+        for model, fields in cls.FIELDS_BY_MODEL.items():
+            for obj in model.select():
+                statistic = cls.get_for(obj)
+                for field in fields:
+                    expected = getattr(obj, f"get_{field}")()
+                    actual = getattr(statistic, field)
+                    if expected != actual:
+                        errors.append(f"{obj}: {field}={actual}, but expected {expected}")
+
+        return errors
+
+
+# Ключ записи дампа: id поста и номер картинки в посте
+DumpKey = tuple[int, int]
+
+# Например: "images\\20960_1.jpg" -> 1
+PATTERN_PHOTO_NUMBER = re.compile(r"_(\d+)\.\w+$")
+
+
+def get_photo_number(file_name: str) -> int:
+    # Номер сравнивается как число, иначе "10_10.jpg" окажется раньше "10_9.jpg"
+    m = PATTERN_PHOTO_NUMBER.search(file_name)
+    return int(m.group(1)) if m else 0
+
+
+class ImportCheckpoint(BaseModel):
+    """
+    Отметка импорта файла дампа: последняя импортированная запись и сколько байт файла прочитано.
+    По ней повторный импорт обрабатывает только новые записи
+    """
+
+    source = TextField(unique=True)
+    last_post_id = IntegerField(default=0)
+    last_photo_number = IntegerField(default=0)
+    offset = IntegerField(default=0)
+    updated_at = DateTimeField(default=DT.datetime.now)
+
+    @staticmethod
+    def get_source(file_name: Path) -> str:
+        return str(Path(file_name).resolve())
+
+    @classmethod
+    def get_for(cls, file_name: Path) -> "ImportCheckpoint":
+        source = cls.get_source(file_name)
+        checkpoint = cls.get_or_none(source=source)
+        if not checkpoint:
+            checkpoint = cls(source=source)
+
+        return checkpoint
+
+    @classmethod
+    def set_for(cls, file_name: Path, last_key: DumpKey, offset: int):
+        last_post_id, last_photo_number = last_key
+        cls.insert(
+            source=cls.get_source(file_name),
+            last_post_id=last_post_id,
+            last_photo_number=last_photo_number,
+            offset=offset,
+            updated_at=DT.datetime.now(),
+        ).on_conflict(
+            conflict_target=[cls.source],
+            preserve=[cls.last_post_id, cls.last_photo_number, cls.offset, cls.updated_at],
+        ).execute()
+
+    def get_last_key(self) -> DumpKey:
+        return self.last_post_id, self.last_photo_number
+
+
 class TgUser(BaseModel):
     first_name = TextField()
     last_name = TextField(null=True)
@@ -549,6 +1112,9 @@ class TgUser(BaseModel):
     last_activity = DateTimeField(default=DT.datetime.now)
     number_requests = IntegerField(default=0)
 
+    class Meta:
+        database = telemetry_db
+
     @classmethod
     def add(
         cls,
@@ -614,6 +1180,9 @@ class TgChat(BaseModel):
     last_activity = DateTimeField(default=DT.datetime.now)
     number_requests = IntegerField(default=0)
 
+    class Meta:
+        database = telemetry_db
+
     @classmethod
     def add(
         cls,
@@ -679,13 +1248,188 @@ class TgChat(BaseModel):
         return self.number_requests in (0, 1)
 
 
-db.connect()
-db.create_tables(BaseModel.get_inherited_models())
+class UploadJob(BaseModel):
+    """
+    Задача загрузки обложек в телеграм. Незавершенная задача продолжится после перезапуска бота
+    """
+
+    chat_id = IntegerField()
+    message_id = IntegerField(null=True)
+    started_at = DateTimeField(default=DT.datetime.now)
+    finished_at = DateTimeField(null=True)
+    number_of_uploaded = IntegerField(default=0)
+    error = TextField(null=True)
+
+    class Meta:
+        database = telemetry_db
+
+    @classmethod
+    def get_unfinished(cls) -> Optional["UploadJob"]:
+        return (
+            cls.select()
+            .where(cls.finished_at.is_null())
+            .order_by(cls.id.desc())
+            .first()
+        )
+
+
+class MediaAsset(BaseModel):
+    """
+    Загруженные в телеграм статичные файлы: file_id по хэшу содержимого файла.
+    При изменении файла меняется и хэш, поэтому старый file_id больше не найдется
+    """
+
+    content_hash = TextField(unique=True)
+    file_name = TextField()
+    file_id = TextField()
+    updated_at = DateTimeField(default=DT.datetime.now)
+
+    class Meta:
+        database = telemetry_db
+
+    @classmethod
+    def get_file_id(cls, content_hash: str) -> str | None:
+        return (
+            cls.select(cls.file_id)
+            .where(cls.content_hash == content_hash)
+            .scalar()
+        )
+
+    @classmethod
+    def set_file_id(cls, content_hash: str, file_name: str, file_id: str | None):
+        if not file_id:
+            cls.delete().where(cls.content_hash == content_hash).execute()
+            return
+
+        cls.insert(
+            content_hash=content_hash,
+            file_name=file_name,
+            file_id=file_id,
+            updated_at=DT.datetime.now(),
+        ).on_conflict(
+            conflict_target=[cls.content_hash],
+            preserve=[cls.file_name, cls.file_id, cls.updated_at],
+        ).execute()
+
+    @classmethod
+    def delete_by_file_name(cls, file_name: str):
+        cls.delete().where(cls.file_name == file_name).execute()
+
+
+def get_models(database) -> list[Type[BaseModel]]:
+    return [
+        model
+        for model in BaseModel.get_inherited_models() + [CoverIndex]
+        if model._meta.database is database
+    ]
+
+
+CATALOG_MODELS: list[Type[BaseModel]] = get_models(catalog_db)
+TELEMETRY_MODELS: list[Type[BaseModel]] = get_models(telemetry_db)
+
+
+@contextmanager
+def catalog_for_write() -> Iterator[SqliteDatabase]:
+    """
+    Привязка моделей каталога к базе, открытой на запись.
+    Привязка общая для всех потоков, поэтому только для заполнения базы, но не для обработчиков бота.
+    Пока привязка действует, другие потоки процесса каталог не меняют
+    """
+
+    with catalog_write_lock, catalog_write_db.bind_ctx(CATALOG_MODELS):
+        yield catalog_write_db
+
+
+def get_catalog_version(database: Database = None) -> int:
+    """
+    Версия данных каталога, хранится в заголовке файла базы (PRAGMA user_version).
+    Увеличивается при каждом заполнении базы. Читается один раз при загрузке снимка каталога,
+    а кэши бота устаревают по версии снимка в памяти
+    """
+
+    database = database or Cover._meta.database
+    return database.execute_sql("PRAGMA user_version").fetchone()[0]
+
+
+def bump_catalog_version(database: Database = None) -> int:
+    # Заголовок меняется в той же транзакции, что и данные
+    database = database or Cover._meta.database
+    version = get_catalog_version(database) + 1
+    database.execute_sql(f"PRAGMA user_version = {version:d}")
+    return version
+
+
+def add_indexes_for_lists(database: Database):
+    """
+    Индексы для списков, отсортированных по имени, и для обложек игры в порядке Cover.get_order_by.
+    После добавления индексов обновляется статистика для планировщика запросов
+    """
+
+    for index in [
+        Author.index(Author.name),
+        GameSeries.index(GameSeries.name),
+        Game.index(Game.name),
+        Game.index(Game.series, Game.name),
+        Cover.index(Cover.game, Cover.date_time),
+    ]:
+        database.execute(index)
+
+    database.execute_sql("ANALYZE")
+
+
+# Новые миграции добавляются только в конец списка
+CATALOG_MIGRATIONS: list[Migration] = [
+    add_indexes_for_lists,
+]
+
+
+with catalog_for_write():
+    catalog_write_db.create_tables(CATALOG_MODELS)
+    for name in migrate(catalog_write_db, CATALOG_MIGRATIONS):
+        log.info(f"Применена миграция базы каталога: {name}")
+
+    # Таблицы, что заполняются по данным каталога, могли остаться пустыми,
+    # если база была заполнена до их появления
+    for model in [CoverIndex, CatalogStatistic]:
+        if not model.is_actual():
+            model.rebuild()
+
+    catalog_write_db.close()
+
+telemetry_db.create_tables(TELEMETRY_MODELS)
 
 # Задержка в 50мс, чтобы дать время на запуск SqliteQueueDatabase и создание таблиц
 # Т.к. в SqliteQueueDatabase запросы на чтение выполняются сразу, а на запись попадают в очередь
 time.sleep(0.050)
 
+
+def move_telemetry_from_catalog():
+    """
+    Раньше активность хранилась в базе каталога, поэтому при первом запуске
+    она переносится в свою базу, а из базы каталога таблицы удаляются
+    """
+
+    with catalog_write_lock:
+        tables = catalog_write_db.get_tables()
+        for model in TELEMETRY_MODELS:
+            table_name = model._meta.table_name
+            if table_name not in tables:
+                continue
+
+            if not model.select().exists():
+                cursor = catalog_write_db.execute_sql(f'SELECT * FROM "{table_name}"')
+                columns = [column[0] for column in cursor.description]
+                rows = [dict(zip(columns, row)) for row in cursor]
+                for batch in chunked(rows, 100):
+                    model.insert_many(batch).execute()
+
+            catalog_write_db.execute_sql(f'DROP TABLE "{table_name}"')
+
+        catalog_write_db.close()
+
+
+move_telemetry_from_catalog()
+
 if __name__ == "__main__":
     BaseModel.print_count_of_tables()
     # Author: 165, Author2Cover: 607, Cover: 567, Game: 451, GameSeries: 200, TgChat: 16, TgUser: 16
@@ -4,9 +4,12 @@
 __author__ = "ipetrash"
 
 
+import threading
 import time
-from typing import Any
+from typing import Any, Iterable
 
+from peewee import Query
+from playhouse.pool import PooledSqliteDatabase
 from playhouse.sqliteq import SqliteQueueDatabase
 from telegram.ext import ExtBot
 
@@ -24,14 +27,92 @@ class ExtBotDebug(ExtBot):
         return result
 
 
-class SqliteQueueDatabaseDebug(SqliteQueueDatabase):
-    elapsed_time_ns: int = 0
+class DatabaseStats:
+    """
+    Счетчики запросов к базам данных.
+    Обработчики работают в разных потоках, поэтому счетчики у каждого потока свои,
+    а запросы ко всем базам учитываются вместе
+    """
+
+    _local = threading.local()
+
+    @property
+    def elapsed_time_ns(self) -> int:
+        return getattr(self._local, "elapsed_time_ns", 0)
+
+    @property
+    def number_of_queries(self) -> int:
+        return getattr(self._local, "number_of_queries", 0)
 
     def start_timer(self):
-        self.elapsed_time_ns = 0
+        self._local.elapsed_time_ns = 0
+        self._local.number_of_queries = 0
+
+    def add(self, elapsed_time_ns: int):
+        self._local.elapsed_time_ns = self.elapsed_time_ns + elapsed_time_ns
+        self._local.number_of_queries = self.number_of_queries + 1
+
 
+db_stats = DatabaseStats()
+
+
+class DatabaseDebugMixin:
     def execute_sql(self, *args, **kwargs) -> Any:
         t = time.perf_counter_ns()
         result = super().execute_sql(*args, **kwargs)
-        self.elapsed_time_ns += time.perf_counter_ns() - t
+        db_stats.add(time.perf_counter_ns() - t)
         return result
+
+
+class AtomicQueries:
+    """
+    Запросы на запись, которые поток записи выполнит одной транзакцией
+    """
+
+    def __init__(self, queries: list[tuple[str, list]]):
+        self.queries = queries
+
+
+class SqliteQueueDatabaseDebug(DatabaseDebugMixin, SqliteQueueDatabase):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        # Поток записи выполняет запросы из очереди через _execute
+        self._execute_query = self._execute
+        self._execute = self._execute_in_writer
+
+    def _execute_in_writer(self, sql, params=None, commit=True):
+        if not isinstance(sql, AtomicQueries):
+            return self._execute_query(sql, params, commit)
+
+        # Транзакция открывается вручную, т.к. atomic() этим классом не поддерживается
+        cursor = self._execute_query("BEGIN", commit=False)
+        try:
+            for query_sql, query_params in sql.queries:
+                cursor = self._execute_query(query_sql, query_params, commit=False)
+        except Exception:
+            self.rollback()
+            raise
+
+        self.commit()
+        return cursor
+
+    def execute_atomic(self, queries: Iterable[Query]):
+        """
+        Выполнение запросов на запись одной транзакцией, вернется после ее завершения.
+        Вместо atomic(), который у SqliteQueueDatabase не поддерживается: запросы всех потоков
+        идут через одну очередь, и между запросами одного потока выполнились бы чужие
+        """
+
+        cursor = self.execute_sql(AtomicQueries([query.sql() for query in queries]), commit=True)
+
+        # Ожидание результата, ошибка транзакции поднимется здесь
+        cursor.fetchall()
+
+    def get_write_queue_size(self) -> int:
+        # Количество запросов на запись, ожидающих потока записи
+        return self._write_queue.qsize()
+
+
+class PooledSqliteDatabaseDebug(DatabaseDebugMixin, PooledSqliteDatabase):
+    pass
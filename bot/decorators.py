@@ -11,8 +11,9 @@ import time
 from telegram import Update
 from telegram.ext import CallbackContext
 
-from bot.debug import ExtBotDebug
-from bot.db import db, TgUser, TgChat
+from bot.debug import ExtBotDebug, db_stats
+from bot.activity import activity_tracker
+from bot.db import catalog_db
 
 
 def log_func(log: logging.Logger):
@@ -66,7 +67,7 @@ def process_request(log: logging.Logger):
             func_name = func.__name__
 
             t = time.perf_counter_ns()
-            db.start_timer()
+            db_stats.start_timer()
 
             if not isinstance(context.bot, ExtBotDebug):
                 raise Exception("Бот должен иметь тип ExtBotDebug!")
@@ -74,25 +75,22 @@ def process_request(log: logging.Logger):
             bot.start_timer()
 
             if update:
-                user = update.effective_user
-                chat = update.effective_chat
+                # Запись в базу будет позже, вместе с активностью из других запросов
+                activity_tracker.track(update.effective_user, update.effective_chat)
 
-                user_db = TgUser.get_from(user)
-                if user_db:
-                    user_db.actualize(user)
-
-                chat_db = TgChat.get_from(chat)
-                if chat_db:
-                    chat_db.actualize(chat)
-
-            result = func(update, context)
+            try:
+                result = func(update, context)
+            finally:
+                # Соединение с каталогом возвращается в пул
+                catalog_db.close()
 
             elapsed_ms = (time.perf_counter_ns() - t) // 1_000_000
-            elapsed_db_ms = db.elapsed_time_ns // 1_000_000
+            elapsed_db_ms = db_stats.elapsed_time_ns // 1_000_000
             elapsed_bot_ms = bot.elapsed_time_ns // 1_000_000
 
             log.debug(
-                f"[{func_name}] Elapsed {elapsed_ms} ms (db/bot: {elapsed_db_ms}/{elapsed_bot_ms})"
+                f"[{func_name}] Elapsed {elapsed_ms} ms (db/bot: {elapsed_db_ms}/{elapsed_bot_ms}), "
+                f"db queries: {db_stats.number_of_queries}"
             )
 
             return result
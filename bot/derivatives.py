@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "ipetrash"
+
+
+import contextlib
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import time
+
+from concurrent.futures import Executor, ProcessPoolExecutor
+from pathlib import Path
+from typing import Iterable
+
+# pip install Pillow
+from PIL import Image, ImageOps
+
+from config import DIR_IMAGES, DIR_IMAGES_CACHE, IMAGE_MAX_SIDE, IMAGE_JPEG_QUALITY
+from bot.common import log
+
+
+def get_mp_context() -> multiprocessing.context.BaseContext:
+    # Бот многопоточный, а fork копирует и захваченные другими потоками блокировки
+    return multiprocessing.get_context("spawn")
+
+
+def make_derivative(
+    source: Path,
+    target: Path,
+    max_side: int = IMAGE_MAX_SIDE,
+    quality: int = IMAGE_JPEG_QUALITY,
+) -> tuple[int, int]:
+    """
+    Копия картинки для телеграма: сторона не больше max_side, прогрессивный JPEG
+    без метаданных. Копия создается всегда, даже если она не меньше оригинала,
+    чтобы в телеграм не попадали EXIF (например, координаты) и неповернутые картинки.
+    Вернет размеры оригинала и копии в байтах
+    """
+
+    # Одну копию могут создавать сразу несколько потоков или процессов
+    tmp = target.with_name(f"{target.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+
+    with Image.open(source) as img:
+        # Поворот из EXIF применяется к пикселям, т.к. сам EXIF в копию не попадет
+        img = ImageOps.exif_transpose(img)
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+
+        if max(img.size) > max_side:
+            img.thumbnail((max_side, max_side), Image.LANCZOS)
+
+        img.save(
+            tmp,
+            "JPEG",
+            quality=quality,
+            optimize=True,
+            progressive=True,
+            icc_profile=img.info.get("icc_profile"),
+        )
+
+    # Копия появляется целиком, даже если процесс прервется во время записи
+    os.replace(tmp, target)
+
+    return source.stat().st_size, target.stat().st_size
+
+
+class DerivativeCache:
+    """
+    Кэш копий картинок для загрузки в телеграм.
+    Имя копии - хэш содержимого оригинала и параметров, а в индексе запоминается,
+    какая копия у какого файла при его mtime и размере, чтобы не читать неизмененные оригиналы
+    """
+
+    INDEX_FILE_NAME = "index.json"
+
+    # Меняется вместе со способом создания копий, чтобы прошлые копии создались заново
+    VERSION = 2
+
+    def __init__(
+        self,
+        dir_cache: Path = DIR_IMAGES_CACHE,
+        max_side: int = IMAGE_MAX_SIDE,
+        quality: int = IMAGE_JPEG_QUALITY,
+        log: logging.Logger = None,
+    ):
+        self.dir_cache = dir_cache
+        self.max_side = max_side
+        self.quality = quality
+        self.log = log
+
+        self._lock = threading.Lock()
+        # Путь оригинала -> [mtime_ns, размер, имя копии]
+        self._index: dict[str, list] | None = None
+
+    @property
+    def index_file_name(self) -> Path:
+        return self.dir_cache / self.INDEX_FILE_NAME
+
+    def _load_index(self) -> dict[str, list]:
+        if self._index is None:
+            try:
+                self._index = json.loads(self.index_file_name.read_text("utf-8"))
+            except (FileNotFoundError, ValueError):
+                self._index = dict()
+
+        return self._index
+
+    def _save_index(self):
+        self.dir_cache.mkdir(parents=True, exist_ok=True)
+
+        tmp = self.index_file_name.with_name(self.INDEX_FILE_NAME + ".tmp")
+        tmp.write_text(json.dumps(self._index, ensure_ascii=False), "utf-8")
+        os.replace(tmp, self.index_file_name)
+
+    def get_name(self, source: Path) -> str:
+        content_hash = hashlib.sha256(source.read_bytes())
+        content_hash.update(f"{self.VERSION}:{self.max_side}:{self.quality}".encode())
+        return content_hash.hexdigest() + ".jpg"
+
+    def get_cached(self, source: Path) -> Path | None:
+        """
+        Копия, если она уже есть и оригинал с тех пор не менялся
+        """
+
+        stat = source.stat()
+        with self._lock:
+            item = self._load_index().get(str(source))
+
+        if not item or item[:2] != [stat.st_mtime_ns, stat.st_size]:
+            return
+
+        target = self.dir_cache / item[2]
+        return target if target.exists() else None
+
+    def _add_to_index(self, source: Path, name: str):
+        stat = source.stat()
+        self._load_index()[str(source)] = [stat.st_mtime_ns, stat.st_size, name]
+
+    def get(self, source: Path) -> Path:
+        """
+        Путь к копии картинки, копия создается, если ее еще нет
+        """
+
+        target = self.get_cached(source)
+        if target:
+            return target
+
+        name = self.get_name(source)
+        target = self.dir_cache / name
+        if not target.exists():
+            self.dir_cache.mkdir(parents=True, exist_ok=True)
+            make_derivative(source, target, self.max_side, self.quality)
+
+        with self._lock:
+            self._add_to_index(source, name)
+            self._save_index()
+
+        return target
+
+    def get_for_upload(self, source: Path) -> Path:
+        # Без копии загрузится оригинал, лишь бы загрузка не сломалась
+        try:
+            return self.get(source)
+        except Exception:
+            if self.log:
+                self.log.exception(f"Не удалось создать копию {source}")
+            return source
+
+    def make_all(
+        self,
+        sources: Iterable[Path],
+        processes: int = None,
+        executor: Executor = None,
+    ) -> dict[str, int | float]:
+        """
+        Создание копий для всех картинок в пуле процессов. Неизмененные картинки пропускаются.
+        Если пул не передан в executor, то он создается на время вызова.
+        Вернет статистику: сколько копий создано и размеры в байтах
+        """
+
+        t = time.perf_counter()
+
+        sources = list(sources)
+        targets = dict()
+        for source in sources:
+            if self.get_cached(source):
+                continue
+
+            name = self.get_name(source)
+            target = self.dir_cache / name
+            if target.exists():
+                with self._lock:
+                    self._add_to_index(source, name)
+                continue
+
+            targets[source] = target
+
+        self.dir_cache.mkdir(parents=True, exist_ok=True)
+
+        made = bytes_in = bytes_out = 0
+        if targets:
+            if executor:
+                executor_ctx = contextlib.nullcontext(executor)
+            else:
+                executor_ctx = ProcessPoolExecutor(
+                    max_workers=processes, mp_context=get_mp_context()
+                )
+
+            with executor_ctx as executor:
+                futures = {
+                    source: executor.submit(
+                        make_derivative, source, target, self.max_side, self.quality
+                    )
+                    for source, target in targets.items()
+                }
+                for source, future in futures.items():
+                    try:
+                        size_in, size_out = future.result()
+                    except Exception:
+                        # Для такой картинки загрузится оригинал
+                        if self.log:
+                            self.log.exception(f"Не удалось создать копию {source}")
+                        continue
+
+                    made += 1
+                    bytes_in += size_in
+                    bytes_out += size_out
+
+                    with self._lock:
+                        self._add_to_index(source, targets[source].name)
+
+        with self._lock:
+            self._load_index()
+            self._save_index()
+
+        return {
+            "total": len(sources),
+            "made": made,
+            "bytes_in": bytes_in,
+            "bytes_out": bytes_out,
+            "elapsed_secs": time.perf_counter() - t,
+        }
+
+
+derivative_cache = DerivativeCache(log=log)
+
+
+if __name__ == "__main__":
+    # Заранее создать копии всех обложек: python -m bot.derivatives
+    stats = derivative_cache.make_all(sorted(DIR_IMAGES.glob("*.jpg")))
+
+    bytes_in, bytes_out = stats["bytes_in"], stats["bytes_out"]
+    print(
+        f"Копий создано: {stats['made']} из {stats['total']} за {stats['elapsed_secs']:.1f} секунд"
+    )
+    if bytes_in:
+        print(
+            f"Размер: {bytes_in / 1024 / 1024:.1f} MB -> {bytes_out / 1024 / 1024:.1f} MB "
+            f"({bytes_out / bytes_in:.0%})"
+        )
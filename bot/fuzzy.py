@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "ipetrash"
+
+
+import math
+import re
+
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from typing import Iterable
+
+from config import FUZZY_SIMILARITY_THRESHOLD
+
+
+PATTERN_WORD = re.compile(r"\w+")
+
+EMPTY_IDS = array("I")
+
+
+def get_words(text: str | None) -> list[str]:
+    return PATTERN_WORD.findall((text or "").casefold())
+
+
+def get_trigrams(word: str) -> set[str]:
+    # Как в pg_trgm: слово дополняется двумя пробелами в начале и одним в конце,
+    # поэтому у коротких слов тоже есть триграммы, а начало слова весит больше
+    word = f"  {word} "
+    return {word[i: i + 3] for i in range(len(word) - 2)}
+
+
+def get_similarity(a: str, b: str) -> float:
+    # Доля общих триграмм слов (коэффициент Жаккара)
+    a, b = get_trigrams(a), get_trigrams(b)
+    return len(a & b) / len(a | b)
+
+
+def contains(ids: array, value: int) -> bool:
+    i = bisect_left(ids, value)
+    return i < len(ids) and ids[i] == value
+
+
+class FuzzyIndex:
+    """
+    Триграммный индекс слов для поиска с опечатками. По каждой триграмме хранятся
+    возрастающие id слов, а по каждому слову - возрастающие позиции документов.
+    Слово запроса сравнивается со словами документов по доле общих триграмм, а
+    похожесть документа - это сумма лучших похожестей слов запроса, взвешенная
+    по количеству их триграмм
+    """
+
+    def __init__(self, documents: Iterable[Iterable[str]]):
+        """
+        documents - тексты каждого документа, позиция документа - его номер в documents
+        """
+
+        self.words: list[str] = []
+        self.word_ids: dict[str, int] = dict()
+        self.positions_by_word: list[array] = []
+        self.word_ids_by_trigram: dict[str, array] = dict()
+
+        # Одинаковые тексты (имена авторов, названия игр) разбираются один раз
+        word_ids_by_text: dict[str, list[int]] = dict()
+
+        for position, texts in enumerate(documents):
+            word_ids = set()
+            for text in texts:
+                ids = word_ids_by_text.get(text)
+                if ids is None:
+                    ids = word_ids_by_text[text] = [
+                        self._add_word(word) for word in get_words(text)
+                    ]
+                word_ids.update(ids)
+
+            for word_id in word_ids:
+                self.positions_by_word[word_id].append(position)
+
+        self.number_of_trigrams = array("H", (len(get_trigrams(word)) for word in self.words))
+
+    def _add_word(self, word: str) -> int:
+        word_id = self.word_ids.get(word)
+        if word_id is not None:
+            return word_id
+
+        word_id = self.word_ids[word] = len(self.words)
+        self.words.append(word)
+        self.positions_by_word.append(array("I"))
+        for trigram in get_trigrams(word):
+            self.word_ids_by_trigram.setdefault(trigram, array("I")).append(word_id)
+
+        return word_id
+
+    def find_words(self, word: str, threshold: float) -> dict[int, float]:
+        """
+        id слов индекса с похожестью на word не меньше threshold
+        """
+
+        trigrams = get_trigrams(word)
+        number = len(trigrams)
+
+        # Для похожести threshold нужно хотя бы min_common общих триграмм, поэтому слово
+        # обязательно встретится в одном из (number - min_common + 1) самых коротких списков.
+        # Кандидаты берутся только из них, а остальные списки проверяются бинарным поиском
+        min_common = max(1, math.ceil(threshold * number - 1e-9))
+        lists = sorted(
+            (self.word_ids_by_trigram.get(trigram, EMPTY_IDS) for trigram in trigrams),
+            key=len,
+        )
+        prefix_size = number - min_common + 1
+
+        candidates = Counter()
+        for ids in lists[:prefix_size]:
+            candidates.update(ids)
+
+        # Похожие слова не могут сильно отличаться по количеству триграмм
+        min_number = threshold * number
+        max_number = number / threshold if threshold else math.inf
+
+        similarity_by_word_id = dict()
+        for word_id, common in candidates.items():
+            other_number = self.number_of_trigrams[word_id]
+            if not min_number <= other_number <= max_number:
+                continue
+
+            for ids in lists[prefix_size:]:
+                if contains(ids, word_id):
+                    common += 1
+
+            similarity = common / (number + other_number - common)
+            if similarity >= threshold:
+                similarity_by_word_id[word_id] = similarity
+
+        return similarity_by_word_id
+
+    def search(
+        self,
+        text: str,
+        threshold: float = FUZZY_SIMILARITY_THRESHOLD,
+    ) -> list[tuple[int, float]]:
+        """
+        Позиции документов и их похожесть на text по убыванию похожести
+        """
+
+        words = list(dict.fromkeys(get_words(text)))
+        weights = [len(get_trigrams(word)) for word in words]
+        total_weight = sum(weights)
+
+        score_by_position: Counter = Counter()
+        for word, weight in zip(words, weights):
+            best_by_position: dict[int, float] = dict()
+            for word_id, similarity in self.find_words(word, threshold).items():
+                for position in self.positions_by_word[word_id]:
+                    if best_by_position.get(position, 0.0) < similarity:
+                        best_by_position[position] = similarity
+
+            weight /= total_weight
+            for position, similarity in best_by_position.items():
+                score_by_position[position] += similarity * weight
+
+        items = [
+            (position, score)
+            for position, score in score_by_position.items()
+            if score >= threshold
+        ]
+        items.sort(key=lambda x: (-x[1], x[0]))
+        return items
+
+    def __len__(self) -> int:
+        return len(self.words)
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "ipetrash"
+
+
+import datetime as DT
+from typing import Callable
+
+# pip install peewee
+from peewee import (
+    Database,
+    Model,
+    IntegerField,
+    TextField,
+    DateTimeField,
+)
+
+
+# Миграция получает базу, к которой применяется
+Migration = Callable[[Database], None]
+
+
+class SchemaVersion(Model):
+    """
+    Примененные к базе миграции.
+    Модель не привязана к базе, т.к. у каждой базы своя таблица версий
+    """
+
+    version = IntegerField(primary_key=True)
+    name = TextField()
+    applied_at = DateTimeField(default=DT.datetime.now)
+
+    class Meta:
+        table_name = "schema_version"
+
+
+def get_version(database: Database) -> int:
+    with database.bind_ctx([SchemaVersion]):
+        database.create_tables([SchemaVersion])
+        return SchemaVersion.select(SchemaVersion.version).order_by(
+            SchemaVersion.version.desc()
+        ).scalar() or 0
+
+
+def migrate(database: Database, migrations: list[Migration]) -> list[str]:
+    """
+    Применение к базе миграций, что еще не были применены.
+    Номер версии - это номер миграции в списке, поэтому новые миграции добавляются только в конец.
+    Возвращает названия примененных миграций
+    """
+
+    applied = []
+
+    version = get_version(database)
+    with database.bind_ctx([SchemaVersion]):
+        for number, migration in enumerate(migrations, start=1):
+            if number <= version:
+                continue
+
+            name = migration.__name__
+
+            # Миграция и запись ее версии выполняются вместе, или вместе не выполняются
+            with database.atomic():
+                migration(database)
+                SchemaVersion.create(version=number, name=name)
+
+            applied.append(name)
+
+    return applied
@@ -4,11 +4,14 @@
 __author__ = "ipetrash"
 
 
+import functools
 import re
 
 from third_party.regexp import fill_string_pattern as _fill_string_pattern
 
 
+# Одни и те же шаблоны для кнопок заполняются при каждом запросе
+@functools.lru_cache(maxsize=10_000)
 def fill_string_pattern(pattern: re.Pattern, *args) -> str:
     # Замена None на пустые строки
     args = [arg if arg is not None else "" for arg in args]
@@ -17,6 +20,10 @@ def fill_string_pattern(pattern: re.Pattern, *args) -> str:
 
 COMMAND_FILL_SERVER_FILE_ID = "fill_server_file_id"
 
+COMMAND_RELOAD_CATALOG = "reload_catalog"
+
+COMMAND_METRICS = "metrics"
+
 COMMAND_GIF_START_DEEP_LINKING = "gif_start_deep_linking"
 
 PATTERN_COVERS_REPLY_HELP = re.compile(r"^Помощь$", flags=re.IGNORECASE)
@@ -30,8 +37,21 @@ PATTERN_COVER_PAGE = re.compile(
 PATTERN_COVER_NEW_PAGE = re.compile(
     r"^covers new page=(?P<page>\d+) a#(?P<author_id>\d*) gs#(?P<game_series_id>\d*) g#(?P<game_id>\d*)$"
 )
+# Переход к соседней обложке (direction: < или >) от обложки cover_id
+PATTERN_COVER_NEAR_PAGE = re.compile(
+    r"^covers page=(?P<page>\d+) (?P<direction>[<>])c#(?P<cover_id>\d+) a#(?P<author_id>\d*) gs#(?P<game_series_id>\d*) g#(?P<game_id>\d*)$"
+)
 PATTERN_REPLY_COVER_BY_PAGE = re.compile(r"^(?P<page>\d+)$")
 
+# Обложки альбомами по COVERS_PER_ALBUM штук, page - номер альбома
+COMMAND_COVERS_ALBUM = "album"
+PATTERN_COVER_ALBUM_PAGE = re.compile(
+    r"^album page=(?P<page>\d+) a#(?P<author_id>\d*) gs#(?P<game_series_id>\d*) g#(?P<game_id>\d*)$"
+)
+PATTERN_COVER_ALBUM_NEW_PAGE = re.compile(
+    r"^album new page=(?P<page>\d+) a#(?P<author_id>\d*) gs#(?P<game_series_id>\d*) g#(?P<game_id>\d*)$"
+)
+
 COMMAND_AUTHORS_ALL = "authors"
 PATTERN_AUTHORS_REPLY_ALL = re.compile(r"^Авторы$", flags=re.IGNORECASE)
 PATTERN_AUTHORS_PAGE = re.compile(
@@ -40,6 +60,10 @@ PATTERN_AUTHORS_PAGE = re.compile(
 PATTERN_AUTHORS_NEW_PAGE = re.compile(
     r"^authors new page=(?P<page>\d+) gs#(?P<game_series_id>\d*) g#(?P<game_id>\d*)$"
 )
+# Коллаж из обложек для страницы списка
+PATTERN_AUTHORS_COLLAGE = re.compile(
+    r"^authors collage page=(?P<page>\d+) gs#(?P<game_series_id>\d*) g#(?P<game_id>\d*)$"
+)
 
 COMMAND_GAME_SERIES_ALL = "game_series"
 PATTERN_GAME_SERIES_REPLY_ALL = re.compile(r"^Серии игр$", flags=re.IGNORECASE)
@@ -49,6 +73,9 @@ PATTERN_GAME_SERIES_PAGE = re.compile(
 PATTERN_GAME_SERIES_NEW_PAGE = re.compile(
     r"^game series new page=(?P<page>\d+) a#(?P<author_id>\d*)$"
 )
+PATTERN_GAME_SERIES_COLLAGE = re.compile(
+    r"^game series collage page=(?P<page>\d+) a#(?P<author_id>\d*)$"
+)
 PATTERN_GAME_SERIES_NEW_CARD = re.compile(r"^game series new #(?P<game_series_id>\d+)$")
 
 COMMAND_GAMES_ALL = "games"
@@ -59,6 +86,9 @@ PATTERN_GAMES_PAGE = re.compile(
 PATTERN_GAMES_NEW_PAGE = re.compile(
     r"^games new page=(?P<page>\d+) a#(?P<author_id>\d*) gs#(?P<game_series_id>\d*)$"
 )
+PATTERN_GAMES_COLLAGE = re.compile(
+    r"^games collage page=(?P<page>\d+) a#(?P<author_id>\d*) gs#(?P<game_series_id>\d*)$"
+)
 
 PATTERN_START_ARGUMENT = re.compile(
     r"^(?P<class_name>[a-zA-Z]+)_(?P<object_id>\d+)_(?P<chat_id>\d+)_(?P<message_id>\d+)$"
@@ -71,3 +101,5 @@ COMMAND_HIDE_REPLY = "hide_reply"
 
 COMMAND_FIND = "find"
 PATTERN_REPLY_FIND = re.compile(r"^Find (?P<text>.+)$", flags=re.IGNORECASE)
+# Страница результатов поиска, query_key - ключ запроса в кэше результатов
+PATTERN_FIND_PAGE = re.compile(r"^find page=(?P<page>\d+) q#(?P<query_key>[0-9a-f]+)$")
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "ipetrash"
+
+
+import hashlib
+import threading
+import time
+
+from collections import OrderedDict
+from typing import NamedTuple
+
+from config import SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL_SECS
+from bot.catalog import Catalog, get_catalog
+from bot.db import Cover, casefold
+from bot.uploader import SingleFlight
+
+
+def normalize_query(text: str | None) -> str:
+    # Регистр и повторяющиеся пробелы на результат не влияют
+    return " ".join(casefold(text or "").split())
+
+
+def get_query_key(query: str) -> str:
+    # Короткий ключ запроса для callback_data, сам запрос туда может не поместиться
+    return hashlib.sha1(query.encode("utf-8")).hexdigest()[:12]
+
+
+class SearchResult(NamedTuple):
+    query: str
+    version: int
+    cover_ids: tuple[int, ...]
+    # Точных совпадений нет, найдены похожие обложки
+    is_fuzzy: bool
+    expires_at: float
+
+
+class SearchCache:
+    """
+    Результаты поиска обложек (id в порядке Cover.find) по нормализованному запросу.
+    Если точных совпадений нет, то результат - похожие обложки по убыванию похожести.
+    По ключу запроса результат берется для страниц, что открываются кнопками пагинатора.
+    Результат устаревает через ttl_secs или после перезагрузки каталога (по версии его снимка
+    в памяти, без запросов к базе), тогда поиск выполняется заново по сохраненному запросу.
+    Похожие обложки ищутся в том же снимке, с чьей версией сохраняется результат. Одинаковые запросы,
+    пришедшие одновременно, ищутся один раз.
+    Давно не использованные запросы удаляются, когда их больше max_size
+    """
+
+    def __init__(
+        self,
+        max_size: int = SEARCH_CACHE_SIZE,
+        ttl_secs: float = SEARCH_CACHE_TTL_SECS,
+    ):
+        self.max_size = max_size
+        self.ttl_secs = ttl_secs
+
+        self._lock = threading.Lock()
+        # Ключ запроса -> результат
+        self._items: OrderedDict[str, SearchResult] = OrderedDict()
+        self._single_flight = SingleFlight()
+
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.computes = 0
+        self.fuzzy_computes = 0
+        self.total_compute_ms = 0.0
+        self.last_compute_ms = 0.0
+
+    def _compute(self, key: str, query: str, catalog: Catalog) -> SearchResult:
+        t = time.perf_counter()
+        cover_ids = tuple(cover.id for cover in Cover.find(query))
+        is_fuzzy = False
+        if not cover_ids and query:
+            cover_ids = tuple(cover.id for cover in catalog.find_similar(query))
+            is_fuzzy = bool(cover_ids)
+        elapsed_ms = (time.perf_counter() - t) * 1000
+
+        result = SearchResult(
+            query=query,
+            version=catalog.version,
+            cover_ids=cover_ids,
+            is_fuzzy=is_fuzzy,
+            expires_at=time.monotonic() + self.ttl_secs,
+        )
+
+        with self._lock:
+            self.computes += 1
+            self.fuzzy_computes += is_fuzzy
+            self.total_compute_ms += elapsed_ms
+            self.last_compute_ms = elapsed_ms
+
+            self._items[key] = result
+            self._items.move_to_end(key)
+
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+        return result
+
+    def _get(self, key: str, query: str) -> SearchResult:
+        catalog = get_catalog()
+        version = catalog.version
+
+        with self._lock:
+            item = self._items.get(key)
+            if item and item.version == version and item.expires_at > time.monotonic():
+                self._items.move_to_end(key)
+                self.hits += 1
+                return item
+
+            self.misses += 1
+            if item:
+                self.expired += 1
+
+        return self._single_flight.do(
+            (key, version),
+            lambda: self._compute(key, query, catalog),
+        )
+
+    def search(self, text: str) -> tuple[str, SearchResult]:
+        """
+        Вернет ключ запроса и результат поиска
+        """
+
+        query = normalize_query(text)
+        key = get_query_key(query)
+        return key, self._get(key, query)
+
+    def get_by_key(self, key: str) -> SearchResult | None:
+        with self._lock:
+            item = self._items.get(key)
+
+        return self._get(key, item.query) if item else None
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def get_metrics(self) -> dict[str, int | float]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "items": len(self._items),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / total, 3) if total else 0.0,
+                "expired": self.expired,
+                "computes": self.computes,
+                "fuzzy_computes": self.fuzzy_computes,
+                "last_compute_ms": round(self.last_compute_ms, 1),
+                "avg_compute_ms": (
+                    round(self.total_compute_ms / self.computes, 1) if self.computes else 0.0
+                ),
+            }
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+
+search_cache = SearchCache()
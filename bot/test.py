@@ -4,24 +4,85 @@
 __author__ = "ipetrash"
 
 
+import contextlib
 import datetime as DT
+import io
+import json
 import re
+import tempfile
+import threading
+import time
 import unittest
-from typing import Type, Iterable, List
+import unittest.mock
+from array import array
+from pathlib import Path
+from typing import Type, Iterable, Iterator, List
 
-from peewee import Field
+from peewee import Field, SqliteDatabase, fn
+from PIL import Image
 
 from bot import regexp_patterns as P
-from config import DEFAULT_AUTHOR_ID
+import telegram
+from telegram.error import BadRequest, NetworkError, RetryAfter
+
+from bot import catalog as catalog_module
+from bot import commands
+from bot import uploader
+from bot.activity import ActivityTracker
+from bot.assets import AssetRegistry, asset_registry
+from bot.cards import CardCache, CHAT_ID_PLACEHOLDER, MESSAGE_ID_PLACEHOLDER
+from bot.catalog import Catalog, intersect_positions
+from bot.collages import CollageRenderer
+from bot.common import (
+    get_keyboard_fingerprint,
+    get_paginator_markup,
+    is_equal_inline_keyboards,
+    split_into_pages,
+)
+from config import DEFAULT_AUTHOR_ID, FILE_NAME_DUMP, MAX_MESSAGE_LENGTH
+from bot.debug import db_stats
+from bot.derivatives import DerivativeCache, make_derivative
+from bot.fuzzy import FuzzyIndex, get_words, get_trigrams, get_similarity
+from bot.migrations import migrate, get_version
+from bot.search import SearchCache, normalize_query, get_query_key
+from bot.uploader import CoverUploader, ServerFileIdWriter, SingleFlight, TokenBucket
 from bot.db import (
+    catalog_db,
+    catalog_write_db,
+    telemetry_db,
+    CATALOG_MODELS,
+    CATALOG_MIGRATIONS,
+    TELEMETRY_MODELS,
+    CoverIndex,
     GameSeries,
     Game,
     Author,
     Cover,
     BaseModel,
+    CatalogStatistic,
+    TgUser,
+    TgChat,
+    UploadJob,
+    MediaAsset,
+    ImportCheckpoint,
     NotDefinedParameterException,
+    casefold,
+    get_catalog_version,
+    bump_catalog_version,
+)
+from data_vk.fill_db import (
+    DUMP_MODELS,
+    UNUSED_DUMP_FIELDS,
+    convert_to_jsonl,
+    fill,
+    get_dump_key,
+    import_files,
+    index_new_dumps,
+    iter_dump_items,
+    iter_dump_lines,
+    iter_dumps,
+    read_dump,
 )
-
 
 DEBUG = False
 
@@ -67,7 +128,11 @@ class TestRegexpPatterns(unittest.TestCase):
             )
 
         with self.subTest("Max"):
-            for pattern in (P.PATTERN_AUTHORS_PAGE, P.PATTERN_AUTHORS_NEW_PAGE):
+            for pattern in (
+                P.PATTERN_AUTHORS_PAGE,
+                P.PATTERN_AUTHORS_NEW_PAGE,
+                P.PATTERN_AUTHORS_COLLAGE,
+            ):
                 self.do_check_callback_data_value(
                     pattern,
                     self.MAX_PAGE, self.MAX_ID_DB, self.MAX_ID_DB
@@ -91,6 +156,37 @@ class TestRegexpPatterns(unittest.TestCase):
                     self.MAX_PAGE, self.MAX_ID, self.MAX_ID_DB, self.MAX_ID_DB
                 )
 
+    def test_pattern_cover_album_page(self):
+        with self.subTest("Nulls"):
+            self.assertEqual(
+                "album page=1 a# gs# g#",
+                P.fill_string_pattern(P.PATTERN_COVER_ALBUM_PAGE, 1, None, None, None),
+            )
+            self.assertEqual(
+                "album new page=1 a# gs# g#",
+                P.fill_string_pattern(P.PATTERN_COVER_ALBUM_NEW_PAGE, 1, None, None, None),
+            )
+
+        with self.subTest("Max"):
+            for pattern in (P.PATTERN_COVER_ALBUM_PAGE, P.PATTERN_COVER_ALBUM_NEW_PAGE):
+                self.do_check_callback_data_value(
+                    pattern,
+                    self.MAX_PAGE, self.MAX_ID, self.MAX_ID_DB, self.MAX_ID_DB
+                )
+
+    def test_pattern_cover_near_page(self):
+        with self.subTest("Nulls"):
+            self.assertEqual(
+                "covers page=1 >c#1 a# gs# g#",
+                P.fill_string_pattern(P.PATTERN_COVER_NEAR_PAGE, 1, ">", 1, None, None, None),
+            )
+
+        with self.subTest("Max"):
+            self.do_check_callback_data_value(
+                P.PATTERN_COVER_NEAR_PAGE,
+                self.MAX_PAGE, "<", self.MAX_ID_DB, self.MAX_ID, self.MAX_ID_DB, self.MAX_ID_DB
+            )
+
     def test_pattern_game_series_page(self):
         with self.subTest("Nulls"):
             self.assertEqual(
@@ -103,7 +199,11 @@ class TestRegexpPatterns(unittest.TestCase):
             )
 
         with self.subTest("Max"):
-            for pattern in (P.PATTERN_GAME_SERIES_PAGE, P.PATTERN_GAME_SERIES_NEW_PAGE):
+            for pattern in (
+                P.PATTERN_GAME_SERIES_PAGE,
+                P.PATTERN_GAME_SERIES_NEW_PAGE,
+                P.PATTERN_GAME_SERIES_COLLAGE,
+            ):
                 self.do_check_callback_data_value(
                     pattern,
                     self.MAX_PAGE, self.MAX_ID
@@ -127,7 +227,11 @@ class TestRegexpPatterns(unittest.TestCase):
             )
 
         with self.subTest("Max"):
-            for pattern in (P.PATTERN_GAMES_PAGE, P.PATTERN_GAMES_NEW_PAGE):
+            for pattern in (
+                P.PATTERN_GAMES_PAGE,
+                P.PATTERN_GAMES_NEW_PAGE,
+                P.PATTERN_GAMES_COLLAGE,
+            ):
                 self.do_check_callback_data_value(
                     pattern,
                     self.MAX_PAGE, self.MAX_ID, self.MAX_ID_DB
@@ -143,6 +247,12 @@ class TestRegexpPatterns(unittest.TestCase):
             self.MAX_ID,
         )
 
+    def test_pattern_find_page(self):
+        self.assertEqual(
+            "find page=1 q#abc", P.fill_string_pattern(P.PATTERN_FIND_PAGE, 1, "abc")
+        )
+        self.do_check_callback_data_value(P.PATTERN_FIND_PAGE, self.MAX_PAGE, "f" * 12)
+
     def test_pattern_find(self):
         text = " крутой Семён!"
 
@@ -198,6 +308,385 @@ class TestDb(unittest.TestCase):
                 assert cls.get_last() == (items[-1] if items else None)
 
 
+class TestDbDatabases(unittest.TestCase):
+    def test_models(self):
+        self.assertEqual([MediaAsset, TgChat, TgUser, UploadJob], TELEMETRY_MODELS)
+        self.assertEqual(
+            sorted(BaseModel.get_inherited_models() + [CoverIndex], key=lambda x: x.__name__),
+            sorted(CATALOG_MODELS + TELEMETRY_MODELS, key=lambda x: x.__name__),
+        )
+        for model in CATALOG_MODELS:
+            with self.subTest(model=model.__name__):
+                self.assertIs(catalog_db, model._meta.database)
+
+        for model in TELEMETRY_MODELS:
+            with self.subTest(model=model.__name__):
+                self.assertIs(telemetry_db, model._meta.database)
+
+    def test_catalog_read_only(self):
+        cover = Cover.get_first()
+        with self.assertRaises(Exception):
+            Cover.update(text=cover.text).where(Cover.id == cover.id).execute()
+
+        # Изменение server_file_id идет через отдельное соединение на запись
+        Cover.set_server_file_id(cover.id, cover.server_file_id)
+        self.assertEqual(cover.server_file_id, cover.get_new().server_file_id)
+
+        # Режим WAL включен соединением на запись и виден из соединения только на чтение
+        self.assertNotIn("journal_mode", catalog_db._pragmas)
+        self.assertEqual("wal", catalog_db.execute_sql("PRAGMA journal_mode").fetchone()[0])
+
+    def test_catalog_write_from_threads(self):
+        covers = list(Cover.select().limit(8))
+
+        errors = []
+
+        def set_server_file_ids():
+            try:
+                for cover in covers:
+                    Cover.set_server_file_ids({cover.id: cover.server_file_id})
+            except Exception as e:
+                errors.append(e)
+
+        # Потоки пишут через одно соединение по очереди
+        threads = [threading.Thread(target=set_server_file_ids) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([], errors)
+
+        for cover in covers:
+            self.assertEqual(cover.server_file_id, cover.get_new().server_file_id)
+
+
+class TestMigrations(unittest.TestCase):
+    def test_migrate(self):
+        database = SqliteDatabase(":memory:")
+
+        def create_table_a(database):
+            database.execute_sql("CREATE TABLE a (id INTEGER PRIMARY KEY)")
+
+        def create_table_b(database):
+            database.execute_sql("CREATE TABLE b (id INTEGER PRIMARY KEY)")
+
+        def broken(database):
+            database.execute_sql("CREATE TABLE c (id INTEGER PRIMARY KEY)")
+            raise Exception("Ошибка миграции")
+
+        self.assertEqual(0, get_version(database))
+        self.assertEqual(["create_table_a"], migrate(database, [create_table_a]))
+        self.assertEqual(1, get_version(database))
+
+        # Уже примененные миграции не применяются повторно
+        self.assertEqual([], migrate(database, [create_table_a]))
+        self.assertEqual(["create_table_b"], migrate(database, [create_table_a, create_table_b]))
+        self.assertEqual(2, get_version(database))
+
+        # Ошибка откатывает и миграцию, и ее версию
+        with self.assertRaises(Exception):
+            migrate(database, [create_table_a, create_table_b, broken])
+        self.assertEqual(2, get_version(database))
+        self.assertNotIn("c", database.get_tables())
+
+
+class TestFillDb(unittest.TestCase):
+    @staticmethod
+    @contextlib.contextmanager
+    def temp_db() -> Iterator[Path]:
+        with tempfile.TemporaryDirectory() as dir_name:
+            database = SqliteDatabase(Path(dir_name) / "database.sqlite")
+            database.register_function(casefold)
+
+            with database.bind_ctx(CATALOG_MODELS):
+                database.create_tables(CATALOG_MODELS)
+
+                # Без вывода переименований авторов
+                with contextlib.redirect_stdout(io.StringIO()):
+                    yield Path(dir_name)
+
+            database.close()
+
+    @staticmethod
+    def dump_tables() -> dict[str, list[tuple]]:
+        rows_by_table = dict()
+        for model in DUMP_MODELS + [CatalogStatistic]:
+            # Id строк статистики зависят от порядка пересчета
+            fields = [
+                field for field in model._meta.sorted_fields
+                if model is not CatalogStatistic or field.name != "id"
+            ]
+            rows_by_table[model._meta.table_name] = list(
+                model.select(*fields).order_by(*fields).tuples()
+            )
+
+        rows_by_table["coverindex"] = list(
+            CoverIndex.select(
+                CoverIndex.rowid,
+                CoverIndex.text,
+                CoverIndex.game,
+                CoverIndex.series,
+                CoverIndex.authors,
+            ).order_by(CoverIndex.rowid).tuples()
+        )
+
+        return rows_by_table
+
+    def fill_and_dump(self, dumps: list[dict], bulk: bool) -> dict[str, list[tuple]]:
+        with self.temp_db():
+            fill(dumps, bulk=bulk)
+            return self.dump_tables()
+
+    def test_iter_dumps(self):
+        with open(FILE_NAME_DUMP, encoding="utf-8") as f:
+            expected = json.load(f)
+        for dump in expected:
+            for name in UNUSED_DUMP_FIELDS:
+                dump.pop(name, None)
+
+        # Маленький размер куска, чтобы объекты разбирались на границах чтения
+        self.assertEqual(expected, list(iter_dumps(FILE_NAME_DUMP, chunk_size=100)))
+        self.assertEqual(expected, list(iter_dumps(FILE_NAME_DUMP)))
+
+    def test_iter_dump_items(self):
+        dumps = [
+            dict(post_id=2, photo_file_name="2_1.jpg", cover_text="Обложка"),
+            dict(post_id=1, photo_file_name="1_1.jpg", cover_text="Ёж\r\n", post_text="Текст"),
+        ]
+
+        with tempfile.TemporaryDirectory() as dir_name:
+            file_name = Path(dir_name) / "dump.json"
+            with open(file_name, "w", encoding="utf-8", newline="") as f:
+                f.write("[\r\n  ")
+                f.write(",\r\n  ".join(json.dumps(dump, ensure_ascii=False) for dump in dumps))
+                f.write("\r\n]")
+
+            jsonl_file_name = Path(dir_name) / "dump.jsonl"
+            with open(jsonl_file_name, "w", encoding="utf-8") as f:
+                for dump in dumps:
+                    f.write(json.dumps(dump, ensure_ascii=False) + "\n\n")
+
+            dumps[1].pop("post_text")
+
+            for file_name, items in [
+                (file_name, iter_dump_items(file_name, chunk_size=10)),
+                (jsonl_file_name, iter_dump_lines(jsonl_file_name)),
+            ]:
+                with self.subTest(file_name=file_name.name):
+                    items = list(items)
+                    self.assertEqual(dumps, [dump for _, dump in items])
+
+                    # По месту в файле читается та же запись
+                    with open(file_name, "rb") as f:
+                        for position, dump in items:
+                            self.assertEqual(dump, read_dump(f, position))
+
+    def test_bulk_equals_row_by_row(self):
+        dumps = list(iter_dumps(FILE_NAME_DUMP))
+
+        bulk = self.fill_and_dump(dumps, bulk=True)
+        row_by_row = self.fill_and_dump(dumps, bulk=False)
+
+        for table_name, rows in row_by_row.items():
+            with self.subTest(table_name=table_name):
+                self.assertTrue(rows)
+                self.assertEqual(rows, bulk[table_name])
+
+    def test_delta(self):
+        dumps = sorted(iter_dumps(FILE_NAME_DUMP), key=get_dump_key)
+        expected = self.fill_and_dump(dumps, bulk=True)
+
+        def append_lines(file_name: Path, dumps: list[dict], last_line_end: str = "\n"):
+            with open(file_name, "a", encoding="utf-8") as f:
+                lines = [json.dumps(dump, ensure_ascii=False) for dump in dumps]
+                f.write("\n".join(lines) + last_line_end)
+
+        with self.temp_db() as dir_name:
+            file_name = dir_name / "dump.jsonl"
+
+            middle = len(dumps) // 2
+            append_lines(file_name, dumps[:middle])
+            self.assertEqual(middle, import_files([file_name]))
+
+            # Последняя строка еще не дописана, поэтому пока не импортируется
+            append_lines(file_name, dumps[middle:], last_line_end="")
+            self.assertEqual(len(dumps) - middle - 1, import_files([file_name], delta=True))
+
+            append_lines(file_name, [], last_line_end="\n")
+            self.assertEqual(1, import_files([file_name], delta=True))
+            self.assertEqual(0, import_files([file_name], delta=True))
+
+            checkpoint = ImportCheckpoint.get_for(file_name)
+            self.assertEqual(file_name.stat().st_size, checkpoint.offset)
+            self.assertEqual(get_dump_key(dumps[-1]), checkpoint.get_last_key())
+
+            actual = self.dump_tables()
+
+        for table_name, rows in expected.items():
+            with self.subTest(table_name=table_name):
+                self.assertEqual(rows, actual[table_name])
+
+        # Для JSON-массива отметка - только последняя запись
+        with self.temp_db():
+            self.assertEqual(len(dumps), import_files([FILE_NAME_DUMP], delta=True))
+            self.assertEqual(0, import_files([FILE_NAME_DUMP], delta=True))
+
+
+    def test_delta_keys(self):
+        def make_dump(post_id: int, photo_number: int) -> dict:
+            return dict(post_id=post_id, photo_file_name=f"images\\{post_id}_{photo_number}.jpg")
+
+        with tempfile.TemporaryDirectory() as dir_name:
+            file_name = Path(dir_name) / "dump.jsonl"
+
+            def append_lines(dumps: list[dict]):
+                with open(file_name, "a", encoding="utf-8") as f:
+                    for dump in dumps:
+                        f.write(json.dumps(dump) + "\n")
+
+            # Номер картинки сравнивается как число
+            append_lines([make_dump(10, 9), make_dump(10, 10)])
+            self.assertEqual((10, 10), get_dump_key(make_dump(10, 10)))
+
+            index, last_key, offset, out_of_order_keys = index_new_dumps(file_name)
+            self.assertEqual([(10, 9), (10, 10)], [key for key, _ in index])
+            self.assertEqual((10, 10), last_key)
+            self.assertEqual([], out_of_order_keys)
+
+            # Дописанные не по порядку записи не теряются, а импортируются и отмечаются
+            append_lines([make_dump(5, 1), make_dump(11, 1)])
+            index, last_key, offset, out_of_order_keys = index_new_dumps(file_name, last_key, offset)
+            self.assertEqual([(5, 1), (11, 1)], [key for key, _ in index])
+            self.assertEqual((11, 1), last_key)
+            self.assertEqual([(5, 1)], out_of_order_keys)
+            self.assertEqual(file_name.stat().st_size, offset)
+
+            # Перезаписанный файл читается с начала, а новые записи ищутся по отметке
+            file_name.write_text("")
+            append_lines([make_dump(5, 1), make_dump(11, 1), make_dump(11, 2)])
+            index, last_key, offset, out_of_order_keys = index_new_dumps(file_name, last_key, 10**6)
+            self.assertEqual([(11, 2)], [key for key, _ in index])
+            self.assertEqual([], out_of_order_keys)
+
+
+    def test_convert_to_jsonl(self):
+        dumps = [
+            dict(post_id=post_id, photo_file_name=f"images\\{post_id}_1.jpg", post_text="Текст")
+            for post_id in [3, 1, 4, 2]
+        ]
+
+        with tempfile.TemporaryDirectory() as dir_name:
+            file_name = Path(dir_name) / "dump.json"
+            with open(file_name, "w", encoding="utf-8") as f:
+                json.dump(dumps, f, ensure_ascii=False, indent=4)
+
+            # Уже импортированы записи до (2, 1), они переносятся в начало файла
+            jsonl_file_name = Path(dir_name) / "dump.jsonl"
+            offset = convert_to_jsonl(file_name, jsonl_file_name, last_key=(2, 1))
+
+            with open(jsonl_file_name, encoding="utf-8") as f:
+                self.assertEqual(
+                    [dumps[1], dumps[3], dumps[0], dumps[2]],
+                    [json.loads(line) for line in f],
+                )
+
+            # После конвертации читаются только новые строки
+            index, last_key, new_offset, out_of_order_keys = index_new_dumps(
+                jsonl_file_name, (2, 1), offset
+            )
+            self.assertEqual([(3, 1), (4, 1)], [key for key, _ in index])
+            self.assertEqual((4, 1), last_key)
+            self.assertEqual(jsonl_file_name.stat().st_size, new_offset)
+            self.assertEqual([], out_of_order_keys)
+            self.assertEqual(4, len(list(iter_dump_lines(jsonl_file_name))))
+
+class TestDbQueryPlans(unittest.TestCase):
+    # Например: "SCAN t1", но не "SCAN t1 USING COVERING INDEX cover_date_time"
+    PATTERN_FULL_SCAN = re.compile(r"^SCAN (\w+)$")
+
+    def get_query_plan(self, query) -> list[str]:
+        sql, params = query.sql()
+        cursor = catalog_db.execute_sql(f"EXPLAIN QUERY PLAN {sql}", params)
+        return [row[-1] for row in cursor]
+
+    def assert_no_full_scan(self, query):
+        plan = self.get_query_plan(query)
+        for line in plan:
+            self.assertIsNone(self.PATTERN_FULL_SCAN.match(line), plan)
+
+    def test_schema_version(self):
+        self.assertEqual(len(CATALOG_MIGRATIONS), get_version(catalog_write_db))
+
+    def test_cover_order_index(self):
+        index_names = [row[1] for row in catalog_write_db.execute_sql("PRAGMA index_list(cover)")]
+        self.assertIn("cover_date_time_id", index_names)
+
+        query = Cover.select(Cover.id).order_by(*Cover.get_order_by())
+        self.assertEqual(
+            ["SCAN t1 USING COVERING INDEX cover_date_time_id"], self.get_query_plan(query)
+        )
+
+    def test_cover_filters(self):
+        for cover_filters in [
+            dict(),
+            dict(by_author=3917270),
+            dict(by_game_series=26),
+            dict(by_game=32),
+            dict(by_author=3917270, by_game_series=26, by_game=32),
+        ]:
+            with self.subTest(**cover_filters):
+                filters = Cover.get_filters(**cover_filters)
+
+                query = Cover.select(Cover.id).order_by(*Cover.get_order_by()).paginate(2, 1)
+                if filters:
+                    query = query.where(*filters)
+                self.assert_no_full_scan(query)
+
+                # Как в Cover.count_by
+                query = Cover.select(fn.COUNT(Cover.id))
+                if filters:
+                    query = query.where(*filters)
+                self.assert_no_full_scan(query)
+
+    def test_paginating(self):
+        for model, all_filters in [
+            (Author, [dict(), dict(by_game_series=26), dict(by_game=32)]),
+            (GameSeries, [dict(), dict(by_author=3917270)]),
+            (Game, [dict(), dict(by_author=3917270), dict(by_game_series=26)]),
+        ]:
+            for filters in all_filters:
+                with self.subTest(model=model.__name__, **filters):
+                    for query in [model.select(), model.select_with_number_of_covers()]:
+                        query = model._paginate(
+                            query=query,
+                            page=2,
+                            order_by=model.name.asc(),
+                            filters=model.get_filters(**filters),
+                        )
+                        self.assert_no_full_scan(query)
+
+
+class TestDbCatalogStatistic(unittest.TestCase):
+    def test_is_actual(self):
+        self.assertTrue(CatalogStatistic.is_actual())
+
+    def test_check(self):
+        self.assertEqual([], CatalogStatistic.check())
+
+    def test_get_for(self):
+        for obj in [Author.get_first(), GameSeries.get_first(), Game.get_first()]:
+            with self.subTest(obj=obj):
+                statistic = CatalogStatistic.get_for(obj)
+                self.assertEqual(obj.__class__.__name__, statistic.class_name)
+                self.assertEqual(obj.id, statistic.object_id)
+                self.assertTrue(statistic.number_of_covers)
+
+        with self.subTest("Not exists"):
+            statistic = CatalogStatistic.get_for(Author(id=-1))
+            self.assertEqual(0, statistic.number_of_covers)
+
+
 class TestDbPaginating(unittest.TestCase):
     def _utils_test_paginating(
         self, model: Type[BaseModel], order_by: Field = None, filters: Iterable = None
@@ -269,6 +758,28 @@ class TestDbPaginating(unittest.TestCase):
         ]
         self._utils_run_testing_for(Cover, filters)
 
+    def test_paginating_with_number_of_covers(self):
+        for model, filters in [
+            (Author, None),
+            (Author, Author.get_filters(by_game_series=26)),
+            (GameSeries, None),
+            (GameSeries, GameSeries.get_filters(by_author=DEFAULT_AUTHOR_ID)),
+            (Game, None),
+            (Game, Game.get_filters(by_author=3917270)),
+        ]:
+            for page in [1, 2, 10]:
+                with self.subTest(model=model, filters=filters, page=page):
+                    objects = model.paginating(
+                        page=page, order_by=model.name.asc(), filters=filters
+                    )
+                    items = model.paginating_with_number_of_covers(
+                        page=page, order_by=model.name.asc(), filters=filters
+                    )
+                    self.assertEqual(objects, [obj for obj, _ in items])
+
+                    for obj, number_of_covers in items:
+                        self.assertEqual(obj.get_number_of_covers(), number_of_covers)
+
     def test_Cover_get_by_page(self):
         def _get_items(page: int = 1, **kwargs) -> List[Cover]:
             items = []
@@ -471,6 +982,852 @@ class TestDbCover(unittest.TestCase):
             )
 
 
+class TestDbCoverGetPage(unittest.TestCase):
+    def test_get_page_all_filters(self):
+        author = Author.get_by_id(3917270)
+        game_series = GameSeries.get_by_id(26)
+        game = Game.get_by_id(32)
+
+        for by_author in [None, author, DEFAULT_AUTHOR_ID]:
+            for by_game_series in [None, game_series]:
+                for by_game in [None, game]:
+                    cover_filters = dict(
+                        by_author=by_author,
+                        by_game_series=by_game_series,
+                        by_game=by_game,
+                    )
+                    with self.subTest(**cover_filters):
+                        query = Cover.select(Cover.id).order_by(*Cover.get_order_by())
+                        filters = Cover.get_filters(**cover_filters)
+                        if filters:
+                            query = query.where(*filters)
+
+                        for page, cover in enumerate(query, 1):
+                            self.assertEqual(
+                                page,
+                                Cover.get_page(need_cover_id=cover.id, **cover_filters),
+                            )
+                            self.assertEqual(
+                                cover,
+                                Cover.get_by_page(page=page, **cover_filters),
+                            )
+
+    def test_get_page_by_every_author(self):
+        # Номера считаются запросами в базу, а не по загруженному каталогу
+        with unittest.mock.patch.object(catalog_module, "_catalog", None):
+            for author in Author.select():
+                with self.subTest(author=author.id):
+                    query = (
+                        Cover.select(Cover.id)
+                        .where(*Cover.get_filters(by_author=author))
+                        .order_by(*Cover.get_order_by())
+                    )
+                    self.assertEqual(
+                        list(range(1, query.count() + 1)),
+                        [Cover.get_page(cover.id, by_author=author) for cover in query],
+                    )
+
+    def test_get_page_not_found(self):
+        with self.assertRaises(Exception):
+            Cover.get_page(need_cover_id=-1)
+
+        cover = Cover.get_first()
+        with self.assertRaises(Exception):
+            Cover.get_page(need_cover_id=cover.id, filters=[Cover.id != cover.id])
+
+
+class TestDbCoverPrefetched(unittest.TestCase):
+    def test_number_of_queries(self):
+        cover_id = Cover.get_by_page(page=10).id
+
+        for title, get_cover in [
+            ("get_by_id_prefetched", lambda: Cover.get_by_id_prefetched(cover_id)),
+            ("get_by_page", lambda: Cover.get_by_page(page=10)),
+            ("get_by_page + filters", lambda: Cover.get_by_page(page=2, by_game_series=26)),
+        ]:
+            with self.subTest(title):
+                db_stats.start_timer()
+
+                cover = get_cover()
+                self.assertTrue(cover.game.name)
+                self.assertTrue(cover.game.series_name)
+                self.assertTrue(cover.game.series.id is not None)
+                self.assertTrue([a.name for a in cover.get_authors()])
+
+                self.assertLessEqual(db_stats.number_of_queries, 2)
+
+    def test_get_authors(self):
+        for cover in Cover.select().order_by(Cover.id).limit(50):
+            with self.subTest(cover_id=cover.id):
+                self.assertEqual(
+                    cover.get_authors(),
+                    Cover.get_by_id_prefetched(cover.id).get_authors(),
+                )
+
+
+class TestDbCoverFind(unittest.TestCase):
+    def test_find_empty(self):
+        self.assertEqual(Cover.find(""), [])
+        self.assertEqual(Cover.find(None), [])
+
+    def test_find_case_insensitive(self):
+        for text in ["Печкин", "Postal", "Grand Theft Auto", "Пе"]:
+            with self.subTest(text=text):
+                covers = Cover.find(text)
+                self.assertTrue(covers)
+                self.assertEqual(covers, Cover.find(text.upper()))
+                self.assertEqual(covers, Cover.find(text.lower()))
+
+    def test_find_order(self):
+        covers = Cover.find("Grand Theft Auto")
+        self.assertEqual(covers, sorted(covers, key=lambda x: x.id))
+
+    def test_find_quotes(self):
+        for text in ['"', '""', '"Печкин', "'", "a\"b"]:
+            with self.subTest(text=text):
+                self.assertIsInstance(Cover.find(text), list)
+
+
+class TestCatalog(unittest.TestCase):
+    catalog: Catalog = None
+
+    @classmethod
+    def setUpClass(cls):
+        cls.catalog = Catalog.load()
+
+    def test_counts(self):
+        self.assertEqual(len(self.catalog.covers), Cover.count())
+        self.assertEqual(len(self.catalog.games), Game.count())
+        self.assertEqual(len(self.catalog.game_series), GameSeries.count())
+        self.assertEqual(len(self.catalog.authors), Author.count())
+
+    def test_covers(self):
+        for page, cover in enumerate(Cover.select().order_by(*Cover.get_order_by()), 1):
+            with self.subTest(cover_id=cover.id):
+                record = self.catalog.get_by_page(page)
+                self.assertEqual(cover.id, record.id)
+                self.assertEqual(cover.text, record.text)
+                self.assertEqual(cover.date_time, record.date_time)
+                self.assertEqual(cover.server_file_id, self.catalog.get_server_file_id(record.id))
+                self.assertEqual(cover.game_id, record.game.id)
+                self.assertEqual(
+                    [a.id for a in cover.get_authors()],
+                    [a.id for a in record.get_authors()],
+                )
+
+    def test_statistic(self):
+        for model, records in [
+            (Author, self.catalog.authors),
+            (GameSeries, self.catalog.game_series),
+            (Game, self.catalog.games),
+        ]:
+            for record in records:
+                with self.subTest(model=model.__name__, id=record.id):
+                    statistic = CatalogStatistic.get_for(model.get_by_id(record.id))
+                    for name in CatalogStatistic.FIELDS_BY_MODEL[model]:
+                        self.assertEqual(getattr(statistic, name), getattr(record, name))
+
+    def test_covers_by_filters(self):
+        for cover_filters in [
+            dict(),
+            dict(by_author=3917270),
+            dict(by_game_series=26),
+            dict(by_game=32),
+            dict(by_author=DEFAULT_AUTHOR_ID, by_game_series=26),
+            dict(by_author=3917270, by_game_series=26, by_game=32),
+            dict(by_author=-1),
+        ]:
+            with self.subTest(**cover_filters):
+                query = Cover.select(Cover.id).order_by(*Cover.get_order_by())
+                filters = Cover.get_filters(**cover_filters)
+                if filters:
+                    query = query.where(*filters)
+                cover_ids = [cover.id for cover in query]
+
+                self.assertEqual(len(cover_ids), self.catalog.count_by(**cover_filters))
+                self.assertEqual(
+                    cover_ids,
+                    [cover.id for cover in self.catalog.get_covers(**cover_filters)],
+                )
+
+                for page, cover_id in enumerate(cover_ids, 1):
+                    self.assertEqual(page, self.catalog.get_page(cover_id, **cover_filters))
+
+                    next_cover_id = cover_ids[page % len(cover_ids)]
+                    self.assertEqual(
+                        next_cover_id, self.catalog.get_near(cover_id, **cover_filters).id
+                    )
+
+                    prev_cover_id = cover_ids[page - 2]
+                    self.assertEqual(
+                        prev_cover_id,
+                        self.catalog.get_near(cover_id, reverse=True, **cover_filters).id,
+                    )
+
+                self.assertIsNone(
+                    self.catalog.get_by_page(len(cover_ids) + 1, **cover_filters)
+                )
+
+    def test_get_page_not_found(self):
+        with self.assertRaises(Exception):
+            self.catalog.get_page(need_cover_id=-1)
+
+    def test_lists_by_filters(self):
+        def _get_ids(model: Type[BaseModel], **filters) -> list[int]:
+            query = model.select(model.id).order_by(model.name, model.id)
+            filters = model.get_filters(**filters)
+            if filters:
+                query = query.where(*filters)
+            return [obj.id for obj in query]
+
+        for by_game_series in [None, 26]:
+            for by_game in [None, 32]:
+                with self.subTest(model="Author", by_game_series=by_game_series, by_game=by_game):
+                    self.assertEqual(
+                        _get_ids(Author, by_game_series=by_game_series, by_game=by_game),
+                        [obj.id for obj in self.catalog.get_authors(by_game_series, by_game)],
+                    )
+
+        for by_author in [None, 3917270, DEFAULT_AUTHOR_ID]:
+            with self.subTest(model="GameSeries", by_author=by_author):
+                self.assertEqual(
+                    _get_ids(GameSeries, by_author=by_author),
+                    [obj.id for obj in self.catalog.get_all_game_series(by_author)],
+                )
+
+            for by_game_series in [None, 26]:
+                with self.subTest(model="Game", by_author=by_author, by_game_series=by_game_series):
+                    self.assertEqual(
+                        _get_ids(Game, by_author=by_author, by_game_series=by_game_series),
+                        [obj.id for obj in self.catalog.get_games(by_author, by_game_series)],
+                    )
+
+    def test_paginating(self):
+        items = list(range(10))
+        self.assertEqual([0, 1, 2], Catalog.paginating(items, page=1, items_per_page=3))
+        self.assertEqual([9], Catalog.paginating(items, page=4, items_per_page=3))
+        self.assertEqual([], Catalog.paginating(items, page=5, items_per_page=3))
+
+
+class TestCatalogPositions(unittest.TestCase):
+    def test_intersect_positions(self):
+        for a, b, expected in [
+            ([], [], []),
+            ([1, 2, 3], [], []),
+            ([1, 2, 3], [2, 3, 4], [2, 3]),
+            ([5], [1, 2, 3, 4, 5], [5]),
+            ([0, 10, 20], [1, 11, 21], []),
+            ([0, 2, 4, 6, 8], [1, 2, 3, 8, 9], [2, 8]),
+        ]:
+            with self.subTest(a=a, b=b):
+                a, b = array("I", a), array("I", b)
+                self.assertEqual(array("I", expected), intersect_positions(a, b))
+                self.assertEqual(array("I", expected), intersect_positions(b, a))
+
+    def test_cover_methods(self):
+        # Методы Cover при загруженном каталоге должны возвращать то же, что и запросы в базу
+        all_cover_filters = [
+            dict(),
+            dict(by_author=3917270),
+            dict(by_author=Author.get_by_id(3917270)),
+            dict(by_game_series=26),
+            dict(by_game=32),
+            dict(by_author=DEFAULT_AUTHOR_ID, by_game_series=26),
+            dict(by_author=3917270, by_game_series=26, by_game=32),
+            dict(by_author=-1),
+        ]
+
+        def _get_results(cover_filters: dict) -> tuple:
+            total = Cover.count_by(**cover_filters)
+            covers = [Cover.get_by_page(page, **cover_filters) for page in range(1, total + 2)]
+            pages = [Cover.get_page(cover.id, **cover_filters) for cover in covers if cover]
+            return total, covers, pages
+
+        for cover_filters in all_cover_filters:
+            with self.subTest(**cover_filters):
+                with unittest.mock.patch.object(catalog_module, "_catalog", None):
+                    self.assertIsNone(Cover.get_catalog_positions(**cover_filters))
+                    expected = _get_results(cover_filters)
+
+                with unittest.mock.patch.object(catalog_module, "_catalog", Catalog.load()):
+                    self.assertIsNotNone(Cover.get_catalog_positions(**cover_filters))
+                    self.assertEqual(expected, _get_results(cover_filters))
+
+                    # С произвольными выражениями запрос идет в базу
+                    self.assertIsNone(
+                        Cover.get_catalog_positions(filters=[Cover.id > 0], **cover_filters)
+                    )
+
+                    with self.assertRaises(Exception):
+                        Cover.get_page(need_cover_id=-1, **cover_filters)
+
+
+class TestActivityTracker(unittest.TestCase):
+    USER_ID = -1_000_001
+    CHAT_ID = -1_000_002
+
+    def setUp(self):
+        self.tearDown()
+
+    def tearDown(self):
+        TgUser.delete().where(TgUser.id == self.USER_ID).execute()
+        TgChat.delete().where(TgChat.id == self.CHAT_ID).execute()
+
+    def test_flush(self):
+        tracker = ActivityTracker(flush_max_events=1000)
+
+        user = telegram.User(id=self.USER_ID, first_name="Иван", is_bot=False)
+        chat = telegram.Chat(id=self.CHAT_ID, type="private", first_name="Иван")
+        for _ in range(3):
+            tracker.track(user, chat)
+
+        # До записи в базу количество запросов учитывает накопленные
+        self.assertIsNone(TgUser.get_or_none(TgUser.id == self.USER_ID))
+        self.assertEqual(3, tracker.get_number_requests(TgUser, self.USER_ID))
+        self.assertFalse(tracker.is_first_request(chat))
+        self.assertEqual(3, tracker.get_metrics()["pending_events"])
+
+        self.assertEqual(2, tracker.flush())
+        self.assertEqual(0, tracker.flush())
+        self.assertEqual(0, tracker.get_metrics()["pending_events"])
+        self.assertEqual(3, TgUser.get_by_id(self.USER_ID).number_requests)
+        self.assertEqual(3, TgChat.get_by_id(self.CHAT_ID).number_requests)
+
+        # Повторная запись прибавляет запросы и обновляет профиль
+        user = telegram.User(id=self.USER_ID, first_name="Петр", is_bot=False, username="petr")
+        tracker.track(user, None)
+        self.assertEqual(1, tracker.flush())
+
+        user_db = TgUser.get_by_id(self.USER_ID)
+        self.assertEqual(4, user_db.number_requests)
+        self.assertEqual("Петр", user_db.first_name)
+        self.assertEqual("petr", user_db.username)
+        self.assertEqual(3, TgChat.get_by_id(self.CHAT_ID).number_requests)
+
+    def test_flush_error(self):
+        tracker = ActivityTracker(flush_max_events=1000)
+
+        user = telegram.User(id=self.USER_ID, first_name="Иван", is_bot=False)
+        chat = telegram.Chat(id=self.CHAT_ID, type="private", first_name="Иван")
+        tracker.track(user, chat)
+        tracker.track(user, chat)
+
+        get_upsert_query = tracker._get_upsert_query
+
+        def _get_upsert_query_with_error(model, rows):
+            if model is TgChat:
+                return TgChat.raw("INSERT INTO not_exists VALUES (1)")
+            return get_upsert_query(model, rows)
+
+        with unittest.mock.patch.object(
+            tracker, "_get_upsert_query", side_effect=_get_upsert_query_with_error
+        ):
+            self.assertEqual(0, tracker.flush())
+
+        # Таблицы пишутся одной транзакцией, поэтому не записалось ничего
+        self.assertIn("not_exists", tracker.get_metrics()["last_flush_error"])
+        self.assertIsNone(TgUser.get_or_none(TgUser.id == self.USER_ID))
+        self.assertIsNone(TgChat.get_or_none(TgChat.id == self.CHAT_ID))
+        self.assertEqual(2, tracker.get_number_requests(TgUser, self.USER_ID))
+
+        # Вся пачка вернулась в очередь
+        self.assertEqual(2, tracker.flush())
+        self.assertEqual(2, TgUser.get_by_id(self.USER_ID).number_requests)
+        self.assertEqual(2, TgChat.get_by_id(self.CHAT_ID).number_requests)
+
+    def test_number_requests_while_flushing(self):
+        tracker = ActivityTracker(flush_max_events=1000)
+
+        chat = telegram.Chat(id=self.CHAT_ID, type="private")
+        tracker.track(None, chat)
+        tracker.track(None, chat)
+        tracker.flush()
+        tracker.track(None, chat)
+
+        started = threading.Event()
+        release = threading.Event()
+        execute_atomic = telemetry_db.execute_atomic
+
+        def _execute_atomic(queries):
+            started.set()
+            release.wait(5)
+            execute_atomic(queries)
+
+        numbers = []
+
+        def _get_number_requests():
+            numbers.append(tracker.get_number_requests(TgChat, self.CHAT_ID))
+
+        with unittest.mock.patch.object(telemetry_db, "execute_atomic", side_effect=_execute_atomic):
+            flush_thread = threading.Thread(target=tracker.flush)
+            flush_thread.start()
+            self.assertTrue(started.wait(5))
+
+            # Пачка уже не в очереди, но еще не в базе: чтение дождется конца ее транзакции
+            reader_thread = threading.Thread(target=_get_number_requests)
+            reader_thread.start()
+            tracker.track(None, chat)
+
+            release.set()
+            flush_thread.join()
+            reader_thread.join()
+
+        self.assertEqual([4], numbers)
+        self.assertEqual(3, TgChat.get_by_id(self.CHAT_ID).number_requests)
+        self.assertEqual(4, tracker.get_number_requests(TgChat, self.CHAT_ID))
+
+    def test_flush_by_max_events(self):
+        tracker = ActivityTracker(flush_interval_secs=60, flush_max_events=2)
+        tracker.start()
+        try:
+            chat = telegram.Chat(id=self.CHAT_ID, type="private")
+            tracker.track(None, chat)
+            tracker.track(None, chat)
+
+            for _ in range(50):
+                if tracker.get_metrics()["flushes"]:
+                    break
+                time.sleep(0.1)
+
+            self.assertEqual(2, TgChat.get_by_id(self.CHAT_ID).number_requests)
+        finally:
+            tracker.stop()
+
+    def test_stop(self):
+        tracker = ActivityTracker(flush_interval_secs=60)
+        tracker.start()
+
+        tracker.track(None, telegram.Chat(id=self.CHAT_ID, type="private"))
+        tracker.stop()
+
+        self.assertEqual(1, TgChat.get_by_id(self.CHAT_ID).number_requests)
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test_acquire(self):
+        bucket = TokenBucket(rate=20, capacity=2)
+
+        # Подряд можно взять не больше capacity токенов, а после - по rate в секунду
+        t = time.perf_counter()
+        for _ in range(4):
+            self.assertTrue(bucket.acquire())
+        self.assertGreaterEqual(time.perf_counter() - t, 0.09)
+
+        t = time.perf_counter()
+        bucket.pause(0.2)
+        bucket.acquire()
+        self.assertGreaterEqual(time.perf_counter() - t, 0.19)
+
+        # Ожидание прерывается остановкой
+        stopped = threading.Event()
+        stopped.set()
+        bucket.pause(10)
+        self.assertFalse(bucket.acquire(stopped))
+
+
+class TestCoverUploader(unittest.TestCase):
+    CHAT_ID = -1_000_003
+
+    def setUp(self):
+        self.tearDown()
+
+    def tearDown(self):
+        UploadJob.delete().where(UploadJob.chat_id == self.CHAT_ID).execute()
+
+    def test_start(self):
+        uploader = CoverUploader()
+        job_queue = unittest.mock.MagicMock()
+
+        # Пока задача не завершилась, вторая не запускается
+        self.assertTrue(uploader.start(job_queue, self.CHAT_ID))
+        self.assertFalse(uploader.start(job_queue, self.CHAT_ID))
+        job_queue.run_once.assert_called_once()
+
+        job = UploadJob.get_unfinished()
+        self.assertEqual(self.CHAT_ID, job.chat_id)
+        self.assertEqual(job.id, job_queue.run_once.call_args.kwargs["context"])
+
+    def test_run(self):
+        catalog = Catalog.load()
+        covers = catalog.covers[:5]
+        for cover in catalog.covers:
+            catalog.set_server_file_id(cover.id, None if cover in covers else "file_id")
+
+        # В дампе пути с разделителем из windows
+        for cover in covers:
+            cover.file_name = cover.file_name.replace("\\", "/")
+
+        bot = unittest.mock.MagicMock()
+        errors = [RetryAfter(0.05), NetworkError("Ошибка сети")]
+        sent_file_names = []
+
+        def send_photo(chat_id, photo, **_):
+            if errors:
+                raise errors.pop(0)
+
+            sent_file_names.append(Path(photo.name).name)
+            message = unittest.mock.MagicMock()
+            message.photo = [
+                telegram.PhotoSize(f"{photo.name}_{size}", "", size, size)
+                for size in [90, 320, 800]
+            ]
+            return message
+
+        bot.send_photo.side_effect = send_photo
+        bot.send_message.return_value.message_id = 1
+
+        uploader = CoverUploader(
+            rate_per_sec=1000, save_batch_size=2, progress_interval_secs=0, retry_delay_secs=0.01
+        )
+        job = UploadJob.create(chat_id=self.CHAT_ID)
+
+        with (
+            tempfile.TemporaryDirectory() as dir_name,
+            unittest.mock.patch(
+                "bot.uploader.derivative_cache", DerivativeCache(dir_cache=Path(dir_name))
+            ) as cache,
+            unittest.mock.patch.object(catalog_module, "_catalog", catalog),
+            unittest.mock.patch.object(Cover, "set_server_file_ids") as set_server_file_ids,
+        ):
+            self.assertEqual(len(covers), uploader.run(bot, job), job.error)
+
+            # Загружаются копии, созданные перед загрузкой
+            targets = {cover.id: cache.get_cached(cover.abs_file_name) for cover in covers}
+
+        self.assertEqual(sorted(target.name for target in targets.values()), sorted(sent_file_names))
+        for cover in covers:
+            self.assertEqual(f"{targets[cover.id]}_800", catalog.get_server_file_id(cover.id))
+
+        # file_id записываются пачками
+        saved = dict()
+        for call in set_server_file_ids.call_args_list:
+            batch = call.args[0]
+            self.assertLessEqual(len(batch), 2)
+            saved.update(batch)
+        self.assertEqual({cover.id: catalog.get_server_file_id(cover.id) for cover in covers}, saved)
+
+        self.assertEqual(len(covers), job.number_of_uploaded)
+        self.assertIsNotNone(job.finished_at)
+        self.assertEqual(2, uploader.get_metrics()["retries"])
+
+        # Прогресс показывается одним сообщением, что после редактируется
+        bot.send_message.assert_called_once()
+        self.assertTrue(bot.edit_message_text.called)
+        self.assertIn("Повторов: 2.", bot.edit_message_text.call_args.args[0])
+
+    def test_upload_retry_after(self):
+        catalog = Catalog.load()
+        cover = catalog.covers[0]
+        catalog.set_server_file_id(cover.id, None)
+
+        message = unittest.mock.MagicMock()
+        message.photo = [telegram.PhotoSize("file_id_800", "", 800, 800)]
+
+        bot = unittest.mock.MagicMock()
+        uploader = CoverUploader(rate_per_sec=1000, max_attempts=2, max_retry_after=3)
+        with (
+            unittest.mock.patch("bot.uploader.derivative_cache") as cache,
+            unittest.mock.patch("builtins.open", unittest.mock.mock_open()),
+            unittest.mock.patch.object(
+                uploader.bucket, "acquire", wraps=uploader.bucket.acquire
+            ) as acquire,
+        ):
+            cache.get_for_upload.return_value = cover.abs_file_name
+
+            # Ожидания по RetryAfter не тратят попытки, которых здесь только на одну ошибку сети
+            bot.send_photo.side_effect = [
+                RetryAfter(0.01), NetworkError("Ошибка сети"), RetryAfter(0.01), message
+            ]
+            self.assertEqual("file_id_800", uploader._upload(bot, self.CHAT_ID, catalog, cover))
+            self.assertEqual(3, uploader.get_metrics()["retries"])
+
+            # Удаление сообщения ждет токен так же, как и отправка
+            message.delete.assert_called_once()
+            self.assertEqual(4 + 1, acquire.call_count)
+
+            # Телеграм все время просит подождать, но ожиданий не больше max_retry_after
+            bot.send_photo.reset_mock()
+            bot.send_photo.side_effect = RetryAfter(0.01)
+            with self.assertRaises(RetryAfter):
+                uploader._upload(bot, self.CHAT_ID, catalog, cover)
+
+            self.assertEqual(3, bot.send_photo.call_count)
+
+
+class TestSendCoverPhoto(unittest.TestCase):
+    def test_single_flight(self):
+        single_flight = SingleFlight()
+        calls = []
+        started = threading.Event()
+        release = threading.Event()
+
+        def func() -> int:
+            calls.append(1)
+            started.set()
+            release.wait()
+            return 42
+
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(single_flight.do("key", func)))
+            for _ in range(10)
+        ]
+        threads[0].start()
+        started.wait()
+        for thread in threads[1:]:
+            thread.start()
+
+        # Остальные вызовы ждут первый
+        time.sleep(0.05)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(1, len(calls))
+        self.assertEqual([42] * 10, results)
+        self.assertEqual(0, len(single_flight))
+
+        # Исключение получают все, кто ждал, а следующий вызов выполнится заново
+        def fail():
+            raise ValueError("Ошибка")
+
+        with self.assertRaises(ValueError):
+            single_flight.do("key", fail)
+        self.assertEqual(43, single_flight.do("key", lambda: 43))
+
+    def test_server_file_id_writer(self):
+        writer = ServerFileIdWriter(batch_size=2)
+        with unittest.mock.patch.object(Cover, "set_server_file_ids") as set_server_file_ids:
+            for cover_id in range(1, 6):
+                writer.put(cover_id, f"file_id_{cover_id}")
+
+            # Остановка дожидается записи всего, что было в очереди
+            writer.stop()
+
+        saved = dict()
+        for call in set_server_file_ids.call_args_list:
+            batch = call.args[0]
+            self.assertLessEqual(len(batch), 2)
+            saved.update(batch)
+
+        self.assertEqual({i: f"file_id_{i}" for i in range(1, 6)}, saved)
+        self.assertEqual(0, writer.get_queue_size())
+
+    def test_concurrent_viewers(self):
+        catalog = Catalog.load()
+        cover = catalog.covers[0]
+        catalog.set_server_file_id(cover.id, None)
+        # В дампе пути с разделителем из windows
+        cover.file_name = cover.file_name.replace("\\", "/")
+
+        lock = threading.Lock()
+        uploads = []
+        sent_file_ids = []
+
+        def send(photo) -> telegram.Message:
+            message = unittest.mock.MagicMock()
+            if isinstance(photo, str):
+                with lock:
+                    sent_file_ids.append(photo)
+                return message
+
+            with lock:
+                uploads.append(photo.name)
+
+            # Загрузка дольше, чем запуск остальных потоков
+            time.sleep(0.2)
+            message.photo = [
+                telegram.PhotoSize(f"file_id_{size}", "", size, size)
+                for size in [90, 800, 320]
+            ]
+            return message
+
+        with (
+            tempfile.TemporaryDirectory() as dir_name,
+            unittest.mock.patch.object(
+                uploader, "derivative_cache", DerivativeCache(dir_cache=Path(dir_name))
+            ) as cache,
+            unittest.mock.patch.object(uploader.server_file_id_writer, "put") as put,
+        ):
+            threads = [
+                threading.Thread(target=uploader.send_cover_photo, args=(catalog, cover, send))
+                for _ in range(50)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            # Когда file_id уже есть, загрузки нет
+            uploader.send_cover_photo(catalog, cover, send)
+
+            self.assertEqual([str(cache.get_cached(cover.abs_file_name))], uploads)
+
+        self.assertEqual(["file_id_800"] * 50, sent_file_ids)
+        self.assertEqual("file_id_800", catalog.get_server_file_id(cover.id))
+        put.assert_called_once_with(cover.id, "file_id_800")
+
+    def test_send_cover_album(self):
+        catalog = Catalog.load()
+        covers = catalog.covers[:3]
+        for cover in covers:
+            # В дампе пути с разделителем из windows
+            cover.file_name = cover.file_name.replace("\\", "/")
+        catalog.set_server_file_id(covers[0].id, "file_id_0")
+        catalog.set_server_file_id(covers[1].id, None)
+        catalog.set_server_file_id(covers[2].id, None)
+
+        sent = []
+
+        def send(media: list) -> list[telegram.Message]:
+            messages = []
+            for i, photo in enumerate(media):
+                sent.append(photo if isinstance(photo, str) else "upload")
+                self.assertTrue(isinstance(photo, str) or not photo.closed)
+
+                message = unittest.mock.MagicMock()
+                message.photo = [
+                    telegram.PhotoSize(f"file_id_{i}_{size}", "", size, size)
+                    for size in [90, 800]
+                ]
+                messages.append(message)
+            return messages
+
+        with (
+            tempfile.TemporaryDirectory() as dir_name,
+            unittest.mock.patch.object(
+                uploader, "derivative_cache", DerivativeCache(dir_cache=Path(dir_name))
+            ),
+            unittest.mock.patch.object(uploader.server_file_id_writer, "put") as put,
+        ):
+            # Все обложки уходят одним запросом, в том числе еще не загруженные
+            messages = uploader.send_cover_album(catalog, covers, send)
+            self.assertEqual(3, len(messages))
+            self.assertEqual(["file_id_0", "upload", "upload"], sent)
+
+            self.assertEqual("file_id_0", catalog.get_server_file_id(covers[0].id))
+            self.assertEqual("file_id_1_800", catalog.get_server_file_id(covers[1].id))
+            self.assertEqual("file_id_2_800", catalog.get_server_file_id(covers[2].id))
+            self.assertEqual(
+                [
+                    unittest.mock.call(covers[1].id, "file_id_1_800"),
+                    unittest.mock.call(covers[2].id, "file_id_2_800"),
+                ],
+                put.call_args_list,
+            )
+
+            # Повторная отправка идет только по file_id
+            sent.clear()
+            uploader.send_cover_album(catalog, covers, send)
+            self.assertEqual(["file_id_0", "file_id_1_800", "file_id_2_800"], sent)
+
+
+    def test_send_cover_album_concurrently(self):
+        catalog = Catalog.load()
+        covers = catalog.covers[:3]
+        for cover in covers:
+            # В дампе пути с разделителем из windows
+            cover.file_name = cover.file_name.replace("\\", "/")
+            catalog.set_server_file_id(cover.id, None)
+
+        lock = threading.Lock()
+        uploads = []
+        sent = []
+
+        def send(media: list) -> list[telegram.Message]:
+            if not all(isinstance(photo, str) for photo in media):
+                with lock:
+                    uploads.append(len(media))
+
+                # Загрузка дольше, чем запуск остальных потоков
+                time.sleep(0.2)
+            else:
+                with lock:
+                    sent.append(media)
+
+            messages = []
+            for i, _ in enumerate(media):
+                message = unittest.mock.MagicMock()
+                message.photo = [telegram.PhotoSize(f"file_id_{i}_800", "", 800, 800)]
+                messages.append(message)
+            return messages
+
+        with (
+            tempfile.TemporaryDirectory() as dir_name,
+            unittest.mock.patch.object(
+                uploader, "derivative_cache", DerivativeCache(dir_cache=Path(dir_name))
+            ),
+            unittest.mock.patch.object(uploader.server_file_id_writer, "put") as put,
+        ):
+            threads = [
+                threading.Thread(target=uploader.send_cover_album, args=(catalog, covers, send))
+                for _ in range(20)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        # Альбом загружен один раз, остальные отправили его по file_id
+        self.assertEqual([3], uploads)
+        self.assertEqual([["file_id_0_800", "file_id_1_800", "file_id_2_800"]] * 19, sent)
+        self.assertEqual(3, put.call_count)
+
+class TestAssetRegistry(unittest.TestCase):
+    FILE_NAME = "test_asset_registry.gif"
+
+    def setUp(self):
+        self.tearDown()
+
+    def tearDown(self):
+        MediaAsset.delete().where(MediaAsset.file_name == self.FILE_NAME).execute()
+
+    def test_send(self):
+        sent = []
+        bad_file_ids = set()
+
+        def send(document) -> telegram.Message:
+            if isinstance(document, str):
+                sent.append(document)
+                if document in bad_file_ids:
+                    raise BadRequest("Wrong file identifier/http url specified")
+                file_id = document
+            else:
+                file_id = f"file_id_{len(sent)}"
+                sent.append("upload")
+
+            return telegram.Message(
+                message_id=1,
+                date=DT.datetime.now(),
+                chat=telegram.Chat(id=1, type="private"),
+                animation=telegram.Animation(file_id, "", 1, 1, 1),
+            )
+
+        with tempfile.TemporaryDirectory() as dir_name:
+            file_name = Path(dir_name) / self.FILE_NAME
+            file_name.write_bytes(b"GIF89a")
+
+            registry = AssetRegistry()
+            registry.send(file_name, send)
+            registry.send(file_name, send)
+            self.assertEqual(["upload", "file_id_0"], sent)
+
+            # file_id хранится в базе, поэтому после перезапуска файл не загружается
+            self.assertEqual("file_id_0", AssetRegistry().get_file_id(file_name))
+
+            # Измененный файл загружается заново
+            file_name.write_bytes(b"GIF89a-changed")
+            registry.send(file_name, send)
+            self.assertEqual("upload", sent[-1])
+            self.assertEqual("file_id_2", registry.get_file_id(file_name))
+
+            # Недействительный file_id забывается, а файл загружается заново
+            bad_file_ids.add("file_id_2")
+            registry.send(file_name, send)
+            self.assertEqual(["file_id_2", "upload"], sent[-2:])
+            self.assertEqual("file_id_4", registry.get_file_id(file_name))
+
+
 class TestDbCoverAll(unittest.TestCase):
     def test_all_covers(self):
         for cover in Cover.select(Cover.id).order_by(Cover.id):
@@ -486,5 +1843,550 @@ class TestDbCoverAll(unittest.TestCase):
                     self.assertTrue(result.wasSuccessful())
 
 
+class TestDerivativeCache(unittest.TestCase):
+    def test_make_derivative(self):
+        with tempfile.TemporaryDirectory() as dir_name:
+            source = Path(dir_name) / "source.png"
+            Image.effect_noise((3000, 1000), 64).convert("RGB").save(source)
+
+            target = Path(dir_name) / "target.jpg"
+            size_in, size_out = make_derivative(source, target, max_side=2560)
+            self.assertEqual(source.stat().st_size, size_in)
+            self.assertEqual(target.stat().st_size, size_out)
+            self.assertLess(size_out, size_in)
+
+            with Image.open(target) as img:
+                self.assertEqual("JPEG", img.format)
+                self.assertEqual(2560, max(img.size))
+                self.assertTrue(img.info.get("progressive"))
+
+            # Копия создается, даже если она больше оригинала: EXIF удаляется, а поворот применяется
+            small = Path(dir_name) / "small.jpg"
+            exif = Image.Exif()
+            exif[0x0112] = 6  # Orientation: поворот на 90 градусов
+            exif[0x8825] = {1: "N", 2: (55.0, 45.0, 0.0)}  # GPSInfo
+            Image.effect_noise((100, 50), 64).convert("RGB").save(small, quality=10, exif=exif)
+
+            size_in, size_out = make_derivative(small, target, quality=100)
+            self.assertGreater(size_out, size_in)
+            with Image.open(target) as img:
+                self.assertEqual((50, 100), img.size)
+                self.assertNotIn("exif", img.info)
+                self.assertEqual(0, len(img.getexif()))
+
+    def test_get(self):
+        with tempfile.TemporaryDirectory() as dir_name:
+            dir_name = Path(dir_name)
+            sources = []
+            for i in range(3):
+                source = dir_name / f"{i}.jpg"
+                Image.effect_noise((300, 200), 16 * (i + 1)).convert("RGB").save(source, quality=100)
+                sources.append(source)
+
+            cache = DerivativeCache(dir_cache=dir_name / "cache")
+            stats = cache.make_all(sources, processes=1)
+            self.assertEqual(3, stats["total"])
+            self.assertEqual(3, stats["made"])
+            self.assertLessEqual(stats["bytes_out"], stats["bytes_in"])
+
+            # Неизмененные картинки пропускаются, в т.ч. после перезапуска
+            cache = DerivativeCache(dir_cache=dir_name / "cache")
+            self.assertEqual(0, cache.make_all(sources)["made"])
+
+            target = cache.get(sources[0])
+            self.assertEqual(target, cache.get_cached(sources[0]))
+            with unittest.mock.patch("bot.derivatives.make_derivative") as make:
+                self.assertEqual(target, cache.get(sources[0]))
+                make.assert_not_called()
+
+            # Измененная картинка получает новую копию
+            Image.new("RGB", (300, 200), "blue").save(sources[0])
+            self.assertIsNone(cache.get_cached(sources[0]))
+            self.assertNotEqual(target, cache.get(sources[0]))
+
+            # Без копии загружается оригинал
+            broken = dir_name / "broken.jpg"
+            broken.write_bytes(b"not an image")
+            self.assertEqual(broken, cache.get_for_upload(broken))
+
+
+class TestCollageRenderer(unittest.TestCase):
+    def test_get(self):
+        covers = Catalog.load().covers[:7]
+        for cover in covers:
+            # В дампе пути с разделителем из windows
+            cover.file_name = cover.file_name.replace("\\", "/")
+        rows = [covers[:5], covers[5:6], []]
+
+        with tempfile.TemporaryDirectory() as dir_name:
+            dir_name = Path(dir_name)
+            renderer = CollageRenderer(
+                dir_cache=dir_name / "collages",
+                dir_thumbnails=dir_name / "thumbnails",
+                covers_per_row=4,
+                cell_size=50,
+            )
+            try:
+                file_name = renderer.get("authors_gs_g", 2, rows, start=11)
+
+                # Строка на объект и не больше covers_per_row обложек в строке
+                with Image.open(file_name) as img:
+                    self.assertEqual((25 + 50 * 4, 50 * 3), img.size)
+
+                self.assertEqual(5, len(list((dir_name / "thumbnails").glob("*.jpg"))))
+
+                # Готовый коллаж берется с диска
+                with unittest.mock.patch.object(renderer, "render") as render:
+                    self.assertEqual(file_name, renderer.get("authors_gs_g", 2, rows, start=11))
+                    render.assert_not_called()
+
+                # Коллаж был отправлен в телеграм
+                content_hash = asset_registry.get_hash(file_name)
+                MediaAsset.set_file_id(content_hash, file_name.name, "collage_file_id")
+                self.assertEqual("collage_file_id", asset_registry.get_file_id(file_name))
+
+                # Другие обложки - другая версия, а прошлая версия удаляется вместе с file_id
+                new_file_name = renderer.get("authors_gs_g", 2, [covers[6:7]], start=11)
+                self.assertNotEqual(file_name, new_file_name)
+                self.assertFalse(file_name.exists())
+                self.assertEqual(
+                    [new_file_name], list((dir_name / "collages").glob("*.jpg"))
+                )
+                self.assertIsNone(MediaAsset.get_file_id(content_hash))
+            finally:
+                renderer.stop()
+                MediaAsset.delete_by_file_name(file_name.name)
+
+
+class TestCards(unittest.TestCase):
+    def setUp(self):
+        self.update = unittest.mock.MagicMock()
+        self.update.callback_query = None
+        self.update.effective_chat.id = 1
+        self.update.effective_message.message_id = 123
+
+        self.context = unittest.mock.MagicMock()
+        self.context.match = None
+        self.context.bot.link = "https://t.me/bot"
+
+    def test_cover_card(self):
+        catalog = Catalog.load()
+        cover = catalog.covers[0]
+        catalog.set_server_file_id(cover.id, "file_id")
+
+        with unittest.mock.patch.object(commands, "get_catalog", return_value=catalog):
+            db_stats.start_timer()
+            commands.reply_cover_page_card(self.update, self.context, cover_id=cover.id)
+
+        # Карточка строится по снимку каталога, без запросов в базу
+        self.assertEqual(0, db_stats.number_of_queries)
+
+        # Карточка уходит одним запросом, ссылки ведут к исходному сообщению
+        message = self.update.effective_message
+        message.reply_photo.assert_called_once()
+        message.reply_photo.return_value.edit_caption.assert_not_called()
+
+        kwargs = message.reply_photo.call_args.kwargs
+        self.assertEqual("file_id", kwargs["photo"])
+        self.assertEqual(123, kwargs["reply_to_message_id"])
+        self.assertIn(f"start=Cover_{cover.id}_1_123", kwargs["caption"])
+
+    def test_game_card(self):
+        game = Catalog.load().games[0]
+        commands.reply_game_card(self.update, self.context, game_id=game.id)
+
+        message = self.update.effective_message
+        message.reply_text.assert_called_once()
+        message.reply_text.return_value.edit_text.assert_not_called()
+        self.assertIn("_1_123", message.reply_text.call_args.kwargs["text"])
+
+    def test_empty_cover_album(self):
+        catalog = Catalog.load()
+        author = catalog.covers[0].authors[0]
+        game = next(cover.game for cover in catalog.covers if author not in cover.authors)
+
+        # У автора нет обложек этой игры, поэтому альбом пустой
+        with unittest.mock.patch.object(commands, "get_catalog", return_value=catalog):
+            commands.reply_cover_album_page(
+                self.update, self.context, by_author_id=author.id, by_game_id=game.id
+            )
+
+        message = self.update.effective_message
+        message.reply_media_group.assert_not_called()
+        message.reply_text.assert_called_once()
+        self.assertIn("Нет обложек", message.reply_text.call_args.args[0])
+
+    def test_cross_chat_deep_link(self):
+        catalog = Catalog.load()
+        for cover in catalog.covers:
+            catalog.set_server_file_id(cover.id, "file_id")
+        cover = catalog.covers[0]
+
+        # Как и телеграм, ответ на удаленное сообщение без allow_sending_without_reply - ошибка
+        deleted_message_ids = set()
+        sent = []
+
+        def _reply(*args, reply_to_message_id=None, allow_sending_without_reply=None, **kwargs):
+            if reply_to_message_id in deleted_message_ids and not allow_sending_without_reply:
+                raise BadRequest("Replied message not found")
+
+            sent.append(kwargs.get("caption") or kwargs.get("text") or args[0])
+            return unittest.mock.MagicMock()
+
+        def _click(start_argument: str, message_id: int):
+            update = unittest.mock.MagicMock()
+            update.callback_query = None
+            update.effective_chat.id = 1
+
+            message = update.effective_message
+            message.message_id = message_id
+            message.reply_photo.side_effect = _reply
+            message.reply_text.side_effect = _reply
+            message.delete.side_effect = lambda: deleted_message_ids.add(message_id)
+
+            context = unittest.mock.MagicMock()
+            context.args = [start_argument]
+            context.match = None
+            context.bot.link = self.context.bot.link
+
+            # Без декораторов, им нужен настоящий бот
+            commands.on_start.__wrapped__.__wrapped__(update, context)
+
+        with (
+            unittest.mock.patch.object(commands, "get_catalog", return_value=catalog),
+            unittest.mock.patch.object(
+                commands.activity_tracker, "is_first_request", return_value=False
+            ),
+        ):
+            # Ссылка из другого чата: карточка привязана к сообщению с /start, которое удаляется
+            _click(f"Cover_{cover.id}_2_5", message_id=10)
+            self.assertEqual({10}, deleted_message_ids)
+
+            start_arguments = re.findall(r"\?start=(\w+)", sent[-1])
+            self.assertIn(f"Game_{cover.game.id}_1_10", start_arguments)
+
+            # Ссылки из этой карточки продолжают работать
+            for i, start_argument in enumerate(start_arguments, start=11):
+                with self.subTest(start_argument=start_argument):
+                    _click(start_argument, message_id=i)
+
+        self.assertEqual(1 + len(start_arguments), len(sent))
+
+    def test_cover_text_cache(self):
+        catalog = Catalog.load()
+        cover = catalog.covers[0]
+
+        with (
+            unittest.mock.patch.object(commands, "card_cache", CardCache()) as cache,
+            unittest.mock.patch.object(commands, "get_catalog", return_value=catalog),
+        ):
+            self.update.effective_chat.id = 111
+            text_1 = commands.get_cover_text(self.update, self.context, cover, reply_to_message_id=222)
+            self.update.effective_chat.id = 333
+            text_2 = commands.get_cover_text(self.update, self.context, cover, reply_to_message_id=444)
+
+            metrics = cache.get_metrics()
+            self.assertEqual(1, metrics["hits"])
+            self.assertEqual(1, metrics["misses"])
+
+            # Из кэша меняются только id чата и сообщения
+            self.assertIn(f"start=Cover_{cover.id}_111_222", text_1)
+            self.assertIn(f"start=Cover_{cover.id}_333_444", text_2)
+            self.assertEqual(text_1.replace("_111_222", "_333_444"), text_2)
+
+            # Текст с фильтрами - другой ключ
+            commands.get_cover_text(
+                self.update, self.context, cover, reply_to_message_id=3, by_game=cover.game.id
+            )
+            self.assertEqual(2, cache.get_metrics()["misses"])
+
+        # Новый снимок каталога - новая версия, старые шаблоны не используются
+        self.assertNotEqual(catalog.version, Catalog.load().version)
+
+
+class TestCardCache(unittest.TestCase):
+    def test_get(self):
+        cache = CardCache()
+        template = f"chat={CHAT_ID_PLACEHOLDER} message={MESSAGE_ID_PLACEHOLDER} {{}}"
+        render = unittest.mock.Mock(return_value=template)
+
+        self.assertEqual("chat=1 message=2 {}", cache.get("key", render, chat_id=1, message_id=2))
+        self.assertEqual("chat=-3 message=4 {}", cache.get("key", render, chat_id=-3, message_id=4))
+        render.assert_called_once()
+
+        metrics = cache.get_metrics()
+        self.assertEqual(1, metrics["items"])
+        self.assertEqual(1, metrics["hits"])
+        self.assertEqual(1, metrics["misses"])
+
+    def test_lru(self):
+        cache = CardCache()
+        cache.get_template("a", lambda: "a" * 100)
+        size = cache.get_metrics()["bytes"]
+
+        # Место только для двух шаблонов
+        cache = CardCache(max_bytes=size * 2)
+        for key in ["a", "b"]:
+            cache.get_template(key, lambda: key * 100)
+
+        # "a" использован недавно, поэтому удаляется "b"
+        cache.get_template("a", lambda: "")
+        cache.get_template("c", lambda: "c" * 100)
+
+        render = unittest.mock.Mock(return_value="b" * 100)
+        cache.get_template("b", render)
+        render.assert_called_once()
+
+        metrics = cache.get_metrics()
+        self.assertEqual(2, metrics["items"])
+        self.assertEqual(2, metrics["evictions"])
+        self.assertLessEqual(metrics["bytes"], size * 2)
+
+
+class TestKeyboardMarkup(unittest.TestCase):
+    def test_fingerprint(self):
+        keyboard = get_paginator_markup(
+            10, 5, "covers page={page} a# gs# g#",
+            before_buttons=(("🖼 Обложки", "collage"),),
+        )
+
+        # Клавиатура сообщения приходит от телеграма объектом
+        message_markup = telegram.InlineKeyboardMarkup.de_json(
+            json.loads(keyboard.markup), bot=None
+        )
+        self.assertEqual(keyboard.fingerprint, get_keyboard_fingerprint(message_markup))
+        self.assertEqual(keyboard.fingerprint, get_keyboard_fingerprint(keyboard.markup))
+        self.assertTrue(is_equal_inline_keyboards(keyboard, message_markup))
+
+        other = get_paginator_markup(10, 6, "covers page={page} a# gs# g#")
+        self.assertFalse(is_equal_inline_keyboards(other, message_markup))
+        self.assertNotEqual(get_keyboard_fingerprint(None), keyboard.fingerprint)
+
+    def test_cache(self):
+        args = (100, 50, "test page={page}", "test page={page} <", "test page={page} >")
+        keyboard = get_paginator_markup(*args)
+
+        hits = get_paginator_markup.cache_info().hits
+        self.assertIs(keyboard, get_paginator_markup(*args))
+        self.assertEqual(hits + 1, get_paginator_markup.cache_info().hits)
+
+        buttons = [
+            [button["callback_data"] for button in row]
+            for row in json.loads(keyboard.markup)["inline_keyboard"]
+        ]
+        self.assertEqual(["test page=49 <", "test page=51 >"], buttons[-1])
+
+
+class TestSearchResultPages(unittest.TestCase):
+    def test_split_into_pages(self):
+        self.assertEqual(["Найдено:"], split_into_pages([], 10, header="Найдено:"))
+        self.assertEqual(["h:a, b"], split_into_pages(["a", "b"], 10, header="h:"))
+        self.assertEqual(
+            ["h:aa, bb", "h:cc, d", "h:eeeeeeee"],
+            split_into_pages(["aa", "bb", "cc", "d", "eeeeeeee"], 8, header="h:"),
+        )
+
+        parts = [str(i) for i in range(10_000)]
+        pages = split_into_pages(parts, 100, sep=", ", header="h:")
+        self.assertTrue(all(len(page) <= 100 for page in pages))
+
+        # Все части на месте и в том же порядке
+        self.assertEqual(
+            parts,
+            [part for page in pages for part in page.removeprefix("h:").split(", ")],
+        )
+
+    def test_search_cache(self):
+        self.assertEqual("grand theft auto", normalize_query("  Grand   THEFT auto "))
+
+        cache = SearchCache(max_size=2)
+        with unittest.mock.patch.object(Cover, "find", wraps=Cover.find) as find:
+            key, result = cache.search("Grand Theft Auto")
+            self.assertEqual(get_query_key("grand theft auto"), key)
+            self.assertEqual(
+                tuple(cover.id for cover in Cover.find("grand theft auto")), result.cover_ids
+            )
+            self.assertFalse(result.is_fuzzy)
+
+            self.assertEqual((key, result), cache.search("grand  theft AUTO"))
+            self.assertEqual(result, cache.get_by_key(key))
+            self.assertEqual(2, find.call_count)
+
+            # Самый старый запрос удаляется
+            cache.search("a")
+            cache.search("b")
+            self.assertIsNone(cache.get_by_key(key))
+            self.assertEqual(2, len(cache))
+
+    def test_search_cache_expiration(self):
+        catalog = unittest.mock.MagicMock(version=1)
+        catalog.find_similar.return_value = []
+
+        with (
+            unittest.mock.patch.object(Cover, "find", return_value=[]) as find,
+            unittest.mock.patch("bot.search.get_catalog", return_value=catalog),
+        ):
+            cache = SearchCache()
+            key, _ = cache.search("a")
+            cache.search("a")
+            self.assertEqual(1, find.call_count)
+
+            # После перезагрузки каталога поиск выполняется заново, в том числе по ключу,
+            # а похожие обложки ищутся в новом снимке
+            new_catalog = unittest.mock.MagicMock(version=2)
+            new_catalog.find_similar.return_value = []
+            with unittest.mock.patch("bot.search.get_catalog", return_value=new_catalog):
+                self.assertEqual("a", cache.get_by_key(key).query)
+                self.assertEqual(2, find.call_count)
+                new_catalog.find_similar.assert_called_once_with("a")
+                cache.search("a")
+                self.assertEqual(2, find.call_count)
+
+            # Устаревший по времени результат
+            cache.ttl_secs = 0
+            cache.search("b")
+            cache.search("b")
+            self.assertEqual(4, find.call_count)
+
+            metrics = cache.get_metrics()
+            self.assertEqual(2, metrics["hits"])
+            self.assertEqual(4, metrics["misses"])
+            self.assertEqual(2, metrics["expired"])
+            self.assertEqual(4, metrics["computes"])
+            self.assertEqual(round(2 / 6, 3), metrics["hit_ratio"])
+
+    def test_search_cache_single_flight(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def _find(query: str) -> list:
+            started.set()
+            release.wait(timeout=5)
+            return []
+
+        cache = SearchCache()
+        with unittest.mock.patch.object(Cover, "find", side_effect=_find) as find:
+            results = []
+            threads = [
+                threading.Thread(target=lambda: results.append(cache.search("a")))
+                for _ in range(4)
+            ]
+            threads[0].start()
+            started.wait(timeout=5)
+            for thread in threads[1:]:
+                thread.start()
+
+            time.sleep(0.05)
+            release.set()
+            for thread in threads:
+                thread.join()
+
+            # Одновременные одинаковые запросы ищутся один раз
+            self.assertEqual(1, find.call_count)
+            self.assertEqual(4, len(results))
+            self.assertEqual(1, len(set(results)))
+
+    def test_catalog_version(self):
+        database = SqliteDatabase(":memory:")
+        self.assertEqual(0, get_catalog_version(database))
+        with database.atomic() as transaction:
+            self.assertEqual(1, bump_catalog_version(database))
+            transaction.rollback()
+
+        # Версия меняется вместе с данными в транзакции
+        self.assertEqual(0, get_catalog_version(database))
+        self.assertEqual(1, bump_catalog_version(database))
+        self.assertEqual(1, get_catalog_version(database))
+
+    def test_reply_cover_ids(self):
+        catalog = Catalog.load()
+
+        update = unittest.mock.MagicMock()
+        update.callback_query = None
+        update.effective_chat.id = 1
+        update.effective_message.message_id = 1
+
+        context = unittest.mock.MagicMock()
+        context.bot.link = "https://t.me/bot"
+
+        commands.reply_cover_ids(catalog.covers, update, context, query_key="abc")
+
+        # Все обложки не помещаются в одно сообщение, поэтому есть кнопки страниц
+        kwargs = update.effective_message.reply_text.call_args.kwargs
+        text = update.effective_message.reply_text.call_args.args[0]
+        self.assertLessEqual(len(text), MAX_MESSAGE_LENGTH)
+        self.assertIn(f"Найдено {len(catalog.covers)}:", text)
+        self.assertIn("find page=2 q#abc", kwargs["reply_markup"])
+
+        # Страница по кнопке редактирует сообщение
+        update.callback_query = unittest.mock.MagicMock()
+        commands.reply_cover_ids(catalog.covers, update, context, query_key="abc", page=2)
+        text_2 = update.effective_message.edit_text.call_args.args[0]
+        self.assertNotEqual(text, text_2)
+        self.assertLessEqual(len(text_2), MAX_MESSAGE_LENGTH)
+
+
+class TestFuzzyIndex(unittest.TestCase):
+    def test_get_trigrams(self):
+        self.assertEqual(["поле", "битвы", "3"], get_words("Поле Битвы 3!"))
+        self.assertEqual({"  c", " ca", "cat", "at "}, get_trigrams("cat"))
+        self.assertEqual({"  a", " a "}, get_trigrams("a"))
+        self.assertEqual(1.0, get_similarity("cat", "cat"))
+        self.assertEqual(0.0, get_similarity("cat", "dog"))
+
+    def test_search(self):
+        index = FuzzyIndex([
+            ("Battlefield 3", "Тимофей Соколов"),
+            ("Alan Wake",),
+            ("Battlefield 4", "Артём Пронин"),
+            ("Need for Speed: Undercover",),
+        ])
+        self.assertEqual(13, len(index))
+
+        # Опечатки и регистр
+        positions = [position for position, _ in index.search("batlefeld 3")]
+        self.assertEqual([0, 2], positions)
+        self.assertEqual([1], [position for position, _ in index.search("ALLAN wake")])
+        self.assertEqual([0], [position for position, _ in index.search("соколв")])
+
+        self.assertEqual(1.0, index.search("Alan Wake")[0][1])
+        self.assertEqual([], index.search("minecraft"))
+        self.assertEqual([], index.search(""))
+
+    def test_find_words(self):
+        catalog = Catalog.load()
+        index = catalog.get_fuzzy_index()
+        self.assertIs(index, catalog.get_fuzzy_index())
+
+        # Отбор кандидатов по триграммам находит те же слова, что и перебор всех слов
+        for word in ["batlefeld", "максимум", "соколв", "3", "wake", "undrcover"]:
+            with self.subTest(word=word):
+                expected = {
+                    word_id: get_similarity(word, other)
+                    for word_id, other in enumerate(index.words)
+                    if get_similarity(word, other) >= 0.3
+                }
+                self.assertTrue(expected)
+                self.assertEqual(expected, index.find_words(word, 0.3))
+
+    def test_find_similar(self):
+        catalog = Catalog.load()
+        covers = catalog.find_similar("Batlefeld")
+        self.assertTrue(covers)
+        self.assertIn("Battlefield", covers[0].game.name)
+
+        cache = SearchCache()
+        with unittest.mock.patch("bot.search.get_catalog", return_value=catalog):
+            _, result = cache.search("Batlefeld")
+            self.assertTrue(result.is_fuzzy)
+            self.assertEqual(tuple(cover.id for cover in covers), result.cover_ids)
+
+            # При точных совпадениях нечеткий поиск не используется
+            _, result = cache.search("Battlefield")
+            self.assertFalse(result.is_fuzzy)
+
+        self.assertEqual(1, cache.get_metrics()["fuzzy_computes"])
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,625 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "ipetrash"
+
+
+import atexit
+import contextlib
+import datetime as DT
+import logging
+import queue
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import IO, Any, Callable, Hashable
+
+import telegram
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError
+from telegram.ext import CallbackContext, JobQueue
+
+from config import (
+    UPLOAD_RATE_PER_SEC,
+    UPLOAD_BURST,
+    UPLOAD_WORKERS,
+    UPLOAD_MAX_ATTEMPTS,
+    UPLOAD_MAX_RETRY_AFTER,
+    UPLOAD_SAVE_BATCH_SIZE,
+    UPLOAD_PROGRESS_INTERVAL_SECS,
+)
+from bot.catalog import Catalog, CoverRecord, get_catalog
+from bot.common import SeverityEnum, log
+from bot.db import Cover, UploadJob
+from bot.derivatives import derivative_cache
+
+
+class TokenBucket:
+    """
+    Ограничение частоты: rate токенов в секунду и не больше capacity подряд.
+    Пауза (например, по RetryAfter от телеграма) действует на всех, кто берет токены
+    """
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+
+        self._lock = threading.Lock()
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+
+    def _take(self) -> float:
+        # Вернет 0, если токен взят, иначе сколько секунд нужно подождать
+        with self._lock:
+            now = time.monotonic()
+            if now < self._paused_until:
+                return self._paused_until - now
+
+            self._tokens = min(
+                self.capacity, self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self, stopped: threading.Event = None) -> bool:
+        """
+        Ожидание токена. Вернет False, если ожидание прервано через stopped
+        """
+
+        while True:
+            wait_secs = self._take()
+            if not wait_secs:
+                return True
+
+            if stopped:
+                if stopped.wait(wait_secs):
+                    return False
+            else:
+                time.sleep(wait_secs)
+
+    def pause(self, secs: float):
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + secs)
+            self._tokens = 0
+            self._updated = self._paused_until
+
+
+def get_photo_file_id(message: telegram.Message) -> str:
+    # Телеграм хранит картинку в нескольких размерах, нужен самый большой
+    photo_large = max(message.photo, key=lambda x: (x.width, x.height))
+    return photo_large.file_id
+
+
+class SingleFlight:
+    """
+    Один вызов на ключ: пока вызов с ключом выполняется, остальные вызовы
+    с тем же ключом ждут и получают его результат или его исключение
+    """
+
+    class _Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result: Any = None
+            self.error: Exception | None = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: dict[Hashable, SingleFlight._Call] = dict()
+
+    def do(self, key: Hashable, func: Callable[[], Any]) -> Any:
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self._calls[key] = self._Call()
+
+        if not is_leader:
+            call.done.wait()
+            if call.error:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+        return call.result
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+
+class ServerFileIdWriter:
+    """
+    Запись server_file_id в базу в отдельном потоке, чтобы обработчик не ждал записи.
+    Накопленные к моменту записи значения записываются одной транзакцией
+    """
+
+    def __init__(self, batch_size: int = UPLOAD_SAVE_BATCH_SIZE, log: logging.Logger = None):
+        self.batch_size = batch_size
+        self.log = log
+
+        self._queue: queue.Queue[tuple[int, str] | None] = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+
+    def put(self, cover_id: int, server_file_id: str):
+        self._queue.put((cover_id, server_file_id))
+
+        # Поток запускается при первой записи
+        with self._lock:
+            if not self._thread:
+                self._thread = threading.Thread(
+                    target=self._run, name=self.__class__.__name__, daemon=True
+                )
+                self._thread.start()
+                atexit.register(self.stop)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+
+            batch = dict([item])
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+
+                if item is None:
+                    # Остановка после записи того, что уже взято из очереди
+                    self._queue.put(None)
+                    break
+
+                batch.update([item])
+
+            try:
+                Cover.set_server_file_ids(batch)
+            except Exception:
+                # Незаписанные file_id есть в каталоге в памяти, а после перезапуска
+                # бота обложки загрузятся заново
+                if self.log:
+                    self.log.exception("Ошибка при записи server_file_id")
+
+    def stop(self):
+        atexit.unregister(self.stop)
+
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+
+        if thread:
+            self._queue.put(None)
+            thread.join()
+
+    def get_queue_size(self) -> int:
+        return self._queue.qsize()
+
+
+single_flight = SingleFlight()
+server_file_id_writer = ServerFileIdWriter(log=log)
+
+
+def send_cover_photo(
+    catalog: Catalog,
+    cover: CoverRecord,
+    send: Callable[[str | IO], telegram.Message],
+) -> telegram.Message:
+    """
+    Отправка обложки через send, которому передается file_id или открытый файл картинки.
+    Если у обложки еще нет server_file_id, то первая отправка загрузит файл и сохранит file_id,
+    а параллельные отправки той же обложки дождутся этого file_id, а не будут загружать файл сами
+    """
+
+    server_file_id = catalog.get_server_file_id(cover.id)
+    if server_file_id:
+        return send(server_file_id)
+
+    message: telegram.Message | None = None
+
+    def _upload() -> str:
+        nonlocal message
+
+        # Обложка могла загрузиться, пока ждали блокировку
+        server_file_id = catalog.get_server_file_id(cover.id)
+        if server_file_id:
+            return server_file_id
+
+        with open(derivative_cache.get_for_upload(cover.abs_file_name), "rb") as f:
+            message = send(f)
+
+        server_file_id = get_photo_file_id(message)
+        catalog.set_server_file_id(cover.id, server_file_id)
+        server_file_id_writer.put(cover.id, server_file_id)
+
+        return server_file_id
+
+    server_file_id = single_flight.do((CoverRecord.model_name, cover.id), _upload)
+
+    # Обложку загрузил другой запрос, осталось отправить ее по file_id
+    if message is None:
+        message = send(server_file_id)
+
+    return message
+
+
+def send_cover_album(
+    catalog: Catalog,
+    covers: list[CoverRecord],
+    send: Callable[[list[str | IO]], list[telegram.Message]],
+) -> list[telegram.Message]:
+    """
+    Отправка обложек одним альбомом через send, которому передается список
+    из file_id или открытых файлов картинок в порядке covers.
+    Обложки без server_file_id загружаются в том же запросе, а их file_id сохраняются.
+    Параллельные отправки того же альбома дождутся загрузки и отправят его по file_id
+    """
+
+    def _get_server_file_ids() -> list[str | None]:
+        return [catalog.get_server_file_id(cover.id) for cover in covers]
+
+    server_file_ids = _get_server_file_ids()
+    if all(server_file_ids):
+        return send(server_file_ids)
+
+    messages: list[telegram.Message] | None = None
+
+    def _upload():
+        nonlocal messages
+
+        # Обложки могли загрузиться, пока ждали блокировку
+        server_file_ids = _get_server_file_ids()
+        if all(server_file_ids):
+            return
+
+        with contextlib.ExitStack() as stack:
+            media = [
+                server_file_id
+                or stack.enter_context(
+                    open(derivative_cache.get_for_upload(cover.abs_file_name), "rb")
+                )
+                for cover, server_file_id in zip(covers, server_file_ids)
+            ]
+            messages = send(media)
+
+        for cover, server_file_id, message in zip(covers, server_file_ids, messages):
+            if server_file_id:
+                continue
+
+            server_file_id = get_photo_file_id(message)
+            catalog.set_server_file_id(cover.id, server_file_id)
+            server_file_id_writer.put(cover.id, server_file_id)
+
+    single_flight.do(
+        (CoverRecord.model_name, tuple(cover.id for cover in covers)), _upload
+    )
+
+    # Альбом загрузил другой запрос, осталось отправить его по file_id
+    if messages is None:
+        messages = send(_get_server_file_ids())
+
+    return messages
+
+
+class CoverUploader:
+    """
+    Загрузка в телеграм обложек без server_file_id, чтобы после отправлять их по file_id.
+    Загрузка идет задачей JobQueue, а не в обработчике, сами загрузки выполняются
+    в нескольких потоках с общим ограничением частоты.
+    Найденные file_id сразу попадают в каталог в памяти, а в базу записываются пачками.
+    Задача хранится в UploadJob, поэтому после падения бота она продолжится с тех обложек,
+    что еще не записаны в базу
+    """
+
+    TITLE = SeverityEnum.INFO.value.format(text="Загрузка обложек.")
+
+    def __init__(
+        self,
+        rate_per_sec: float = UPLOAD_RATE_PER_SEC,
+        burst: int = UPLOAD_BURST,
+        workers: int = UPLOAD_WORKERS,
+        max_attempts: int = UPLOAD_MAX_ATTEMPTS,
+        max_retry_after: int = UPLOAD_MAX_RETRY_AFTER,
+        retry_delay_secs: float = 1,
+        save_batch_size: int = UPLOAD_SAVE_BATCH_SIZE,
+        progress_interval_secs: float = UPLOAD_PROGRESS_INTERVAL_SECS,
+        log: logging.Logger = None,
+    ):
+        self.bucket = TokenBucket(rate_per_sec, burst)
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.max_retry_after = max_retry_after
+        self.retry_delay_secs = retry_delay_secs
+        self.save_batch_size = save_batch_size
+        self.progress_interval_secs = progress_interval_secs
+        self.log = log
+
+        self._lock = threading.Lock()
+        self._running = False
+        self._stopped = threading.Event()
+        self._last_progress = 0.0
+
+        self.number_of_uploaded = 0
+        self.number_of_retries = 0
+        self.number_of_errors = 0
+
+        # Повторы текущей задачи, показываются в ее прогрессе
+        self._job_retries = 0
+
+    @property
+    def is_running(self) -> bool:
+        return self._running
+
+    def start(self, job_queue: JobQueue, chat_id: int) -> bool:
+        """
+        Запуск загрузки задачей JobQueue. Вернет False, если загрузка уже идет
+        """
+
+        with self._lock:
+            if self._running:
+                return False
+            self._running = True
+
+        job = UploadJob.get_unfinished()
+        if not job:
+            job = UploadJob.create(chat_id=chat_id)
+        elif job.chat_id != chat_id:
+            job.chat_id = chat_id
+            job.message_id = None
+            job.save()
+
+        job_queue.run_once(
+            self._run_job, when=0, context=job.id, name=self.__class__.__name__
+        )
+        return True
+
+    def resume(self, job_queue: JobQueue) -> bool:
+        """
+        Продолжение задачи, что не завершилась при прошлом запуске бота
+        """
+
+        job = UploadJob.get_unfinished()
+        if not job:
+            return False
+
+        if self.log:
+            self.log.info(f"Продолжение загрузки обложек, задача #{job.id}")
+
+        return self.start(job_queue, job.chat_id)
+
+    def stop(self):
+        # Загрузки, что уже идут, завершатся, а новые не начнутся
+        self._stopped.set()
+
+    def _run_job(self, context: CallbackContext):
+        try:
+            self.run(context.bot, UploadJob.get_by_id(context.job.context))
+        except Exception:
+            if self.log:
+                self.log.exception("Ошибка при загрузке обложек")
+        finally:
+            with self._lock:
+                self._running = False
+
+    def _report(self, bot: telegram.Bot, job: UploadJob, text: str, force: bool = False):
+        # Редактирование сообщения тоже запрос к телеграму, поэтому прогресс обновляется редко
+        if not force and time.monotonic() - self._last_progress < self.progress_interval_secs:
+            return
+        self._last_progress = time.monotonic()
+
+        text = f"{self.TITLE}\n{text}"
+
+        # Сообщения с прогрессом в том же чате, поэтому под тем же ограничением частоты
+        self.bucket.acquire()
+        try:
+            if job.message_id:
+                bot.edit_message_text(text, chat_id=job.chat_id, message_id=job.message_id)
+            else:
+                message = bot.send_message(job.chat_id, text)
+                job.message_id = message.message_id
+                job.save()
+
+        except TelegramError as e:
+            if self.log:
+                self.log.warning(f"Не удалось показать прогресс загрузки: {e}")
+
+    def _get_progress(self, number_of_uploaded: int, total_covers: int) -> str:
+        text = f"{number_of_uploaded} / {total_covers}"
+        if self._job_retries:
+            text += f", повторов: {self._job_retries}"
+        return text
+
+    def _add_retry(self):
+        with self._lock:
+            self.number_of_retries += 1
+            self._job_retries += 1
+
+    def _save(self, job: UploadJob, server_file_id_by_cover_id: dict[int, str]):
+        if not server_file_id_by_cover_id:
+            return
+
+        Cover.set_server_file_ids(server_file_id_by_cover_id)
+
+        job.number_of_uploaded += len(server_file_id_by_cover_id)
+        job.save()
+
+    def _upload(
+        self, bot: telegram.Bot, chat_id: int, catalog: Catalog, cover: CoverRecord
+    ) -> str | None:
+        """
+        Загрузка обложки, вернет file_id самого большого размера картинки.
+        Вернет None, если загрузка остановлена или обложка уже загружена
+        """
+
+        attempt = 0
+        number_of_retry_after = 0
+        while True:
+            # Обложку могли уже загрузить при ее просмотре
+            if catalog.get_server_file_id(cover.id):
+                return
+
+            if not self.bucket.acquire(self._stopped):
+                return
+
+            try:
+                with open(derivative_cache.get_for_upload(cover.abs_file_name), "rb") as f:
+                    message = bot.send_photo(chat_id, photo=f, disable_notification=True)
+                break
+
+            except RetryAfter as e:
+                # Это не ошибка загрузки, поэтому попытки не тратятся,
+                # но и ждать бесконечно, если телеграм все время просит подождать, не нужно
+                number_of_retry_after += 1
+                if number_of_retry_after >= self.max_retry_after:
+                    raise
+
+                # Лимит общий для всех загрузок, поэтому ждать будут все
+                self._add_retry()
+                self.bucket.pause(e.retry_after)
+
+            except BadRequest:
+                raise
+
+            except NetworkError:
+                attempt += 1
+                if attempt >= self.max_attempts:
+                    raise
+
+                # Повтор с увеличивающейся задержкой
+                self._add_retry()
+                if self._stopped.wait(self.retry_delay_secs * 2 ** (attempt - 1)):
+                    return
+
+        try:
+            # Удаление - тоже запрос в чат, поэтому ждет свой токен
+            self.bucket.acquire()
+            message.delete()
+        except TelegramError as e:
+            if self.log:
+                self.log.warning(f"Не удалось удалить сообщение с обложкой: {e}")
+
+        return get_photo_file_id(message)
+
+    def run(self, bot: telegram.Bot, job: UploadJob) -> int:
+        """
+        Загрузка всех обложек без server_file_id. Вернет количество загруженных
+        """
+
+        self._stopped.clear()
+        self._last_progress = 0.0
+        self._job_retries = 0
+
+        catalog = get_catalog()
+        covers = [
+            cover for cover in catalog.covers
+            if not catalog.get_server_file_id(cover.id)
+        ]
+        total_covers = len(covers)
+        if not total_covers:
+            self._report(bot, job, "Все обложки уже загружены!", force=True)
+            job.finished_at = DT.datetime.now()
+            job.save()
+            return 0
+
+        # Копии для загрузки создаются заранее все сразу в пуле процессов
+        self._report(bot, job, "Подготовка картинок...", force=True)
+        stats = derivative_cache.make_all(
+            cover.abs_file_name for cover in covers if cover.abs_file_name.exists()
+        )
+        if self.log:
+            self.log.info(f"Копии обложек для загрузки: {stats}")
+
+        self._report(bot, job, self._get_progress(0, total_covers), force=True)
+
+        t = time.perf_counter()
+        number_of_uploaded = 0
+        errors = []
+        pending: dict[int, str] = dict()
+
+        try:
+            with ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix=self.__class__.__name__
+            ) as executor:
+                future_to_cover = {
+                    executor.submit(self._upload, bot, job.chat_id, catalog, cover): cover
+                    for cover in covers
+                }
+
+                for future in as_completed(future_to_cover):
+                    cover = future_to_cover[future]
+                    try:
+                        server_file_id = future.result()
+                    except Exception as e:
+                        self.number_of_errors += 1
+                        errors.append(f"{cover.file_name}: {e}")
+                        if self.log:
+                            self.log.exception(f"Ошибка при загрузке {cover.file_name}")
+                        continue
+
+                    # Загрузка была остановлена или обложка уже загружена
+                    if not server_file_id:
+                        continue
+
+                    catalog.set_server_file_id(cover.id, server_file_id)
+                    pending[cover.id] = server_file_id
+                    number_of_uploaded += 1
+                    self.number_of_uploaded += 1
+
+                    if len(pending) >= self.save_batch_size:
+                        self._save(job, pending)
+                        pending = dict()
+
+                    self._report(bot, job, self._get_progress(number_of_uploaded, total_covers))
+
+        finally:
+            self._save(job, pending)
+
+        if self._stopped.is_set():
+            self._report(
+                bot, job,
+                f"{self._get_progress(number_of_uploaded, total_covers)}\n"
+                f"Загрузка остановлена, она продолжится после запуска бота.",
+                force=True,
+            )
+            return number_of_uploaded
+
+        elapsed_secs = int(time.perf_counter() - t)
+        text = f"Загружено {number_of_uploaded} обложек за {elapsed_secs} секунд."
+        if self._job_retries:
+            text += f"\nПовторов: {self._job_retries}."
+        if errors:
+            text += f"\nОшибок: {len(errors)}, повторите команду, чтобы загрузить оставшиеся."
+
+        job.finished_at = DT.datetime.now()
+        job.error = "\n".join(errors) or None
+        job.save()
+
+        self._report(bot, job, text, force=True)
+        return number_of_uploaded
+
+    def get_metrics(self) -> dict[str, int | bool]:
+        return {
+            "running": self.is_running,
+            "uploaded": self.number_of_uploaded,
+            "retries": self.number_of_retries,
+            "errors": self.number_of_errors,
+            "uploads_in_flight": len(single_flight),
+            "file_id_write_queue": server_file_id_writer.get_queue_size(),
+        }
+
+
+cover_uploader = CoverUploader(log=log)
@@ -26,6 +26,21 @@ DIR_IMAGES = DIR_DATA_VK / "images"
 if not DIR_IMAGES.exists() or not any(DIR_IMAGES.glob("*.jpg")):
     raise Exception(f"Отсутствует или пустая папка с картинками: {DIR_IMAGES}")
 
+# Уменьшенные и пережатые копии обложек, что загружаются в телеграм вместо оригиналов.
+# Имя копии - хэш оригинала и параметров, поэтому при их изменении копия создастся заново
+DIR_IMAGES_CACHE = DIR_DATA_VK / "images_cache"
+IMAGE_MAX_SIDE = 2560
+IMAGE_JPEG_QUALITY = 87
+
+# Коллажи для страниц списков: по строке на автора/серию/игру из первых обложек.
+# Коллаж кэшируется на диске, а после первой загрузки отправляется по file_id
+DIR_THUMBNAILS_CACHE = DIR_IMAGES_CACHE / "thumbnails"
+DIR_COLLAGES_CACHE = DIR_IMAGES_CACHE / "collages"
+COLLAGE_COVERS_PER_ROW = 5
+COLLAGE_CELL_SIZE = 160
+COLLAGE_JPEG_QUALITY = 80
+COLLAGE_WORKERS = 2
+
 TOKEN_FILE_NAME = DIR / "TOKEN.txt"
 
 try:
@@ -40,9 +55,10 @@ except:
     TOKEN_FILE_NAME.touch()
     sys.exit()
 
-SCREENSHOT_GIF_START_DEEP_LINKING = (
-    DIR / "etc" / "screenshots" / "start_deep_linking.gif"
-)
+# Статичные файлы, что бот отправляет пользователям
+DIR_SCREENSHOTS = DIR / "etc" / "screenshots"
+
+SCREENSHOT_GIF_START_DEEP_LINKING = DIR_SCREENSHOTS / "start_deep_linking.gif"
 if not SCREENSHOT_GIF_START_DEEP_LINKING.exists():
     raise Exception(f"Отсутствует файл: {SCREENSHOT_GIF_START_DEEP_LINKING}")
 
@@ -53,15 +69,55 @@ PLEASE_WAIT = "Пожалуйста, подождите..."
 DB_DIR_NAME = DIR / "database"
 DB_DIR_NAME.mkdir(parents=True, exist_ok=True)
 
-# Путь к файлу базы данных
+# Путь к файлу базы данных каталога (обложки, игры, серии и авторы)
 DB_FILE_NAME = str(DB_DIR_NAME / "database.sqlite")
 
+# Путь к файлу базы данных с активностью пользователей и чатов
+DB_TELEMETRY_FILE_NAME = str(DB_DIR_NAME / "telemetry.sqlite")
+
+# Максимальное количество соединений на чтение к базе каталога
+DB_CATALOG_MAX_CONNECTIONS = 32
+
 USER_NAME_ADMINS = [
     "@ilya_petrash",
 ]
 
+# Активность пользователей и чатов записывается в базу пачками:
+# раз в указанное количество секунд или при накоплении указанного количества запросов
+ACTIVITY_FLUSH_INTERVAL_SECS = 5
+ACTIVITY_FLUSH_MAX_EVENTS = 100
+
+# Загрузка обложек в телеграм (/fill_server_file_id).
+# Загрузки идут в один чат, а телеграм в одном чате разрешает около сообщения в секунду.
+# Лимит общий для отправки, удаления и редактирования сообщений, а при превышении
+# телеграм ответит RetryAfter и загрузки подождут
+UPLOAD_RATE_PER_SEC = 1
+UPLOAD_BURST = 1
+UPLOAD_WORKERS = 4
+# Попытки при ошибках сети, а ожидания по RetryAfter считаются отдельно
+UPLOAD_MAX_ATTEMPTS = 5
+UPLOAD_MAX_RETRY_AFTER = 20
+# Найденные file_id записываются в базу пачками
+UPLOAD_SAVE_BATCH_SIZE = 20
+# Сообщение с прогрессом обновляется не чаще указанного количества секунд
+UPLOAD_PROGRESS_INTERVAL_SECS = 5
+
 MAX_MESSAGE_LENGTH = 4096
+MAX_CAPTION_LENGTH = 1024
+
+# Кэш текстов карточек и списков, при превышении удаляются давно не использованные
+CARD_CACHE_MAX_BYTES = 16 * 1024 * 1024
+# Кэш клавиатур пагинаторов, по количеству клавиатур
+KEYBOARD_CACHE_SIZE = 10_000
+# Результаты поиска хранятся для пагинации, по количеству запросов
+SEARCH_CACHE_SIZE = 1000
+# Результат поиска устаревает через указанное время или при изменении версии каталога
+SEARCH_CACHE_TTL_SECS = 10 * 60
+# Минимальная доля общих триграмм для нечеткого поиска, как по умолчанию в pg_trgm
+FUZZY_SIMILARITY_THRESHOLD = 0.3
 ITEMS_PER_PAGE = 10
+# Больше 10 картинок в одном альбоме (sendMediaGroup) телеграм не принимает
+COVERS_PER_ALBUM = 10
 
 DEFAULT_AUTHOR_ID = 0
 DEFAULT_AUTHOR_NAME = 'Обложки "Фаргус"'
@@ -4,9 +4,19 @@
 __author__ = "ipetrash"
 
 
+import argparse
 import datetime as DT
 import json
+import sys
+import time
+
 from collections import defaultdict
+from contextlib import ExitStack
+from pathlib import Path
+from typing import BinaryIO, Iterable, Iterator, Type
+
+# pip install peewee
+from peewee import chunked
 
 from config import (
     FILE_NAME_DUMP,
@@ -14,10 +24,268 @@ from config import (
     DEFAULT_AUTHOR_URL,
     DEFAULT_AUTHOR_ID,
 )
-from bot.db import Game, GameSeries, Author, Cover, Author2Cover, BaseModel
+from bot.common import get_slug, log
+from bot.regexp_patterns import COMMAND_RELOAD_CATALOG
+from bot.db import (
+    Game,
+    GameSeries,
+    Author,
+    Cover,
+    Author2Cover,
+    BaseModel,
+    CoverIndex,
+    CatalogStatistic,
+    ImportCheckpoint,
+    DumpKey,
+    get_photo_number,
+    catalog_for_write,
+    bump_catalog_version,
+)
+
+
+# Таблицы, что заполняются по дампу
+DUMP_MODELS: list[Type[BaseModel]] = [GameSeries, Game, Author, Cover, Author2Cover]
+
+# Поля дампа, что не нужны для базы, не хранятся в памяти при чтении
+UNUSED_DUMP_FIELDS = ["post_text"]
+
+# Ограничение на количество строк в одном INSERT, чтобы не упереться в лимит параметров SQLITE
+INSERT_BATCH_SIZE = 500
+
+# Место записи в файле дампа: смещение в байтах и размер в байтах
+DumpPosition = tuple[int, int]
+
+
+def iter_dumps(file_name: Path, chunk_size: int = 64 * 1024) -> Iterator[dict]:
+    """
+    Потоковое чтение JSON-массива из файла: объекты разбираются по мере чтения,
+    а весь файл целиком в память не загружается
+    """
+
+    for _, dump in iter_dump_items(file_name, chunk_size):
+        yield dump
+
+
+def iter_dump_items(
+    file_name: Path,
+    chunk_size: int = 64 * 1024,
+) -> Iterator[tuple[DumpPosition, dict]]:
+    """
+    Потоковое чтение JSON-массива из файла, вместе с объектом возвращается его место в файле
+    """
+
+    decoder = json.JSONDecoder()
+
+    # newline="", чтобы переносы строк не менялись и смещения совпадали с байтами файла
+    with open(file_name, encoding="utf-8", newline="") as f:
+        buffer = ""
+        pos = 0
+        # Смещение в байтах символа buffer[pos]
+        byte_pos = 0
+
+        def _read() -> bool:
+            nonlocal buffer, pos
+            chunk = f.read(chunk_size)
+            buffer = buffer[pos:] + chunk
+            pos = 0
+            return bool(chunk)
+
+        def _skip(chars: str) -> str | None:
+            # Пропуск символов, возвращает следующий символ или None в конце файла.
+            # Пропускаются только ASCII-символы, поэтому каждый из них - один байт
+            nonlocal pos, byte_pos
+            while True:
+                while pos < len(buffer) and buffer[pos] in chars:
+                    pos += 1
+                    byte_pos += 1
+
+                if pos < len(buffer):
+                    return buffer[pos]
+
+                if not _read():
+                    return None
+
+        if _skip(" \t\r\n") != "[":
+            raise Exception(f"Ожидался JSON-массив в {file_name}")
+        pos += 1
+        byte_pos += 1
+
+        while True:
+            char = _skip(" \t\r\n,")
+            if char is None:
+                raise Exception(f"Неожиданный конец файла {file_name}")
+
+            if char == "]":
+                return
+
+            while True:
+                try:
+                    start = pos
+                    obj, pos = decoder.raw_decode(buffer, pos)
+                    break
+                except json.JSONDecodeError:
+                    # Объект прочитан не полностью
+                    if not _read():
+                        raise
+
+            size = len(buffer[start:pos].encode("utf-8"))
+            yield (byte_pos, size), strip_unused_fields(obj)
+            byte_pos += size
+
+
+def iter_dump_lines(file_name: Path, offset: int = 0) -> Iterator[tuple[DumpPosition, dict]]:
+    """
+    Чтение JSONL-файла, где на каждой строке по записи, начиная с offset байт.
+    Вместе с записью возвращается место ее строки в файле.
+    Последняя строка без переноса считается недописанной и пропускается
+    """
+
+    with open(file_name, "rb") as f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b"\n"):
+                return
+
+            if line.strip():
+                yield (offset, len(line)), strip_unused_fields(json.loads(line))
+            offset += len(line)
+
+
+def read_dump(f: BinaryIO, position: DumpPosition) -> dict:
+    offset, size = position
+    f.seek(offset)
+    return strip_unused_fields(json.loads(f.read(size)))
+
+
+def is_line_start(file_name: Path, offset: int) -> bool:
+    # Отметка подходит, если файл не стал короче и она стоит сразу после переноса строки
+    if offset == 0:
+        return True
+
+    if offset > file_name.stat().st_size:
+        return False
+
+    with open(file_name, "rb") as f:
+        f.seek(offset - 1)
+        return f.read(1) == b"\n"
+
+
+def strip_unused_fields(dump: dict) -> dict:
+    for name in UNUSED_DUMP_FIELDS:
+        dump.pop(name, None)
+
+    return dump
 
 
-def append_to_db(dump: dict):
+def get_dump_key(dump: dict) -> DumpKey:
+    # Id поста и номер картинки из имени файла
+    return dump["post_id"], get_photo_number(dump["photo_file_name"])
+
+
+def index_new_dumps(
+    file_name: Path,
+    last_key: DumpKey = (0, 0),
+    offset: int = 0,
+) -> tuple[list[tuple[DumpKey, DumpPosition]], DumpKey, int, list[DumpKey]]:
+    """
+    Поиск записей дампа, что идут после last_key. Записи разбираются потоком,
+    а в памяти остаются только их ключи и места в файле, сами записи потом читаются по ним.
+
+    JSONL-файл дописывается в конец, поэтому читается с offset - места, где закончилось прошлое чтение.
+    Строки после offset еще не импортировались, поэтому новые все, даже если их ключ не больше last_key.
+    Если файл был перезаписан, то он читается с начала, а новые записи ищутся по last_key.
+
+    JSON-массив при выгрузке перезаписывается целиком, места для продолжения чтения у него нет,
+    поэтому он каждый раз разбирается весь, а новые записи ищутся по last_key.
+    Для дописываемых дампов лучше JSONL, тогда читаются только новые строки.
+
+    Вернет ключи и места новых записей, ключ последней записи, смещение для следующего чтения
+    и ключи новых записей, что оказались не после last_key
+    """
+
+    if file_name.suffix == ".jsonl" and is_line_start(file_name, offset):
+        items = iter_dump_lines(file_name, offset)
+        min_key = None
+    elif file_name.suffix == ".jsonl":
+        offset = 0
+        items = iter_dump_lines(file_name, offset)
+        min_key = last_key
+    else:
+        offset = 0
+        items = iter_dump_items(file_name)
+        min_key = last_key
+
+    index = []
+    out_of_order_keys = []
+    new_last_key = last_key
+    for position, dump in items:
+        if file_name.suffix == ".jsonl":
+            offset = sum(position)
+
+        key = get_dump_key(dump)
+        if min_key is not None and key <= min_key:
+            continue
+
+        index.append((key, position))
+        if key <= last_key:
+            out_of_order_keys.append(key)
+        new_last_key = max(new_last_key, key)
+
+    return index, new_last_key, offset, out_of_order_keys
+
+
+def read_dumps_by_index(
+    file_names: list[Path],
+    index: Iterable[tuple[int, DumpPosition]],
+) -> Iterator[dict]:
+    """
+    Чтение записей по номеру файла в file_names и месту в файле
+    """
+
+    with ExitStack() as stack:
+        files: dict[int, BinaryIO] = dict()
+        for file_number, position in index:
+            f = files.get(file_number)
+            if not f:
+                f = files[file_number] = stack.enter_context(open(file_names[file_number], "rb"))
+
+            yield read_dump(f, position)
+
+
+def convert_to_jsonl(
+    file_name: Path,
+    new_file_name: Path,
+    last_key: DumpKey = (0, 0),
+) -> int:
+    """
+    Однократная конвертация JSON-массива в JSONL. JSON-массив при --delta каждый раз
+    разбирается целиком, а JSONL читается только с новых строк.
+    Записи переносятся целиком, вместе с полями, что не нужны для базы.
+    Уже импортированные записи (с ключом не больше last_key) пишутся в начало файла,
+    вернется смещение после них - с него импорт JSONL продолжится
+    """
+
+    offset = 0
+    with (
+        open(file_name, "rb") as f,
+        open(new_file_name, "w", encoding="utf-8", newline="\n") as f_jsonl,
+    ):
+        for is_imported in [True, False]:
+            for (start, size), dump in iter_dump_items(file_name):
+                if (get_dump_key(dump) <= last_key) != is_imported:
+                    continue
+
+                f.seek(start)
+                line = json.dumps(json.loads(f.read(size)), ensure_ascii=False) + "\n"
+                f_jsonl.write(line)
+
+                if is_imported:
+                    offset += len(line.encode("utf-8"))
+
+    return offset
+
+
+def append_to_db(dump: dict) -> Cover:
     series = dump["game_series"]
     game_series = GameSeries.add(name=series) if series else None
 
@@ -61,47 +329,386 @@ def append_to_db(dump: dict):
         if not link:
             Author2Cover.create(author=author, cover=cover)
 
+    return cover
+
 
-def make_identical_authors_unique():
+def set_unknown_game_series():
+    for game in list(Game.select().where(Game.series.is_null())):
+        game.series = GameSeries.get_unknown()
+        game.save()
+
+
+def fill_row_by_row(dumps: Iterable[dict]):
+    """
+    Прежний способ заполнения: каждый объект ищется и добавляется отдельными запросами
+    """
+
+    for dump in dumps:
+        append_to_db(dump)
+
+    set_unknown_game_series()
+
+
+class BulkImporter:
+    """
+    Заполнение базы пачками. Уже существующие в базе объекты загружаются в словари,
+    новые объекты дедуплицируются в памяти, а после записываются через insert_many.
+    Идентификаторы назначаются так же, как их бы назначила SQLITE при добавлении по одному,
+    поэтому результат совпадает с fill_row_by_row
+    """
+
+    def __init__(self):
+        self.game_series_id_by_slug: dict[str, int] = dict(
+            GameSeries.select(GameSeries.slug, GameSeries.id).tuples()
+        )
+        self.game_id_by_slug: dict[str, int] = dict(
+            Game.select(Game.slug, Game.id).tuples()
+        )
+        self.author_ids: set[int] = {
+            id for id, in Author.select(Author.id).tuples()
+        }
+        self.cover_id_by_file_name: dict[str, int] = dict(
+            Cover.select(Cover.file_name, Cover.id).tuples()
+        )
+        self.links: set[tuple[int, int]] = set(
+            Author2Cover.select(Author2Cover.author, Author2Cover.cover).tuples()
+        )
+
+        # Следующие id, как у SQLITE для INTEGER PRIMARY KEY: максимальный + 1
+        self.next_id_by_model: dict[Type[BaseModel], int] = {
+            model: (model.select(model.id).order_by(model.id.desc()).scalar() or 0) + 1
+            for model in DUMP_MODELS
+        }
+
+        # Новые строки по таблицам в порядке добавления
+        self.rows_by_model: dict[Type[BaseModel], list[dict]] = defaultdict(list)
+
+    def _add(self, model: Type[BaseModel], **row) -> int:
+        if row.get("id") is None:
+            row["id"] = self.next_id_by_model[model]
+
+        self.next_id_by_model[model] = max(self.next_id_by_model[model], row["id"] + 1)
+        self.rows_by_model[model].append(row)
+        return row["id"]
+
+    def add_game_series(self, name: str, id: int = None) -> int:
+        slug = get_slug(name)
+        if slug not in self.game_series_id_by_slug:
+            self.game_series_id_by_slug[slug] = self._add(GameSeries, id=id, name=name, slug=slug)
+
+        return self.game_series_id_by_slug[slug]
+
+    def add_game(self, name: str, series_id: int | None) -> int:
+        slug = get_slug(name)
+        if slug not in self.game_id_by_slug:
+            self.game_id_by_slug[slug] = self._add(Game, name=name, slug=slug, series=series_id)
+
+        return self.game_id_by_slug[slug]
+
+    def add_author(self, id: int, name: str, url: str = None) -> int:
+        if id not in self.author_ids:
+            self.author_ids.add(id)
+            self._add(Author, id=id, name=name, url=url or f"https://vk.com/id{id}")
+
+        return id
+
+    def append(self, dump: dict):
+        # Тот же порядок, что и в append_to_db
+        series = dump["game_series"]
+        game_series_id = self.add_game_series(name=series) if series else None
+
+        game_id = self.add_game(name=dump["game_name"], series_id=game_series_id)
+
+        author_ids = [
+            self.add_author(id=author_dump["id"], name=author_dump["name"])
+            for author_dump in dump["authors"]
+        ]
+
+        # Пусть у каждой обложки будет автор, по умолчанию, это сама группа
+        if not author_ids:
+            author_ids.append(
+                self.add_author(
+                    id=DEFAULT_AUTHOR_ID, name=DEFAULT_AUTHOR_NAME, url=DEFAULT_AUTHOR_URL
+                )
+            )
+
+        file_name = dump["photo_file_name"]
+        cover_id = self.cover_id_by_file_name.get(file_name)
+        if cover_id is None:
+            cover_id = self.cover_id_by_file_name[file_name] = self._add(
+                Cover,
+                text=dump["cover_text"],
+                file_name=file_name,
+                url_post=dump["post_url"],
+                url_post_image=dump["photo_post_url"],
+                game=game_id,
+                date_time=DT.datetime.fromisoformat(dump["date_time"]),
+                server_file_id=None,
+            )
+
+        for author_id in author_ids:
+            link = author_id, cover_id
+            if link not in self.links:
+                self.links.add(link)
+                self._add(Author2Cover, author=author_id, cover=cover_id)
+
+    def set_unknown_game_series(self):
+        new_games = [row for row in self.rows_by_model[Game] if row["series"] is None]
+        has_old_games = Game.select().where(Game.series.is_null()).exists()
+        if not new_games and not has_old_games:
+            return
+
+        # Аналог GameSeries.get_unknown
+        unknown_id = self.add_game_series(name="<Без серии>", id=0)
+        for row in new_games:
+            row["series"] = unknown_id
+
+        if has_old_games:
+            Game.update(series=unknown_id).where(Game.series.is_null()).execute()
+
+    def write(self) -> dict[Type[BaseModel], int]:
+        """
+        Запись новых строк в базу. Возвращает количество добавленных строк по таблицам
+        """
+
+        # Серия без игр (<Без серии>) добавляется последней, а ссылаются на нее
+        # только игры, поэтому порядок таблиц тот же, что и у внешних ключей
+        for model in DUMP_MODELS:
+            for batch in chunked(self.rows_by_model[model], INSERT_BATCH_SIZE):
+                model.insert_many(batch).execute()
+
+        return {model: len(self.rows_by_model[model]) for model in DUMP_MODELS}
+
+
+def fill_bulk(dumps: Iterable[dict]):
+    importer = BulkImporter()
+    for dump in dumps:
+        importer.append(dump)
+
+    importer.set_unknown_game_series()
+    importer.write()
+
+
+def make_identical_authors_unique(author_ids: Iterable[int] = None) -> list[int]:
     """
     Функция добавит id к name тем авторам, что имеют одинаковое имя.
     Пример: 'DELETED' -> 'DELETED (id74388128)'
+    Если указаны author_ids, то проверяются только имена этих авторов.
+    Вернет id переименованных авторов
     """
 
+    query = Author.select()
+    if author_ids is not None:
+        names = Author.select(Author.name).where(Author.id.in_(list(author_ids)))
+        query = query.where(Author.name.in_(names))
+
     name_by_objects = defaultdict(list)
-    for author in Author.select():
+    for author in query:
         name_by_objects[author.name].append(author)
 
-    for objects in name_by_objects.values():
-        if len(objects) == 1:
+    renamed_ids = []
+
+    for name, objects in name_by_objects.items():
+        # Тезки нового автора могли быть переименованы при прошлом импорте
+        if len(objects) == 1 and not (
+            author_ids is not None
+            and Author.select().where(Author.name.startswith(f"{name} (id")).exists()
+        ):
             continue
 
         for author in objects:
-            name = author.name
             new_name = f"{name} (id{author.id})"
             print(f"Renamed: {name!r} -> {new_name!r}")
 
             author.name = new_name
             author.save()
+            renamed_ids.append(author.id)
+
+    return renamed_ids
+
+
+def get_number_of_rows() -> int:
+    return sum(model.select().count() for model in DUMP_MODELS)
+
+
+def fill(dumps: Iterable[dict], bulk: bool = True):
+    """
+    Заполнение каталога по дампу одной транзакцией, после заполнения
+    пересчитываются производные от каталога таблицы.
+    Записи добавляются в порядке dumps, import_files передает их отсортированными по get_dump_key
+    """
+
+    database = Cover._meta.database
+    with database.atomic():
+        if bulk:
+            fill_bulk(dumps)
+        else:
+            fill_row_by_row(dumps)
+
+        make_identical_authors_unique()
+        # Renamed: 'DELETED' -> 'DELETED (id74388128)'
+        # Renamed: 'DELETED' -> 'DELETED (id135225390)'
+        # Renamed: 'DELETED' -> 'DELETED (id230625225)'
+
+        CoverIndex.rebuild()
+        CatalogStatistic.rebuild()
+
+        # Кэши бота, построенные по прошлым данным, устаревают
+        bump_catalog_version(database)
+
+        # Статистика для планировщика запросов по заполненным таблицам
+        database.execute_sql("ANALYZE")
+
+
+def fill_delta(dumps: Iterable[dict]) -> set[int]:
+    """
+    Добавление новых записей в уже заполненный каталог. Запросов столько, сколько новых записей,
+    а производные таблицы пересчитываются только для затронутых обложек.
+    Вернет id затронутых обложек
+    """
+
+    cover_ids = {append_to_db(dump).id for dump in dumps}
+    if not cover_ids:
+        return cover_ids
+
+    set_unknown_game_series()
+
+    author_ids = Author2Cover.select(Author2Cover.author).where(
+        Author2Cover.cover.in_(list(cover_ids))
+    )
+    renamed_author_ids = make_identical_authors_unique(id for id, in author_ids.tuples())
+
+    # У обложек переименованных авторов поменялся текст в индексе поиска
+    if renamed_author_ids:
+        cover_ids.update(
+            id for id, in Author2Cover.select(Author2Cover.cover)
+            .where(Author2Cover.author.in_(renamed_author_ids))
+            .tuples()
+        )
+
+    CoverIndex.rebuild(cover_ids)
+    CatalogStatistic.rebuild(cover_ids)
+
+    bump_catalog_version()
+
+    return cover_ids
+
+
+def import_files(file_names: list[Path], bulk: bool = True, delta: bool = False) -> int:
+    """
+    Импорт файлов дампов. При delta импортируются только записи после отметок
+    прошлого импорта, иначе каталог заполняется по всем записям.
+    Отметки обновляются в той же транзакции, что и каталог.
+    Вернет количество импортированных записей
+    """
+
+    database = Cover._meta.database
+    with database.atomic():
+        # Ключ записи, номер файла и место записи в файле
+        index = []
+        checkpoints = []
+        for file_number, file_name in enumerate(file_names):
+            if delta:
+                checkpoint = ImportCheckpoint.get_for(file_name)
+                new_index, last_key, offset, out_of_order_keys = index_new_dumps(
+                    file_name, checkpoint.get_last_key(), checkpoint.offset
+                )
+                if out_of_order_keys:
+                    log.warning(
+                        f"В {file_name} дописано {len(out_of_order_keys)} записей не по порядку, "
+                        f"не после отметки {checkpoint.get_last_key()}, они тоже импортируются: "
+                        f"{out_of_order_keys}"
+                    )
+            else:
+                new_index, last_key, offset, _ = index_new_dumps(file_name)
+
+            index += [(key, file_number, position) for key, position in new_index]
+            checkpoints.append((file_name, last_key, offset))
+
+        # Сортируются только ключи, а записи читаются из файлов уже по порядку
+        index.sort()
+        dumps = read_dumps_by_index(
+            file_names, ((file_number, position) for _, file_number, position in index)
+        )
+
+        if delta:
+            fill_delta(dumps)
+        else:
+            fill(dumps, bulk=bulk)
+
+        for file_name, last_key, offset in checkpoints:
+            ImportCheckpoint.set_for(file_name, last_key, offset)
+
+    return len(index)
 
 
 if __name__ == "__main__":
-    dumps = json.loads(FILE_NAME_DUMP.read_text("utf-8"))
+    parser = argparse.ArgumentParser(description="Заполнение базы каталога по дампу")
+    parser.add_argument(
+        "--row-by-row",
+        action="store_true",
+        help="Прежний способ: каждый объект ищется и добавляется отдельными запросами",
+    )
+    parser.add_argument(
+        "--delta",
+        action="store_true",
+        help="Импорт только записей, что появились после прошлого импорта",
+    )
+    parser.add_argument(
+        "--dump",
+        type=Path,
+        nargs="+",
+        default=[FILE_NAME_DUMP],
+        help=(
+            "Пути к дампам: JSON-массив или JSONL, что дописывается в конец. "
+            "JSON-массив при --delta разбирается целиком, а JSONL - только с новых строк"
+        ),
+    )
+    parser.add_argument(
+        "--to-jsonl",
+        action="store_true",
+        help=(
+            "Конвертация дампов из JSON-массива в JSONL рядом с ними, без импорта. "
+            "Отметка прошлого импорта переносится, после --delta продолжит с новых записей"
+        ),
+    )
+    args = parser.parse_args()
 
-    # Сортировка по id посту и номера картинки из имени файла
-    dumps.sort(key=lambda dump: (dump["post_id"], dump["photo_file_name"]))
+    if args.to_jsonl:
+        with catalog_for_write() as database, database.atomic():
+            for file_name in args.dump:
+                new_file_name = file_name.with_suffix(".jsonl")
 
-    for dump in dumps:
-        append_to_db(dump)
+                last_key = ImportCheckpoint.get_for(file_name).get_last_key()
+                offset = convert_to_jsonl(file_name, new_file_name, last_key)
+                ImportCheckpoint.set_for(new_file_name, last_key, offset)
 
-    for game in list(Game.select().where(Game.series.is_null())):
-        game.series = GameSeries.get_unknown()
-        game.save()
+                print(f"{file_name} -> {new_file_name}")
+
+        sys.exit()
+
+    # База каталога в боте открыта только на чтение, поэтому заполнение через отдельное соединение
+    with catalog_for_write():
+        number_of_rows = get_number_of_rows()
+
+        t = time.perf_counter()
+        number_of_dumps = import_files(args.dump, bulk=not args.row_by_row, delta=args.delta)
+        elapsed_secs = time.perf_counter() - t
+
+        BaseModel.print_count_of_tables()
+        # Author: 165, Author2Cover: 607, CatalogStatistic: 816, Cover: 567, Game: 451, GameSeries: 200, TgChat: 2, TgUser: 2
+
+        number_of_rows = get_number_of_rows() - number_of_rows
+        print(
+            f"Импортировано {number_of_dumps} записей, "
+            f"добавлено {number_of_rows} строк за {elapsed_secs:.2f} секунд "
+            f"({number_of_rows / elapsed_secs:.0f} строк/с)"
+        )
 
-    BaseModel.print_count_of_tables()
-    # Author: 165, Author2Cover: 607, Cover: 567, Game: 451, GameSeries: 200, TgChat: 2, TgUser: 2
+        # Проверка перебирает весь каталог, поэтому только после полного заполнения
+        if not args.delta:
+            for error in CatalogStatistic.check():
+                print(f"CatalogStatistic: {error}")
 
-    make_identical_authors_unique()
-    # Renamed: 'DELETED' -> 'DELETED (id74388128)'
-    # Renamed: 'DELETED' -> 'DELETED (id135225390)'
-    # Renamed: 'DELETED' -> 'DELETED (id230625225)'
+    # Бот держит каталог в памяти, после импорта его нужно перечитать
+    print(f"Чтобы бот увидел изменения, выполните команду /{COMMAND_RELOAD_CATALOG}")
@@ -12,9 +12,12 @@ from telegram.ext import Updater, Defaults
 from telegram.utils.request import Request
 
 from bot import commands
+from bot.activity import activity_tracker
+from bot.catalog import get_catalog
 from bot.common import log
 from bot.debug import ExtBotDebug
-from config import TOKEN
+from bot.uploader import cover_uploader
+from config import TOKEN, UPLOAD_WORKERS
 
 
 def main():
@@ -24,11 +27,20 @@ def main():
     workers = cpu_count
     log.debug(f"System: CPU_COUNT={cpu_count}, WORKERS={workers}")
 
+    catalog = get_catalog()
+    log.debug(catalog.get_memory_report())
+
+    # Индекс нечеткого поиска строится сразу, а не на первом запросе /find
+    log.debug(f"Fuzzy index: {len(catalog.get_fuzzy_index())} words")
+
     updater = Updater(
         workers=workers,
+        # При остановке бота загрузка обложек прерывается, чтобы не ждать ее завершения
+        user_sig_handler=lambda *_: cover_uploader.stop(),
         bot=ExtBotDebug(
             token=TOKEN,
-            request=Request(con_pool_size=workers + 4),
+            # Соединения нужны и обработчикам, и потокам загрузки обложек
+            request=Request(con_pool_size=workers + 4 + UPLOAD_WORKERS),
             defaults=Defaults(run_async=True),
         ),
     )
@@ -38,9 +50,17 @@ def main():
     dp = updater.dispatcher
     commands.setup(dp)
 
+    activity_tracker.start()
+
     updater.start_polling()
+
+    # Загрузка обложек, прерванная при прошлом запуске, продолжится
+    cover_uploader.resume(updater.job_queue)
     updater.idle()
 
+    # Запись накопленной активности перед выходом
+    activity_tracker.stop()
+
     log.debug("Finish")
 
 